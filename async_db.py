@@ -0,0 +1,103 @@
+# async_db.py
+import asyncio
+import functools
+from concurrent.futures import ThreadPoolExecutor
+
+import metrics
+import player_lists
+from storage import db
+
+
+def _offload(func):
+    """Wraps a blocking database function so it runs (timed) on the store's executor."""
+    def timed_call(*args, **kwargs):
+        with metrics.timer("db_query_duration_seconds", query=func.__name__):
+            return func(*args, **kwargs)
+
+    @functools.wraps(func)
+    async def wrapper(self, *args, **kwargs):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._executor, functools.partial(timed_call, *args, **kwargs))
+    return wrapper
+
+
+class AsyncTournamentStore:
+    """Async facade over the database backend (see storage.py) for use inside handlers.
+
+    Every call runs on the store's own threads, so database work never
+    blocks the event loop: one thread for SQLite, whose queries all share
+    that thread's long-lived connection, or one per pooled PostgreSQL
+    connection.
+    """
+
+    def __init__(self):
+        self._executor = ThreadPoolExecutor(max_workers=db.POOL_SIZE, thread_name_prefix="db")
+
+    def shutdown(self):
+        self._executor.submit(db.close_db_connections).result()
+        self._executor.shutdown(wait=True)
+
+    setup_database = _offload(db.setup_database)
+    cache_stats = _offload(db.cache_stats)
+    acquire_background_lock = _offload(db.acquire_background_lock)
+    holds_background_lock = _offload(db.holds_background_lock)
+
+    # --- Users ---
+    add_or_update_user = _offload(db.add_or_update_user)
+    add_or_update_users = _offload(db.add_or_update_users)
+    get_user = _offload(db.get_user)
+    get_all_user_ids = _offload(db.get_all_user_ids)
+    is_admin = _offload(db.is_admin)
+    grant_admin = _offload(db.grant_admin)
+
+    # --- Tournaments ---
+    add_tournament = _offload(db.add_tournament)
+    get_open_tournaments = _offload(db.get_open_tournaments)
+    get_open_tournaments_page = _offload(db.get_open_tournaments_page)
+    get_tournament_details = _offload(db.get_tournament_details)
+    set_room_details = _offload(db.set_room_details)
+
+    # --- Tournament lifecycle ---
+    get_next_tournament_event_time = _offload(db.get_next_tournament_event_time)
+    get_due_tournament_events = _offload(db.get_due_tournament_events)
+    advance_tournament_event = _offload(db.advance_tournament_event)
+    get_unscheduled_tournaments = _offload(db.get_unscheduled_tournaments)
+    set_tournament_schedule = _offload(db.set_tournament_schedule)
+
+    # --- Registrations ---
+    register_user_for_tournament = _offload(db.register_user_for_tournament)
+    register_team = _offload(db.register_team)
+    get_team_members = _offload(db.get_team_members)
+    get_registrations_for_tournament = _offload(db.get_registrations_for_tournament)
+    get_registrations_page = _offload(db.get_registrations_page)
+
+    # --- Payments ---
+    mark_payments = _offload(db.mark_payments)
+    get_payment_summary = _offload(db.get_payment_summary)
+    get_unpaid_players = _offload(db.get_unpaid_players)
+
+    # --- Broadcast jobs ---
+    count_segment = _offload(db.count_segment)
+    create_broadcast_job = _offload(db.create_broadcast_job)
+    get_unfinished_broadcast_jobs = _offload(db.get_unfinished_broadcast_jobs)
+    get_broadcast_job = _offload(db.get_broadcast_job)
+    cancel_scheduled_tournament_jobs = _offload(db.cancel_scheduled_tournament_jobs)
+    get_pending_deliveries = _offload(db.get_pending_deliveries)
+    record_deliveries = _offload(db.record_deliveries)
+    get_broadcast_job_counts = _offload(db.get_broadcast_job_counts)
+    finish_broadcast_job = _offload(db.finish_broadcast_job)
+    get_delivery_latency = _offload(db.get_delivery_latency)
+
+    # --- Bulk export/import (run on the store's threads, which own the connections) ---
+    export_registrations = _offload(player_lists.export_registrations)
+    import_players = _offload(player_lists.import_players)
+
+    # --- Bot persistence ---
+    load_persistence_data = _offload(db.load_persistence_data)
+    get_persistence_data_if_newer = _offload(db.get_persistence_data_if_newer)
+    load_conversation_states = _offload(db.load_conversation_states)
+    get_conversation_states = _offload(db.get_conversation_states)
+    write_persistence = _offload(db.write_persistence)
+
+
+store = AsyncTournamentStore()
@@ -0,0 +1,95 @@
+# benchmarks/bench_bulk_import.py
+"""Bulk import and streaming export of a large player list.
+
+Writes a `rows`-player CSV file, imports it into a tournament in one
+transaction (executemany), then compares that with registering a sample of
+the same players one at a time through the regular /register path. Finally
+exports the tournament back to CSV and JSON, reporting the peak Python
+memory of the streaming export against building the file from fetchall().
+With DATABASE_URL set it runs on PostgreSQL (see loadtest.throwaway_database).
+
+    python benchmarks/bench_bulk_import.py [rows]
+"""
+import csv
+import io
+import os
+import sys
+import tempfile
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+import player_lists  # noqa: E402
+from loadtest import throwaway_database  # noqa: E402
+from storage import db  # noqa: E402
+
+SAMPLE = 2000  # players registered one by one for the comparison
+
+
+def write_csv(path, rows, first_id=1):
+    with open(path, "w", newline="", encoding="utf-8") as f:
+        writer = csv.writer(f)
+        writer.writerow(player_lists.FIELDS)
+        writer.writerows((i, f"player{i}", str(1_000_000_000 + i)) for i in range(first_id, first_id + rows))
+
+
+def peak_memory(func):
+    tracemalloc.start()
+    try:
+        result = func()
+        return result, tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+
+def build_in_memory(tournament_id):
+    out = io.StringIO()
+    writer = csv.writer(out)
+    writer.writerow(player_lists.FIELDS)
+    writer.writerows(tuple(row) for row in db.get_registrations_for_tournament(tournament_id))
+    return out.getvalue().encode()
+
+
+def main(rows):
+    with tempfile.TemporaryDirectory() as tmp, throwaway_database(tmp):
+        db.setup_database()
+        path = os.path.join(tmp, "players.csv")
+        write_csv(path, rows)
+        print(f"{rows} players, {os.path.getsize(path) / 1e6:.1f} MB CSV")
+
+        db.add_tournament("BR", "bench", 0, rows)
+        start = time.perf_counter()
+        with open(path, "rb") as f:
+            registered, total = player_lists.import_players(1, "csv", f)
+        elapsed = time.perf_counter() - start
+        print(f"Bulk import:        {registered}/{total} registered in {elapsed:.2f}s ({total / elapsed:,.0f} rows/s)")
+
+        db.add_tournament("BR", "bench", 0, SAMPLE)
+        start = time.perf_counter()
+        for i in range(rows + 1, rows + 1 + SAMPLE):
+            db.add_or_update_user(i, f"player{i}", str(1_000_000_000 + i))
+            db.register_user_for_tournament(2, i)
+        elapsed = time.perf_counter() - start
+        print(f"One at a time:      {SAMPLE} registered in {elapsed:.2f}s ({SAMPLE / elapsed:,.0f} rows/s)")
+
+        # Timings come from a plain run; memory from a second run under tracemalloc.
+        for fmt in player_lists.FORMATS:
+            with tempfile.SpooledTemporaryFile(max_size=1024 * 1024) as out:
+                start = time.perf_counter()
+                count = player_lists.export_registrations(1, fmt, out)
+                elapsed = time.perf_counter() - start
+                size = out.tell()
+            with tempfile.SpooledTemporaryFile(max_size=1024 * 1024) as out:
+                _, peak = peak_memory(lambda: player_lists.export_registrations(1, fmt, out))
+            print(f"Streaming {fmt} export: {count} rows, {size / 1e6:.1f} MB in {elapsed:.2f}s, "
+                  f"peak {peak / 1e6:.2f} MB")
+        start = time.perf_counter()
+        data = build_in_memory(1)
+        elapsed = time.perf_counter() - start
+        _, peak = peak_memory(lambda: build_in_memory(1))
+        print(f"fetchall csv export: {len(data) / 1e6:.1f} MB in {elapsed:.2f}s, peak {peak / 1e6:.2f} MB")
+        db.close_db_connections()
+
+
+if __name__ == "__main__":
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 100_000)
@@ -0,0 +1,81 @@
+# benchmarks/bench_db_connections.py
+"""Connects-per-update benchmark for database.py.
+
+Replays the database calls made by one /register flow and one admin message,
+first with a fresh connection per call (the old behaviour) and then with the
+pooled per-thread connection, and prints connects and time per update.
+SQLite only: pg_database.py always pools its connections, so there is no
+connect-per-call mode to compare with.
+
+    python benchmarks/bench_db_connections.py [flows]
+"""
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+import database as db  # noqa: E402
+
+
+def register_flow(user_id, tournament_id):
+    db.get_open_tournaments()                                 # register_start
+    db.get_tournament_details(tournament_id)                  # register_tournament_choice
+    db.get_registrations_for_tournament(tournament_id)
+    db.add_or_update_user(user_id, f"player{user_id}", str(user_id))   # register_get_userid
+    db.register_user_for_tournament(tournament_id, user_id)
+    db.get_tournament_details(tournament_id)
+
+
+def admin_message(admin_id):
+    db.is_admin(admin_id)
+
+
+def run(flows, per_call_connect):
+    calls = []
+    if per_call_connect:
+        # Emulate the old connect/close per function call.
+        for name in ("get_open_tournaments", "get_tournament_details", "get_registrations_for_tournament",
+                     "add_or_update_user", "register_user_for_tournament", "is_admin"):
+            original = getattr(db, name)
+
+            def wrapper(*args, _original=original, **kwargs):
+                try:
+                    return _original(*args, **kwargs)
+                finally:
+                    db.close_db_connections()
+            calls.append((name, original))
+            setattr(db, name, wrapper)
+    try:
+        db.add_tournament("BR", "July 10, 9:00 PM", 0, flows + 1)
+        tournament_id = db.get_open_tournaments()[-1]['id']
+        db.close_db_connections()
+        start_connects = db.connect_count
+        start = time.perf_counter()
+        for i in range(flows):
+            register_flow(1_000_000 + i, tournament_id)
+            admin_message(1)
+        elapsed = time.perf_counter() - start
+    finally:
+        for name, original in calls:
+            setattr(db, name, original)
+    updates = flows * 4  # three /register updates plus one admin message
+    return (db.connect_count - start_connects) / updates, elapsed / updates * 1e6
+
+
+def main():
+    if os.environ.get("DATABASE_URL"):
+        sys.exit("bench_db_connections measures the SQLite backend; unset DATABASE_URL")
+    flows = int(sys.argv[1]) if len(sys.argv) > 1 else 500
+    with tempfile.TemporaryDirectory() as tmp:
+        db.DB_FILE = os.path.join(tmp, "bench.db")
+        db.setup_database()
+        db.grant_admin(1)
+        for label, per_call in (("connect per call", True), ("pooled", False)):
+            connects, micros = run(flows, per_call)
+            print(f"{label:>17}: {connects:5.2f} connects/update, {micros:8.1f} us/update")
+        db.close_db_connections()
+
+
+if __name__ == "__main__":
+    main()
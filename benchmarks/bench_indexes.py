@@ -0,0 +1,90 @@
+# benchmarks/bench_indexes.py
+"""Query timings on a seeded database with and without the lookup indexes.
+
+Seeds `rows` registrations spread over many tournaments (most of them
+finished), times the hot queries, then drops the indexes added by the
+migrations and times them again. With DATABASE_URL set it runs on
+PostgreSQL (see loadtest.throwaway_database).
+
+    python benchmarks/bench_indexes.py [rows]
+"""
+import os
+import random
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+import storage  # noqa: E402
+from loadtest import throwaway_database  # noqa: E402
+from storage import db  # noqa: E402
+
+INDEXES = ("idx_registrations_unique", "idx_registrations_telegram_id", "idx_registrations_tournament_page",
+           "idx_tournaments_status")
+
+
+def sql(query):
+    """`query` with the backend's placeholders (written with SQLite's ?)."""
+    return query.replace("?", "%s") if storage.DATABASE_URL else query
+
+
+def seed(rows):
+    tournaments = rows // 50
+    users = rows // 10
+    rng = random.Random(1)
+    # Both backends' connections commit at the end of a `with` block.
+    with db.get_db_connection() as conn:
+        c = conn.cursor()
+        c.executemany(sql("INSERT INTO users (telegram_id, ff_username, ff_userid) VALUES (?, ?, ?)"),
+                      ((i, f"player{i}", str(i)) for i in range(1, users + 1)))
+        c.executemany(sql("INSERT INTO tournaments (mode, date_time, fee, max_players, status) VALUES ('BR', 'x', 0, 50, ?)"),
+                      (('OPEN' if i > tournaments - 20 else 'FINISHED',) for i in range(tournaments)))
+        c.executemany(sql("INSERT INTO registrations (tournament_id, telegram_id) VALUES (?, ?) ON CONFLICT DO NOTHING"),
+                      ((i // 50 + 1, rng.randint(1, users)) for i in range(rows)))
+    if storage.DATABASE_URL:
+        with db.get_db_connection() as conn:
+            conn.execute("ANALYZE")  # PostgreSQL plans from statistics, which autovacuum may not have gathered yet
+    return tournaments, users
+
+
+def timed(label, func, repeat):
+    start = time.perf_counter()
+    for _ in range(repeat):
+        func()
+    print(f"  {label:<34} {(time.perf_counter() - start) / repeat * 1e3:9.3f} ms")
+
+
+def query(query, params):
+    with db.get_db_connection() as conn:
+        return conn.execute(sql(query), params).fetchall()
+
+
+def run_queries(tournaments, users):
+    tid = tournaments // 2
+    timed("get_registrations_for_tournament", lambda: db.get_registrations_for_tournament(tid), 20)
+    timed("duplicate check", lambda: query(
+        "SELECT 1 FROM registrations WHERE tournament_id = ? AND telegram_id = ?", (tid, users // 2)), 20)
+    timed("registrations by player", lambda: query(
+        "SELECT tournament_id FROM registrations WHERE telegram_id = ?", (users // 2,)), 20)
+    timed("get_open_tournaments", db.get_open_tournaments.__wrapped__, 20)
+
+
+def main():
+    rows = int(sys.argv[1]) if len(sys.argv) > 1 else 1_000_000
+    with tempfile.TemporaryDirectory() as tmp, throwaway_database(tmp):
+        db.setup_database()
+        start = time.perf_counter()
+        tournaments, users = seed(rows)
+        print(f"Seeded {rows} registrations, {tournaments} tournaments, {users} users in {time.perf_counter() - start:.1f}s")
+        print("With indexes:")
+        run_queries(tournaments, users)
+        with db.get_db_connection() as conn:
+            for index in INDEXES:
+                conn.execute(f"DROP INDEX {index}")
+        print("Without indexes:")
+        run_queries(tournaments, users)
+        db.close_db_connections()
+
+
+if __name__ == "__main__":
+    main()
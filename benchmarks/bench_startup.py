@@ -0,0 +1,160 @@
+# benchmarks/bench_startup.py
+"""Cold start benchmark: process launch to first answered update.
+
+Launches the bot under uvicorn in a fresh process against the fake Bot API
+(benchmarks/fake_bot_api.py) and measures, from the moment the process is
+spawned:
+
+  import     how long `import main` takes in a fresh interpreter
+  serving    until the server answers GET /
+  first      until a /start posted to the webhook has been answered (the
+             fake API received the reply)
+
+for a new database (migrations run) and a restart on an up-to-date one, and
+checks that the server still comes up when the Bot API can't be reached.
+With DATABASE_URL set each new database is a throwaway PostgreSQL schema
+(see loadtest.throwaway_schema) instead of a SQLite file in a new directory.
+Pass --dir with an older checkout to compare against it (its main:app is used
+when it has no create_app factory).
+
+    python benchmarks/bench_startup.py [--runs 3] [--dir PATH] [--port 8091]
+"""
+import argparse
+import contextlib
+import json
+import multiprocessing
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import urllib.error
+import urllib.request
+
+sys.path.insert(0, os.path.dirname(__file__))
+import fake_bot_api  # noqa: E402
+from loadtest import ADMIN_ID, TOKEN, fake_api_stats, message, reset_fake_api, throwaway_schema  # noqa: E402
+
+REPO = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+TIMEOUT = 30
+
+
+def request(url, data=None):
+    body = None if data is None else json.dumps(data).encode()
+    req = urllib.request.Request(url, data=body, headers={"Content-Type": "application/json"})
+    try:
+        with urllib.request.urlopen(req, timeout=TIMEOUT) as response:
+            return response.status
+    except urllib.error.HTTPError as e:
+        return e.code
+
+
+def wait_until(check):
+    deadline = time.perf_counter() + TIMEOUT
+    while time.perf_counter() < deadline:
+        try:
+            if check():
+                return time.perf_counter()
+        except OSError:
+            pass
+        time.sleep(0.005)
+    raise TimeoutError
+
+
+def env(api_url, source, database_url=None):
+    variables = {**os.environ, "BOT_TOKEN": TOKEN, "ADMIN_ID": str(ADMIN_ID), "PYTHONPATH": source,
+                 "TELEGRAM_API_BASE_URL": f"{api_url}/bot", "PYTHONWARNINGS": "ignore"}
+    if database_url:
+        variables["DATABASE_URL"] = database_url
+    return variables
+
+
+def time_import(api_url, source, cwd):
+    code = "import time; t = time.perf_counter(); import main; print(time.perf_counter() - t)"
+    out = subprocess.run([sys.executable, "-c", code], env=env(api_url, source), cwd=cwd,
+                         capture_output=True, text=True, check=True)
+    return float(out.stdout.split()[-1])
+
+
+def launch(api_url, source, cwd, port, database_url=None):
+    with open(os.path.join(source, "main.py"), encoding="utf-8") as f:
+        target = ["--factory", "main:create_app"] if "def create_app" in f.read() else ["main:app"]
+    return subprocess.Popen(
+        [sys.executable, "-m", "uvicorn", *target, "--port", str(port), "--log-level", "warning"],
+        env=env(api_url, source, database_url), cwd=cwd, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+
+def cold_start(api_url, source, cwd, port, database_url=None):
+    """Returns (seconds until serving, seconds until the first /start was answered)."""
+    reset_fake_api(api_url)
+    start = time.perf_counter()
+    server = launch(api_url, source, cwd, port, database_url)
+    try:
+        serving = wait_until(lambda: request(f"http://127.0.0.1:{port}/") == 200)
+        wait_until(lambda: request(f"http://127.0.0.1:{port}/{TOKEN}", message(42, "/start")) == 200)
+        first = wait_until(lambda: fake_api_stats(api_url)["calls"].get("sendMessage", 0) > 0)
+        return serving - start, first - start
+    finally:
+        server.terminate()
+        server.wait()
+
+
+def offline_start(source, cwd, port, database_url=None):
+    """With the Bot API unreachable: seconds until serving, and the webhook's status code."""
+    start = time.perf_counter()
+    server = launch("http://127.0.0.1:9", source, cwd, port, database_url)
+    try:
+        serving = wait_until(lambda: request(f"http://127.0.0.1:{port}/") == 200)
+        status = request(f"http://127.0.0.1:{port}/{TOKEN}", message(42, "/start"))
+        return serving - start, status
+    finally:
+        server.terminate()
+        server.wait()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--runs", type=int, default=3)
+    parser.add_argument("--dir", default=REPO, help="checkout to benchmark (default: this one)")
+    parser.add_argument("--port", type=int, default=8091)
+    args = parser.parse_args()
+    source = os.path.abspath(args.dir)
+
+    api_url = f"http://127.0.0.1:{args.port + 1}"
+    api = multiprocessing.get_context("spawn").Process(
+        target=fake_bot_api.serve, kwargs=dict(port=args.port + 1), daemon=True)
+    api.start()
+    wait_until(lambda: fake_api_stats(api_url))
+
+    with tempfile.TemporaryDirectory() as tmp, contextlib.ExitStack() as schemas:
+        imports = [time_import(api_url, source, tmp) for _ in range(args.runs)]
+        print(f"import main:           median {statistics.median(imports) * 1e3:6.0f} ms")
+        database_urls = []  # the PostgreSQL schema of each new database, with DATABASE_URL set
+        for label in ("new database", "up-to-date database"):
+            if label == "new database":
+                runs = []
+                for i in range(args.runs):
+                    cwd = os.path.join(tmp, f"new{i}")
+                    os.mkdir(cwd)
+                    if os.environ.get("DATABASE_URL"):
+                        database_urls.append(schemas.enter_context(throwaway_schema(os.environ["DATABASE_URL"])))
+                    runs.append(cold_start(api_url, source, cwd, args.port, database_urls[i] if database_urls else None))
+            else:
+                runs = [cold_start(api_url, source, os.path.join(tmp, "new0"), args.port,
+                                   database_urls[0] if database_urls else None) for _ in range(args.runs)]
+            serving = statistics.median(r[0] for r in runs)
+            first = statistics.median(r[1] for r in runs)
+            print(f"{label + ':':22} serving after {serving * 1e3:6.0f} ms, first update answered after "
+                  f"{first * 1e3:6.0f} ms (median of {args.runs})")
+        try:
+            serving, status = offline_start(source, os.path.join(tmp, "new0"), args.port,
+                                            database_urls[0] if database_urls else None)
+            print(f"Bot API unreachable:   serving after {serving * 1e3:6.0f} ms, webhook answered {status}")
+        except TimeoutError:
+            print("Bot API unreachable:   the server never came up")
+    api.terminate()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,82 @@
+# benchmarks/bench_user_upserts.py
+"""/start user upserts: one commit per call vs the write-behind buffer.
+
+Replays a burst of `starts` /start messages from a pool of users (a viral
+post brings many new users and some repeat presses) through the async
+store, first awaiting store.add_or_update_user per message as the handler
+used to, then queueing them on a UserWriteBuffer and flushing it. Prints
+commits, commits/s and /starts absorbed per second for both, and checks
+that the users table ends up the same. With DATABASE_URL set it runs on
+PostgreSQL (see loadtest.throwaway_database).
+
+    python benchmarks/bench_user_upserts.py [starts] [users]
+"""
+import asyncio
+import os
+import random
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+import async_db  # noqa: E402
+from loadtest import throwaway_database  # noqa: E402
+from user_writes import UserWriteBuffer  # noqa: E402
+
+CONCURRENCY = 64  # handlers running at once, as with the update dispatcher's workers
+
+
+async def replay(handle, user_ids):
+    queue = list(reversed(user_ids))
+
+    async def worker():
+        while queue:
+            await handle(queue.pop())
+    await asyncio.gather(*(worker() for _ in range(CONCURRENCY)))
+
+
+async def direct(store, user_ids):
+    start = time.perf_counter()
+    await replay(store.add_or_update_user, user_ids)
+    return time.perf_counter() - start, len(user_ids)
+
+
+async def buffered(store, user_ids):
+    buffer = UserWriteBuffer(store)
+
+    async def handle(user_id):
+        buffer.add_or_update_user(user_id)
+        await asyncio.sleep(0)  # the rest of the handler (sending the reply) yields here
+
+    start = time.perf_counter()
+    await replay(handle, user_ids)
+    await buffer.flush()
+    return time.perf_counter() - start, buffer.batches
+
+
+async def run(label, func, user_ids):
+    store = async_db.AsyncTournamentStore()
+    await store.setup_database()
+    elapsed, commits = await func(store, user_ids)
+    users = await store.count_segment(("all", None))
+    store.shutdown()
+    print(f"{label:9} {commits:7} commits in {elapsed:6.2f}s  {commits / elapsed:9,.0f} commits/s  "
+          f"{len(user_ids) / elapsed:9,.0f} /starts/s  {users} users")
+    return users
+
+
+def main(starts, users):
+    rng = random.Random(1)
+    user_ids = [rng.randrange(users) + 1 for _ in range(starts)]
+    print(f"{starts} /starts from {len(set(user_ids))} distinct users, {CONCURRENCY} concurrent handlers")
+    results = []
+    for label, func in (("direct", direct), ("buffered", buffered)):
+        with tempfile.TemporaryDirectory() as tmp, throwaway_database(tmp):
+            results.append(asyncio.run(run(label, func, user_ids)))
+    before, after = results
+    assert before == after, (before, after)
+
+
+if __name__ == "__main__":
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 20_000,
+         int(sys.argv[2]) if len(sys.argv) > 2 else 15_000)
@@ -0,0 +1,129 @@
+# benchmarks/fake_bot_api.py
+"""A local stand-in for the Telegram Bot API used by the load tests.
+
+Answers every Bot API method the bot uses, records call counts and request
+timestamps per method, and can simulate flood control (429 with
+retry_after) and users who blocked the bot (403). Point the bot at it with
+
+    TELEGRAM_API_BASE_URL=http://127.0.0.1:8081/bot
+
+and read what it saw from GET /_stats (POST /_reset clears the counters).
+
+    python benchmarks/fake_bot_api.py [--port 8081] [--flood-rate 0.001] [--blocked-every 20] [--latency-ms 5]
+"""
+import argparse
+import asyncio
+import random
+import time
+from collections import Counter
+from urllib.parse import parse_qsl
+
+from starlette.applications import Starlette
+from starlette.requests import Request
+from starlette.responses import JSONResponse
+from starlette.routing import Route
+
+
+class FakeBotAPI:
+    def __init__(self, flood_rate=0.0, retry_after=1, blocked_every=0, latency_ms=0.0, seed=0):
+        self.flood_rate = flood_rate
+        self.retry_after = retry_after
+        self.blocked_every = blocked_every
+        self.latency = latency_ms / 1000
+        self.random = random.Random(seed)
+        self.reset()
+
+    def reset(self):
+        self.calls = Counter()
+        self.errors = Counter()
+        self.first_call = {}
+        self.last_call = {}
+        self.message_id = 0
+
+    def _message(self, chat_id, text):
+        self.message_id += 1
+        return {
+            "message_id": self.message_id,
+            "date": int(time.time()),
+            "chat": {"id": int(chat_id), "type": "private"},
+            "from": {"id": 1, "is_bot": True, "first_name": "FakeBot"},
+            "text": text or "",
+        }
+
+    def _error(self, method, code, description, **parameters):
+        self.errors[(method, code)] += 1
+        body = {"ok": False, "error_code": code, "description": description}
+        if parameters:
+            body["parameters"] = parameters
+        return JSONResponse(body, status_code=code)
+
+    async def handle(self, request: Request):
+        method = request.path_params["method"]
+        content_type = request.headers.get("content-type", "")
+        if content_type.startswith("application/json"):
+            params = await request.json()
+        elif content_type.startswith("application/x-www-form-urlencoded"):
+            params = dict(parse_qsl((await request.body()).decode()))
+        else:
+            params = {}  # multipart uploads: only the method matters here
+        now = time.monotonic()
+        self.calls[method] += 1
+        self.first_call.setdefault(method, now)
+        self.last_call[method] = now
+        if self.latency:
+            await asyncio.sleep(self.latency)
+
+        chat_id = params.get("chat_id", 0)
+        if method == "sendMessage":
+            if self.flood_rate and self.random.random() < self.flood_rate:
+                return self._error(method, 429, f"Too Many Requests: retry after {self.retry_after}",
+                                   retry_after=self.retry_after)
+            if self.blocked_every and int(chat_id) % self.blocked_every == 0:
+                return self._error(method, 403, "Forbidden: bot was blocked by the user")
+            result = self._message(chat_id, params.get("text"))
+        elif method == "editMessageText":
+            result = self._message(chat_id or 1, params.get("text"))
+        elif method == "sendDocument":
+            result = {**self._message(chat_id, ""), "document": {"file_id": "f", "file_unique_id": "u"}}
+        elif method == "getMe":
+            result = {"id": 1, "is_bot": True, "first_name": "FakeBot", "username": "fake_bot",
+                      "can_join_groups": True, "can_read_all_group_messages": False, "supports_inline_queries": False}
+        else:
+            result = True
+        return JSONResponse({"ok": True, "result": result})
+
+    async def stats(self, request: Request):
+        return JSONResponse({
+            "calls": dict(self.calls),
+            "errors": {f"{method}:{code}": count for (method, code), count in self.errors.items()},
+            "span_seconds": {method: round(self.last_call[method] - self.first_call[method], 3)
+                             for method in self.calls},
+        })
+
+    async def reset_stats(self, request: Request):
+        self.reset()
+        return JSONResponse({"ok": True})
+
+    def app(self):
+        return Starlette(routes=[
+            Route("/_stats", self.stats),
+            Route("/_reset", self.reset_stats, methods=["POST"]),
+            Route("/bot{token}/{method}", self.handle, methods=["GET", "POST"]),
+        ])
+
+
+def serve(port=8081, **options):
+    import uvicorn
+    uvicorn.run(FakeBotAPI(**options).app(), host="127.0.0.1", port=port, log_level="warning")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--port", type=int, default=8081)
+    parser.add_argument("--flood-rate", type=float, default=0.0, help="fraction of sendMessage calls answered with 429")
+    parser.add_argument("--retry-after", type=int, default=1)
+    parser.add_argument("--blocked-every", type=int, default=0, help="chat ids divisible by this have blocked the bot")
+    parser.add_argument("--latency-ms", type=float, default=0.0)
+    args = parser.parse_args()
+    serve(args.port, flood_rate=args.flood_rate, retry_after=args.retry_after,
+          blocked_every=args.blocked_every, latency_ms=args.latency_ms)
@@ -0,0 +1,59 @@
+# benchmarks/load_webhook.py
+"""Webhook throughput load test.
+
+Posts synthetic Telegram updates to a running bot's webhook with a fixed
+number of concurrent connections and reports accepted updates per second.
+The updates are plain text messages outside any conversation, so no handler
+replies and the number reflects the web server and dispatch path alone.
+
+Run it against the ASGI server and against an older Flask/gunicorn build
+(e.g. a checkout of the previous release) with the same token to compare:
+
+    uvicorn --factory main:create_app --port 8000 &
+    python benchmarks/load_webhook.py http://127.0.0.1:8000/$BOT_TOKEN [updates] [concurrency]
+"""
+import asyncio
+import sys
+import time
+
+import httpx
+
+
+def make_update(update_id):
+    user_id = 100000 + update_id % 5000
+    return {
+        "update_id": update_id,
+        "message": {
+            "message_id": update_id,
+            "date": int(time.time()),
+            "chat": {"id": user_id, "type": "private"},
+            "from": {"id": user_id, "is_bot": False, "first_name": "Load"},
+            "text": "hello",
+        },
+    }
+
+
+async def main():
+    url = sys.argv[1]
+    total = int(sys.argv[2]) if len(sys.argv) > 2 else 5000
+    concurrency = int(sys.argv[3]) if len(sys.argv) > 3 else 20
+    counter = iter(range(1, total + 1))
+    errors = 0
+
+    async def client_loop(client):
+        nonlocal errors
+        for update_id in counter:
+            response = await client.post(url, json=make_update(update_id))
+            if response.status_code != 200:
+                errors += 1
+
+    async with httpx.AsyncClient(limits=httpx.Limits(max_connections=concurrency), timeout=30) as client:
+        start = time.perf_counter()
+        await asyncio.gather(*(client_loop(client) for _ in range(concurrency)))
+        elapsed = time.perf_counter() - start
+    print(f"{total} updates in {elapsed:.2f}s with {concurrency} connections: "
+          f"{total / elapsed:.0f} updates/s, {errors} errors")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
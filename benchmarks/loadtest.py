@@ -0,0 +1,338 @@
+# benchmarks/loadtest.py
+"""Offline load test for the bot against a fake Telegram Bot API.
+
+Starts benchmarks/fake_bot_api.py in a subprocess, runs the bot in-process
+on a throwaway database and replays synthetic update streams through the
+same UpdateDispatcher the webhook uses:
+
+  register   N users each going through /start -> /register -> pick tournament -> name -> id
+  squads     N captains each registering a team of four in one flow
+             (/start -> /register -> pick tournament -> team name -> roster)
+  broadcast  an admin broadcast to a seeded user base
+  sendroom   /sendroom to a full 50-player Battle Royale lobby
+  roomtimer  room details scheduled a few seconds ahead for a 50-player lobby,
+             reporting how long after the send time each player got them
+
+For each scenario it prints throughput, p50/p99 handler latency, time spent
+in database calls and what the fake API received. With --database-url (or
+DATABASE_URL set) it runs on PostgreSQL instead of SQLite, in a new schema
+of that database that is dropped afterwards.
+
+    python benchmarks/loadtest.py [--scenario all] [--users 2000] [--broadcast-users 50000]
+                                  [--rate 1000] [--flood-rate 0.001] [--blocked-every 20]
+                                  [--database-url postgresql://localhost/bench]
+"""
+import argparse
+import asyncio
+import contextlib
+import itertools
+import json
+import logging
+import multiprocessing
+import os
+import statistics
+import sys
+import tempfile
+import time
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+sys.path.insert(0, os.path.dirname(__file__))
+
+TOKEN = "123456:LOADTEST"
+ADMIN_ID = 1
+_update_ids = itertools.count(1)
+
+
+# --- Synthetic updates ---
+def _sender(user_id):
+    return {"id": user_id, "is_bot": False, "first_name": f"Player{user_id}"}
+
+
+def message(user_id, text):
+    update_id = next(_update_ids)
+    msg = {"message_id": update_id, "date": int(time.time()), "chat": {"id": user_id, "type": "private"},
+           "from": _sender(user_id), "text": text}
+    if text.startswith("/"):
+        msg["entities"] = [{"type": "bot_command", "offset": 0, "length": len(text.split()[0])}]
+    return {"update_id": update_id, "message": msg}
+
+
+def callback(user_id, data):
+    update_id = next(_update_ids)
+    return {"update_id": update_id, "callback_query": {
+        "id": str(update_id), "chat_instance": "loadtest", "data": data, "from": _sender(user_id),
+        "message": {"message_id": 1, "date": int(time.time()), "chat": {"id": user_id, "type": "private"},
+                    "text": "menu"},
+    }}
+
+
+# --- Measurement ---
+class TimedExecutor(ThreadPoolExecutor):
+    """Executor for the async store that records how long each database call takes."""
+
+    def __init__(self, workers):
+        super().__init__(max_workers=workers, thread_name_prefix="db")
+        self.durations = []
+
+    def submit(self, fn, *args, **kwargs):
+        def timed():
+            start = time.perf_counter()
+            try:
+                return fn(*args, **kwargs)
+            finally:
+                self.durations.append(time.perf_counter() - start)
+        return super().submit(timed)
+
+
+def percentile(values, pct):
+    if len(values) < 2:
+        return values[0] if values else 0.0
+    return statistics.quantiles(values, n=100)[pct - 1]
+
+
+def fake_api_stats(url):
+    with urllib.request.urlopen(url + "/_stats") as response:
+        return json.load(response)
+
+
+def reset_fake_api(url):
+    urllib.request.urlopen(urllib.request.Request(url + "/_reset", method="POST")).close()
+
+
+_schemas = itertools.count(1)
+
+@contextlib.contextmanager
+def throwaway_schema(url):
+    """Creates an empty schema in the PostgreSQL database at `url`; yields a URL using it, drops it after."""
+    import psycopg
+    from psycopg.conninfo import make_conninfo
+    schema = f"bench_{os.getpid()}_{next(_schemas)}"
+    with psycopg.connect(url, autocommit=True) as conn:
+        conn.execute(f"CREATE SCHEMA {schema}")
+    try:
+        yield make_conninfo(url, options=f"-c search_path={schema}")
+    finally:
+        with psycopg.connect(url, autocommit=True) as conn:
+            conn.execute(f"DROP SCHEMA {schema} CASCADE")
+
+
+@contextlib.contextmanager
+def throwaway_database(tmp):
+    """Points the storage backend at an empty database for the run and yields it.
+
+    That is a SQLite file in `tmp`, or with DATABASE_URL set, a new schema in
+    that PostgreSQL database, dropped at the end. Call before the first query.
+    """
+    import storage
+    db = storage.db
+    if not storage.DATABASE_URL:
+        db.DB_FILE = os.path.join(tmp, "bench.db")
+        yield db
+        return
+    with throwaway_schema(storage.DATABASE_URL) as url:
+        db.DATABASE_URL = url
+        try:
+            yield db
+        finally:
+            db.close_db_connections()
+            db.DATABASE_URL = storage.DATABASE_URL
+
+
+class Harness:
+    def __init__(self, bot, executor, api_url):
+        self.bot = bot
+        self.executor = executor
+        self.api_url = api_url
+        self.latencies = []
+        original = bot.application.process_update
+
+        async def timed_process_update(update):
+            start = time.perf_counter()
+            try:
+                await original(update)
+            finally:
+                self.latencies.append(time.perf_counter() - start)
+        bot.application.process_update = timed_process_update
+
+    async def submit(self, updates):
+        for update in updates:
+            while self.bot.dispatcher.submit(update) == "full":
+                await asyncio.sleep(0.01)
+
+    async def drain(self):
+        await asyncio.gather(*(queue.join() for queue in self.bot.dispatcher.queues))
+
+    async def wait_for_broadcasts(self):
+        while await self.bot.store.get_unfinished_broadcast_jobs():
+            await asyncio.sleep(0.2)
+
+    async def scenario(self, name, body):
+        self.latencies.clear()
+        self.executor.durations.clear()
+        reset_fake_api(self.api_url)
+        # Header first: scenarios print their own results (e.g. "registered:") as they finish.
+        print(f"\n== {name} ==")
+        start = time.perf_counter()
+        updates = await body()
+        elapsed = time.perf_counter() - start
+        db_times = list(self.executor.durations)
+        latencies = list(self.latencies)
+        api = fake_api_stats(self.api_url)
+        if updates:
+            print(f"  updates: {updates} in {elapsed:.2f}s ({updates / elapsed:.0f} updates/s)")
+            print(f"  handler latency: p50 {percentile(latencies, 50) * 1e3:.2f} ms, "
+                  f"p99 {percentile(latencies, 99) * 1e3:.2f} ms")
+        print(f"  database: {len(db_times)} calls, {sum(db_times) * 1e3:.0f} ms total, "
+              f"{statistics.mean(db_times) * 1e3 if db_times else 0:.3f} ms avg")
+        sends = api["calls"].get("sendMessage", 0)
+        span = api["span_seconds"].get("sendMessage", 0) or elapsed
+        print(f"  bot api calls: {api['calls']}, errors: {api['errors']}")
+        print(f"  sendMessage: {sends} in {span:.2f}s ({sends / span:.0f}/s)")
+
+
+async def run(args, bot, executor, api_url, db):
+    await bot.main_setup()
+    await bot.start_bot()
+    harness = Harness(bot, executor, api_url)
+    if args.rate:
+        from broadcast import TokenBucket
+        bot.broadcast_engine.bucket = TokenBucket(args.rate)
+
+    async def register():
+        await bot.store.add_tournament("BR", "tomorrow 9:00 PM", 0, args.users, time.time() + 86400)
+        tournament_id = (await bot.store.get_open_tournaments())[-1]['id']
+        # Users who blocked the bot wouldn't be registering.
+        users = list(itertools.islice(
+            (u for u in itertools.count(10_000) if not args.blocked_every or u % args.blocked_every),
+            args.users))
+        # Interleave users step by step, as a real rush would arrive.
+        steps = [
+            lambda u: message(u, "/start"),
+            lambda u: message(u, "/register"),
+            lambda u: callback(u, f"register_{tournament_id}"),
+            lambda u: message(u, f"Player{u}"),
+            lambda u: message(u, str(u * 7)),
+        ]
+        for step in steps:
+            await harness.submit(step(u) for u in users)
+        await harness.drain()
+        tournament = await bot.store.get_tournament_details(tournament_id)
+        print(f"  registered: {tournament['registered_count']}/{args.users}")
+        return len(steps) * args.users
+
+    async def squads():
+        await bot.store.add_tournament("BR", "tomorrow 9:30 PM", 0, args.users * 4, time.time() + 88200, team_size=4)
+        tournament_id = (await bot.store.get_open_tournaments())[-1]['id']
+        captains = list(itertools.islice(
+            (u for u in itertools.count(400_000) if not args.blocked_every or u % args.blocked_every), args.users))
+        steps = [
+            lambda u: message(u, "/start"),
+            lambda u: message(u, "/register"),
+            lambda u: callback(u, f"register_{tournament_id}"),
+            lambda u: message(u, f"Squad{u}"),
+            lambda u: message(u, "\n".join(f"Player{u}x{i} {u * 10 + i}" for i in range(4))),
+        ]
+        for step in steps:
+            await harness.submit(step(u) for u in captains)
+        await harness.drain()
+        teams = await bot.store.get_registrations_for_tournament(tournament_id)
+        tournament = await bot.store.get_tournament_details(tournament_id)
+        print(f"  registered: {len(teams)}/{args.users} teams, {tournament['registered_count']} players")
+        return len(steps) * args.users
+
+    async def broadcast():
+        db.add_or_update_users([(u, None, None, time.time()) for u in range(100_000, 100_000 + args.broadcast_users)])
+        updates = [message(ADMIN_ID, "📢 Broadcast"), callback(ADMIN_ID, "audience_all"),
+                   message(ADMIN_ID, "Load test broadcast")]
+        await harness.submit(updates)
+        await harness.drain()
+        await harness.wait_for_broadcasts()
+        return len(updates)
+
+    async def sendroom():
+        await bot.store.add_tournament("BR", "tomorrow 10:00 PM", 0, 50, time.time() + 90000)
+        tournament_id = (await bot.store.get_open_tournaments())[-1]['id']
+        for u in range(200_001, 200_051):
+            await bot.store.add_or_update_user(u, f"Player{u}", str(u))
+            await bot.store.register_user_for_tournament(tournament_id, u)
+        updates = [message(ADMIN_ID, "/sendroom"), message(ADMIN_ID, str(tournament_id)),
+                   message(ADMIN_ID, "1234567"), message(ADMIN_ID, "pass"),
+                   callback(ADMIN_ID, "send_room_confirm_yes")]
+        await harness.submit(updates)
+        await harness.drain()
+        await harness.wait_for_broadcasts()
+        return len(updates)
+
+    async def roomtimer():
+        await bot.store.add_tournament("BR", "tomorrow 11:00 PM", 0, 50, time.time() + 93600)
+        tournament_id = (await bot.store.get_open_tournaments())[-1]['id']
+        for u in range(300_001, 300_051):
+            await bot.store.add_or_update_user(u, f"Player{u}", str(u))
+            await bot.store.register_user_for_tournament(tournament_id, u)
+        tournament = await bot.store.get_tournament_details(tournament_id)
+        send_at = time.time() + args.room_delay
+        job_id = await bot.store.create_broadcast_job(
+            bot.room_details_message(tournament, "1234567", "pass"), parse_mode="Markdown",
+            recipient_ids=range(300_001, 300_051), send_at=send_at, tournament_id=tournament_id)
+        bot.broadcast_worker.wake()
+        await harness.wait_for_broadcasts()
+        latency = await bot.store.get_delivery_latency(job_id)
+        print(f"  room details: {latency['count']} delivered, median {latency['median'] * 1e3:.0f} ms "
+              f"and slowest {latency['max'] * 1e3:.0f} ms after the send time")
+        return 0
+
+    scenarios = {"register": register, "squads": squads, "broadcast": broadcast, "sendroom": sendroom, "roomtimer": roomtimer}
+    try:
+        for name in (scenarios if args.scenario == "all" else [args.scenario]):
+            await harness.scenario(name, scenarios[name])
+    finally:
+        await bot.stop_bot()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Offline load test against a fake Bot API")
+    parser.add_argument("--scenario", choices=["all", "register", "squads", "broadcast", "sendroom", "roomtimer"], default="all")
+    parser.add_argument("--users", type=int, default=2000, help="concurrent /register flows (teams, in the squads scenario)")
+    parser.add_argument("--broadcast-users", type=int, default=50000)
+    parser.add_argument("--rate", type=float, default=1000,
+                        help="broadcast messages/s (Telegram allows ~30; 0 keeps the production limit)")
+    parser.add_argument("--flood-rate", type=float, default=0.0)
+    parser.add_argument("--blocked-every", type=int, default=20)
+    parser.add_argument("--room-delay", type=float, default=3.0, help="seconds ahead the roomtimer send is scheduled")
+    parser.add_argument("--latency-ms", type=float, default=2.0)
+    parser.add_argument("--port", type=int, default=8081)
+    parser.add_argument("--database-url", default=os.environ.get("DATABASE_URL"),
+                        help="run on this PostgreSQL database (default: a SQLite file)")
+    args = parser.parse_args()
+    if args.database_url:
+        os.environ["DATABASE_URL"] = args.database_url
+
+    import fake_bot_api
+    api_url = f"http://127.0.0.1:{args.port}"
+    api = multiprocessing.get_context("spawn").Process(target=fake_bot_api.serve, kwargs=dict(
+        port=args.port, flood_rate=args.flood_rate, blocked_every=args.blocked_every, latency_ms=args.latency_ms),
+        daemon=True)
+    api.start()
+    for _ in range(50):
+        try:
+            fake_api_stats(api_url)
+            break
+        except OSError:
+            time.sleep(0.1)
+
+    with tempfile.TemporaryDirectory() as tmp:
+        os.environ.update(BOT_TOKEN=TOKEN, ADMIN_ID=str(ADMIN_ID), TELEGRAM_API_BASE_URL=f"{api_url}/bot")
+        with throwaway_database(tmp) as db:
+            import main as bot
+            logging.getLogger().setLevel(logging.WARNING)
+            print(f"database: {db.__name__}, {db.POOL_SIZE} store thread(s)")
+            executor = TimedExecutor(db.POOL_SIZE)
+            bot.store._executor = executor
+            asyncio.run(run(args, bot, executor, api_url, db))
+    api.terminate()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,61 @@
+# benchmarks/stress_registrations.py
+"""Concurrency stress test for register_user_for_tournament.
+
+Fires thousands of registrations from many threads (each with its own
+connection) at a handful of small tournaments, including repeated attempts by
+the same player, then checks that no tournament is overbooked, nobody is
+registered twice and registered_count matches the registrations table.
+With DATABASE_URL set it runs on PostgreSQL (in a throwaway schema, see
+loadtest.throwaway_database), where registrations really run in parallel.
+
+    python benchmarks/stress_registrations.py [registrations] [threads]
+"""
+import os
+import random
+import sys
+import tempfile
+import time
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+from loadtest import throwaway_database  # noqa: E402
+
+TOURNAMENTS = [("BR", 50), ("CS", 8), ("BR", 50), ("CS", 8)]
+
+
+def main():
+    attempts = int(sys.argv[1]) if len(sys.argv) > 1 else 5000
+    threads = int(sys.argv[2]) if len(sys.argv) > 2 else 64
+    with tempfile.TemporaryDirectory() as tmp, throwaway_database(tmp) as db:
+        db.setup_database()
+        for mode, max_players in TOURNAMENTS:
+            db.add_tournament(mode, "July 10, 9:00 PM", 0, max_players)
+        tournament_ids = [t['id'] for t in db.get_open_tournaments()]
+        players = range(1, attempts // 4 + 2)
+        for telegram_id in players:
+            db.add_or_update_user(telegram_id, f"player{telegram_id}", str(telegram_id))
+
+        rng = random.Random(42)
+        jobs = [(rng.choice(tournament_ids), rng.choice(players)) for _ in range(attempts)]
+        start = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=threads) as pool:
+            results = Counter(pool.map(lambda job: db.register_user_for_tournament(*job), jobs))
+        elapsed = time.perf_counter() - start
+        print(f"{db.__name__}: {attempts} registrations from {threads} threads in {elapsed:.2f}s: {dict(results)}")
+
+        ok = True
+        for tournament_id in tournament_ids:
+            t = db.get_tournament_details(tournament_id)
+            registered = [row['telegram_id'] for row in db.get_registrations_for_tournament(tournament_id)]
+            print(f"tournament {tournament_id}: {len(registered)}/{t['max_players']} rows, "
+                  f"registered_count={t['registered_count']}, status={t['status']}")
+            ok &= len(registered) <= t['max_players'] and len(registered) == len(set(registered)) == t['registered_count']
+        assert results["SUCCESS"] == sum(db.get_tournament_details(t)['registered_count'] for t in tournament_ids)
+        db.close_db_connections()
+    print("OK" if ok else "OVERBOOKED")
+    sys.exit(0 if ok else 1)
+
+
+if __name__ == "__main__":
+    main()
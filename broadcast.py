@@ -0,0 +1,282 @@
+# broadcast.py
+import asyncio
+import logging
+import time
+
+from telegram.error import BadRequest, Forbidden, NetworkError, RetryAfter, TelegramError
+
+import metrics
+
+logger = logging.getLogger(__name__)
+
+# Telegram allows roughly 30 messages per second across all chats and about
+# one message per second to the same chat.
+GLOBAL_RATE = 30
+PER_CHAT_INTERVAL = 1.0
+MAX_CONCURRENCY = 20
+# Only network errors and timeouts are retried, after RETRY_BACKOFF seconds
+# times the attempt number; anything else (bad chat id, malformed text) would
+# fail the same way again.
+MAX_ATTEMPTS = 3
+RETRY_BACKOFF = 1.0
+# Flood control (429) says when to retry and isn't the recipient's fault, so
+# it has its own, larger cap instead of using up MAX_ATTEMPTS.
+MAX_FLOOD_WAITS = 10
+# Persistent broadcast jobs are drained in batches; results are written back
+# after each batch, so a restart re-sends at most one batch worth of messages.
+BATCH_SIZE = 200
+POLL_INTERVAL = 30
+# A scheduled job's first batch is read this many seconds early, so sending
+# starts right at its send time.
+PREFETCH_LEAD = 5
+
+
+def _seconds(delay):
+    """RetryAfter.retry_after is an int or a timedelta depending on PTB settings."""
+    return delay.total_seconds() if hasattr(delay, "total_seconds") else float(delay)
+
+
+class TokenBucket:
+    """Async token bucket: allows `rate` acquisitions per second on average."""
+
+    def __init__(self, rate, capacity=None):
+        self.rate = rate
+        self.capacity = capacity or rate
+        self._tokens = self.capacity
+        self._updated = time.monotonic()
+        self._lock = None  # made on first acquire(), in the running loop rather than at import
+
+    def pause(self, seconds):
+        """Drains the bucket so nothing is sent for `seconds` (used on flood control)."""
+        self._tokens = min(self._tokens, -seconds * self.rate)
+        self._updated = time.monotonic()
+
+    async def acquire(self):
+        if self._lock is None:
+            self._lock = asyncio.Lock()
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+                self._updated = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                await asyncio.sleep((1 - self._tokens) / self.rate)
+
+
+class BroadcastEngine:
+    """Sends messages to many chats with bounded concurrency and rate limiting.
+
+    One engine should be shared by everything that fans out messages so the
+    global rate limit holds across concurrent broadcasts.
+    """
+
+    def __init__(self, rate=GLOBAL_RATE, concurrency=MAX_CONCURRENCY, per_chat_interval=PER_CHAT_INTERVAL):
+        self.bucket = TokenBucket(rate)
+        self.concurrency = concurrency
+        self.per_chat_interval = per_chat_interval
+        self._chat_last_sent = {}
+
+    async def _wait_for_chat(self, chat_id):
+        last = self._chat_last_sent.get(chat_id)
+        if last is not None:
+            delay = last + self.per_chat_interval - time.monotonic()
+            if delay > 0:
+                await asyncio.sleep(delay)
+        self._chat_last_sent[chat_id] = time.monotonic()
+        if len(self._chat_last_sent) > 10000:
+            cutoff = time.monotonic() - self.per_chat_interval
+            self._chat_last_sent = {c: t for c, t in self._chat_last_sent.items() if t > cutoff}
+
+    async def send(self, bot, chat_id, text, **kwargs):
+        """Sends one message, returning 'sent', 'blocked' or 'failed'."""
+        attempt = flood_waits = 0
+        while True:
+            await self._wait_for_chat(chat_id)
+            await self.bucket.acquire()
+            try:
+                await bot.send_message(chat_id=chat_id, text=text, **kwargs)
+                return "sent"
+            except RetryAfter as e:
+                flood_waits += 1
+                if flood_waits > MAX_FLOOD_WAITS:
+                    logger.error(f"Could not send message to {chat_id}: still flood controlled after {MAX_FLOOD_WAITS} waits")
+                    return "failed"
+                delay = _seconds(e.retry_after)
+                logger.warning(f"Flood control hit, pausing sends for {delay}s")
+                self.bucket.pause(delay)
+                await asyncio.sleep(delay)
+            except Forbidden:
+                return "blocked"
+            except BadRequest as e:
+                # BadRequest subclasses NetworkError in PTB, so it is caught first.
+                logger.error(f"Could not send message to {chat_id}: {e}")
+                return "failed"
+            except NetworkError as e:
+                attempt += 1
+                logger.warning(f"Could not send message to {chat_id} (attempt {attempt}): {e}")
+                if attempt == MAX_ATTEMPTS:
+                    logger.error(f"Giving up on {chat_id} after {MAX_ATTEMPTS} attempts")
+                    return "failed"
+                await asyncio.sleep(RETRY_BACKOFF * attempt)
+            except TelegramError as e:
+                logger.error(f"Could not send message to {chat_id}: {e}")
+                return "failed"
+
+    async def run(self, bot, chat_ids, text, on_progress=None, progress_interval=3.0, on_result=None, **kwargs):
+        """Sends `text` to every chat in `chat_ids`.
+
+        `on_progress(counts, total)` is awaited at most every `progress_interval`
+        seconds while sending, and `on_result(chat_id, status)` is called after
+        every message. Returns a dict of counts per status.
+        """
+        chat_ids = list(chat_ids)
+        counts = {"sent": 0, "blocked": 0, "failed": 0}
+        queue = asyncio.Queue()
+        for chat_id in chat_ids:
+            queue.put_nowait(chat_id)
+        last_progress = time.monotonic()
+
+        async def worker():
+            nonlocal last_progress
+            while True:
+                try:
+                    chat_id = queue.get_nowait()
+                except asyncio.QueueEmpty:
+                    return
+                status = await self.send(bot, chat_id, text, **kwargs)
+                counts[status] += 1
+                metrics.inc("broadcast_messages_total", status=status)
+                if on_result:
+                    on_result(chat_id, status)
+                if on_progress and time.monotonic() - last_progress >= progress_interval:
+                    last_progress = time.monotonic()
+                    try:
+                        await on_progress(dict(counts), len(chat_ids))
+                    except TelegramError as e:
+                        logger.warning(f"Could not report broadcast progress: {e}")
+
+        await asyncio.gather(*(worker() for _ in range(min(self.concurrency, len(chat_ids)))))
+        return counts
+
+
+class BroadcastWorker:
+    """Drains queued broadcast jobs from the database.
+
+    Pending deliveries are read in batches, sent through the engine and their
+    statuses written back, so the worker picks up where it left off after a
+    restart. Call `wake()` (from any thread) after queueing a new job.
+
+    Each job is drained in its own task once it is due, so a scheduled job
+    (room details) isn't held up behind a large broadcast; the shared engine
+    keeps the global rate limit. A job queued by another process is noticed
+    within `poll_interval`.
+    """
+
+    def __init__(self, bot, store, engine, batch_size=BATCH_SIZE, poll_interval=POLL_INTERVAL):
+        self.bot = bot
+        self.store = store
+        self.engine = engine
+        self.batch_size = batch_size
+        self.poll_interval = poll_interval
+        self._loop = None
+        self._wakeup = None
+        self._draining = {}  # job id -> task
+        self._pending = {}   # job id -> deliveries still pending
+
+    def wake(self):
+        if self._loop is not None:
+            self._loop.call_soon_threadsafe(self._wakeup.set)
+
+    async def run_forever(self):
+        self._loop = asyncio.get_running_loop()
+        self._wakeup = asyncio.Event()
+        try:
+            while True:
+                self._wakeup.clear()
+                timeout = self.poll_interval
+                try:
+                    for job in await self.store.get_unfinished_broadcast_jobs():
+                        if job['id'] in self._draining:
+                            continue
+                        wait = (job['send_at'] or 0) - time.time() - PREFETCH_LEAD
+                        if wait > 0:
+                            timeout = min(timeout, wait)
+                            continue
+                        self._draining[job['id']] = asyncio.create_task(self._drain_task(job))
+                except Exception:
+                    logger.exception("Broadcast worker failed, retrying on next poll")
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), timeout)
+                except asyncio.TimeoutError:
+                    pass
+        finally:
+            for task in self._draining.values():
+                task.cancel()
+
+    async def _drain_task(self, job):
+        try:
+            await self.drain(job)
+        except Exception:
+            logger.exception(f"Broadcast {job['id']} failed, retrying on next poll")
+        finally:
+            del self._draining[job['id']]
+            self._pending.pop(job['id'], None)
+
+    async def _report(self, job, text):
+        if job['admin_chat_id'] and job['status_message_id']:
+            try:
+                await self.bot.edit_message_text(text, chat_id=job['admin_chat_id'], message_id=job['status_message_id'])
+            except TelegramError as e:
+                logger.warning(f"Could not report progress of broadcast {job['id']}: {e}")
+
+    async def drain(self, job):
+        job_id = job['id']
+        kind = "room" if job['tournament_id'] else "broadcast"
+        first_batch = True
+        while True:
+            batch = await self.store.get_pending_deliveries(job_id, self.batch_size)
+            if not batch:
+                break
+            if first_batch and job['send_at']:
+                # The first recipients are loaded; now wait for the exact send time.
+                await asyncio.sleep(max(job['send_at'] - time.time(), 0))
+            first_batch = False
+            # The admin may have cancelled or replaced the job (new room
+            # details) while we waited or sent the previous batch.
+            current = await self.store.get_broadcast_job(job_id)
+            if current is None or current['status'] != 'PENDING':
+                logger.info(f"Broadcast {job_id} was cancelled, not sending the rest")
+                self._pending.pop(job_id, None)
+                metrics.set_gauge("broadcast_pending_deliveries", sum(self._pending.values()))
+                return
+            results = []
+
+            def on_result(chat_id, status):
+                delivered_at = time.time()
+                results.append((chat_id, status.upper(), delivered_at))
+                if status == "sent" and job['send_at']:
+                    metrics.observe("broadcast_delivery_latency_seconds", delivered_at - job['send_at'], kind=kind)
+
+            await self.engine.run(self.bot, batch, job['text'], parse_mode=job['parse_mode'], on_result=on_result)
+            await self.store.record_deliveries(job_id, results)
+            counts = await self.store.get_broadcast_job_counts(job_id)
+            self._pending[job_id] = counts['PENDING']
+            metrics.set_gauge("broadcast_pending_deliveries", sum(self._pending.values()))
+            total = sum(counts.values())
+            await self._report(job, f"📢 Sending... {total - counts['PENDING']}/{total} processed.")
+        await self.store.finish_broadcast_job(job_id)
+        self._pending.pop(job_id, None)
+        metrics.set_gauge("broadcast_pending_deliveries", sum(self._pending.values()))
+        counts = await self.store.get_broadcast_job_counts(job_id)
+        latency = await self.store.get_delivery_latency(job_id)
+        latency_text = (f"\nDelivery time after the send time: median {latency['median']:.2f}s, "
+                        f"slowest {latency['max']:.2f}s." if latency['count'] else "")
+        await self._report(job, (
+            f"✅ Done!\n\nDelivered to {counts['SENT']}/{sum(counts.values())} users.\n"
+            f"Blocked: {counts['BLOCKED']}, failed: {counts['FAILED']}.{latency_text}"
+        ))
+
+
+engine = BroadcastEngine()
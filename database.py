@@ -1,18 +1,106 @@
 # database.py
 import sqlite3
+import threading
+import time
+
+from cache import TTLCache
 
 DB_FILE = "tournament.db"
+# Threads the async store runs queries on. SQLite takes one writer at a
+# time and its connections are per thread, so one.
+POOL_SIZE = 1
 
-def get_db_connection():
-    """Establishes a connection to the database."""
-    conn = sqlite3.connect(DB_FILE)
+# Connections are long-lived and kept one per thread (sqlite3 connections
+# must not be shared across threads). The pragmas below are applied once
+# when a connection is opened instead of paying for a connect per query.
+PRAGMAS = (
+    "PRAGMA journal_mode = WAL",
+    "PRAGMA synchronous = NORMAL",
+    "PRAGMA cache_size = -16000",      # ~16 MB page cache
+    "PRAGMA mmap_size = 134217728",    # 128 MB memory-mapped I/O
+    "PRAGMA temp_store = MEMORY",
+    "PRAGMA busy_timeout = 5000",
+)
+STATEMENT_CACHE_SIZE = 256
+
+# Hot read paths are cached in-process and invalidated by the functions that
+# change them; the TTL bounds staleness from writes made by other processes.
+admin_cache = TTLCache("admin", maxsize=4096, ttl=300)
+tournament_cache = TTLCache("tournament", maxsize=1024, ttl=30)
+open_tournaments_cache = TTLCache("open_tournaments", maxsize=4, ttl=30)  # the full list and first pages
+CACHES = (admin_cache, tournament_cache, open_tournaments_cache)
+
+_local = threading.local()
+_all_connections = []
+_all_connections_lock = threading.Lock()
+connect_count = 0
+
+def _connect():
+    """Opens a new tuned connection to the database."""
+    global connect_count
+    conn = sqlite3.connect(DB_FILE, timeout=5, cached_statements=STATEMENT_CACHE_SIZE,
+                           check_same_thread=False)
     conn.row_factory = sqlite3.Row
+    for pragma in PRAGMAS:
+        conn.execute(pragma)
+    with _all_connections_lock:
+        _all_connections.append(conn)
+        connect_count += 1
     return conn
 
-def setup_database():
-    """Creates the necessary tables if they don't exist."""
-    conn = get_db_connection()
-    c = conn.cursor()
+def get_db_connection():
+    """Returns this thread's long-lived connection, opening it on first use.
+
+    The connection outlives each call, so every write runs in `with conn:`
+    or BEGIN IMMEDIATE ... rollback: a failed write must not leave it in an
+    open transaction, where the next BEGIN IMMEDIATE on this thread fails.
+    """
+    conn = getattr(_local, "conn", None)
+    if conn is None:
+        conn = _local.conn = _connect()
+    return conn
+
+def cache_stats():
+    """Hit/miss counters for every read cache, keyed by cache name."""
+    return {cache.name: cache.stats() for cache in CACHES}
+
+def _invalidate_tournament(tournament_id):
+    tournament_cache.invalidate((tournament_id,))
+    open_tournaments_cache.clear()
+
+def close_db_connections():
+    """Closes every connection opened by this process (call on shutdown)."""
+    with _all_connections_lock:
+        for conn in _all_connections:
+            conn.close()
+        _all_connections.clear()
+    _local.__dict__.pop("conn", None)
+
+# --- Background Lock ---
+# See pg_database.py: with PostgreSQL several instances can share a database,
+# and only the one holding this lock runs the broadcast worker and scheduler.
+# A SQLite file belongs to a single host, where sharding already runs them in
+# one process, so here the lock is always ours.
+
+def acquire_background_lock():
+    return True
+
+def holds_background_lock():
+    return True
+
+def _add_column_if_missing(c, table, column, definition):
+    columns = [row['name'] for row in c.execute(f"PRAGMA table_info({table})")]
+    if column in columns:
+        return False
+    c.execute(f"ALTER TABLE {table} ADD COLUMN {column} {definition}")
+    return True
+
+# --- Schema Migrations ---
+# Each migration brings the schema from version N-1 to N and runs in its own
+# transaction. They are written to be safe on databases created before
+# versioning existed (IF NOT EXISTS, column checks), since those start at 0.
+
+def _migration_1_base_tables(c):
     # Users table: stores user info and admin status
     c.execute('''
         CREATE TABLE IF NOT EXISTS users (
@@ -45,96 +133,504 @@ def setup_database():
             FOREIGN KEY (telegram_id) REFERENCES users (telegram_id)
         )
     ''')
-    conn.commit()
-    conn.close()
+
+def _migration_2_broadcast_jobs(c):
+    # Broadcast jobs and their per-recipient delivery status, so an interrupted
+    # broadcast can resume without re-sending to anyone already reached.
+    c.execute('''
+        CREATE TABLE IF NOT EXISTS broadcast_jobs (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            text TEXT NOT NULL,
+            parse_mode TEXT,
+            status TEXT DEFAULT 'PENDING', -- 'PENDING', 'DONE'
+            admin_chat_id INTEGER,
+            status_message_id INTEGER,
+            created_at TEXT DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+    c.execute('''
+        CREATE TABLE IF NOT EXISTS broadcast_deliveries (
+            job_id INTEGER NOT NULL,
+            telegram_id INTEGER NOT NULL,
+            status TEXT DEFAULT 'PENDING', -- 'PENDING', 'SENT', 'BLOCKED', 'FAILED'
+            PRIMARY KEY (job_id, telegram_id),
+            FOREIGN KEY (job_id) REFERENCES broadcast_jobs (id)
+        )
+    ''')
+    c.execute("CREATE INDEX IF NOT EXISTS idx_broadcast_deliveries_status ON broadcast_deliveries (job_id, status)")
+    _add_column_if_missing(c, "users", "is_blocked", "INTEGER DEFAULT 0")
+
+def _migration_3_atomic_registrations(c):
+    # One registration per player per tournament, enforced by the database
+    # (older files may hold duplicates from the former check-then-insert race).
+    c.execute('''
+        DELETE FROM registrations WHERE id NOT IN (
+            SELECT MIN(id) FROM registrations GROUP BY tournament_id, telegram_id
+        )
+    ''')
+    c.execute("CREATE UNIQUE INDEX IF NOT EXISTS idx_registrations_unique ON registrations (tournament_id, telegram_id)")
+    # Slots taken, maintained in the same transaction as each registration.
+    if _add_column_if_missing(c, "tournaments", "registered_count", "INTEGER NOT NULL DEFAULT 0"):
+        c.execute('''
+            UPDATE tournaments SET registered_count =
+                (SELECT COUNT(*) FROM registrations r WHERE r.tournament_id = tournaments.id)
+        ''')
+
+def _migration_4_lookup_indexes(c):
+    # Lookups by tournament use the (tournament_id, telegram_id) unique index.
+    c.execute("CREATE INDEX IF NOT EXISTS idx_registrations_telegram_id ON registrations (telegram_id)")
+    c.execute("CREATE INDEX IF NOT EXISTS idx_tournaments_status ON tournaments (status)")
+
+def _migration_5_persistence(c):
+    # Bot framework state (user_data, chat_data, bot_data) as JSON blobs, and
+    # the current step of every persistent conversation.
+    c.execute('''
+        CREATE TABLE IF NOT EXISTS persistence_data (
+            kind TEXT NOT NULL,          -- 'user', 'chat' or 'bot'
+            key TEXT NOT NULL,
+            data TEXT NOT NULL,
+            updated_at REAL NOT NULL,
+            PRIMARY KEY (kind, key)
+        )
+    ''')
+    c.execute('''
+        CREATE TABLE IF NOT EXISTS conversation_states (
+            name TEXT NOT NULL,
+            key TEXT NOT NULL,           -- JSON list, e.g. [chat_id, user_id]
+            state TEXT NOT NULL,         -- JSON-encoded state
+            PRIMARY KEY (name, key)
+        )
+    ''')
+
+def _migration_6_keyset_pagination(c):
+    # Pages of a tournament's registrations are read in id order.
+    c.execute("CREATE INDEX IF NOT EXISTS idx_registrations_tournament_page ON registrations (tournament_id, id)")
+
+def _migration_7_tournament_schedule(c):
+    # Start time as a UTC timestamp parsed from date_time, and the next
+    # lifecycle event due (see scheduler.py). The partial index makes "when is
+    # the next event" a single index lookup.
+    _add_column_if_missing(c, "tournaments", "starts_at", "REAL")
+    _add_column_if_missing(c, "tournaments", "next_event", "TEXT")  # 'REMIND', 'CLOSE', 'ARCHIVE' or NULL
+    _add_column_if_missing(c, "tournaments", "next_event_at", "REAL")
+    c.execute("CREATE INDEX IF NOT EXISTS idx_tournaments_next_event ON tournaments (next_event_at) WHERE next_event IS NOT NULL")
+    c.execute("CREATE INDEX IF NOT EXISTS idx_tournaments_starts_at ON tournaments (starts_at)")
+
+def _migration_8_scheduled_broadcasts(c):
+    # Broadcast jobs can wait for a send time (room details are scheduled
+    # ahead), belong to a tournament so late registrants are added to them,
+    # and record when each message was delivered.
+    _add_column_if_missing(c, "broadcast_jobs", "send_at", "REAL")
+    _add_column_if_missing(c, "broadcast_jobs", "tournament_id", "INTEGER REFERENCES tournaments (id)")
+    _add_column_if_missing(c, "broadcast_deliveries", "delivered_at", "REAL")
+    c.execute("CREATE INDEX IF NOT EXISTS idx_broadcast_jobs_pending_tournament ON broadcast_jobs (tournament_id) WHERE status = 'PENDING'")
+
+def _migration_9_user_activity(c):
+    # When each user last talked to the bot, and the mode of the last
+    # tournament they joined, for targeting broadcasts.
+    _add_column_if_missing(c, "users", "last_seen", "REAL")
+    if _add_column_if_missing(c, "users", "preferred_mode", "TEXT"):
+        c.execute('''
+            UPDATE users SET preferred_mode = (
+                SELECT t.mode FROM registrations r JOIN tournaments t ON t.id = r.tournament_id
+                WHERE r.telegram_id = users.telegram_id ORDER BY r.id DESC LIMIT 1)
+        ''')
+    c.execute("CREATE INDEX IF NOT EXISTS idx_users_last_seen ON users (last_seen) WHERE is_blocked = 0")
+    c.execute("CREATE INDEX IF NOT EXISTS idx_users_preferred_mode ON users (preferred_mode) WHERE is_blocked = 0")
+
+def _migration_10_payments(c):
+    # Fee ledger: one row per registration in a paid tournament, created
+    # UNPAID with the fee at registration time. The (tournament_id, status,
+    # amount) index answers the per-tournament summary on its own.
+    c.execute('''
+        CREATE TABLE IF NOT EXISTS payments (
+            registration_id INTEGER PRIMARY KEY,
+            tournament_id INTEGER NOT NULL,
+            telegram_id INTEGER NOT NULL,
+            amount INTEGER NOT NULL,
+            status TEXT NOT NULL DEFAULT 'UNPAID', -- 'UNPAID', 'PAID'
+            paid_at REAL,
+            marked_by INTEGER,               -- the admin who last changed the status
+            FOREIGN KEY (registration_id) REFERENCES registrations (id),
+            FOREIGN KEY (tournament_id) REFERENCES tournaments (id)
+        )
+    ''')
+    c.execute("CREATE INDEX IF NOT EXISTS idx_payments_tournament_status ON payments (tournament_id, status, amount)")
+    c.execute('''
+        INSERT OR IGNORE INTO payments (registration_id, tournament_id, telegram_id, amount)
+        SELECT r.id, r.tournament_id, r.telegram_id, t.fee
+        FROM registrations r JOIN tournaments t ON t.id = r.tournament_id
+        WHERE t.fee > 0
+    ''')
+
+def _migration_11_teams(c):
+    # Team tournaments: a team's captain registers everyone at once. The
+    # captain's registration holds `slots` player slots (the tournament's
+    # team_size), so registered_count and max_players stay in players.
+    _add_column_if_missing(c, "tournaments", "team_size", "INTEGER NOT NULL DEFAULT 1")
+    _add_column_if_missing(c, "registrations", "team_id", "INTEGER REFERENCES teams (id)")
+    _add_column_if_missing(c, "registrations", "slots", "INTEGER NOT NULL DEFAULT 1")
+    c.execute('''
+        CREATE TABLE IF NOT EXISTS teams (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            tournament_id INTEGER NOT NULL,
+            name TEXT NOT NULL COLLATE NOCASE,
+            captain_id INTEGER NOT NULL,
+            UNIQUE (tournament_id, name),
+            FOREIGN KEY (tournament_id) REFERENCES tournaments (id),
+            FOREIGN KEY (captain_id) REFERENCES users (telegram_id)
+        )
+    ''')
+    c.execute('''
+        CREATE TABLE IF NOT EXISTS team_members (
+            team_id INTEGER NOT NULL,
+            tournament_id INTEGER NOT NULL,
+            ff_username TEXT NOT NULL,
+            ff_userid TEXT NOT NULL,
+            UNIQUE (tournament_id, ff_userid),  -- a player is in one team per tournament
+            FOREIGN KEY (team_id) REFERENCES teams (id)
+        )
+    ''')
+    c.execute("CREATE INDEX IF NOT EXISTS idx_team_members_team ON team_members (team_id)")
+
+MIGRATIONS = [
+    _migration_1_base_tables,
+    _migration_2_broadcast_jobs,
+    _migration_3_atomic_registrations,
+    _migration_4_lookup_indexes,
+    _migration_5_persistence,
+    _migration_6_keyset_pagination,
+    _migration_7_tournament_schedule,
+    _migration_8_scheduled_broadcasts,
+    _migration_9_user_activity,
+    _migration_10_payments,
+    _migration_11_teams,
+]
+SCHEMA_VERSION = len(MIGRATIONS)
+
+def get_schema_version(conn):
+    try:
+        row = conn.execute("SELECT version FROM schema_version").fetchone()
+    except sqlite3.OperationalError:  # a new database
+        conn.execute("CREATE TABLE schema_version (version INTEGER NOT NULL)")
+        conn.commit()
+        row = None
+    return row['version'] if row else 0
+
+def setup_database():
+    """Creates the tables and applies any schema migrations not yet run.
+
+    An up-to-date database costs a single SELECT, so this is cheap to call on
+    every start.
+    """
+    conn = get_db_connection()
+    version = get_schema_version(conn)
+    if version == len(MIGRATIONS):
+        return
+    for number, migration in enumerate(MIGRATIONS[version:], start=version + 1):
+        c = conn.cursor()
+        c.execute("BEGIN IMMEDIATE")
+        try:
+            migration(c)
+            c.execute("DELETE FROM schema_version")
+            c.execute("INSERT INTO schema_version (version) VALUES (?)", (number,))
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+        print(f"Applied database migration {number}: {migration.__name__}")
     print("Database setup complete.")
 
 # --- User Functions ---
+# A user talking to the bot again can be messaged again, so this also clears
+# is_blocked. last_seen never moves backwards, since buffered /start writes
+# (see user_writes.py) can land after a newer direct one.
+USER_UPSERT = '''
+    INSERT INTO users (telegram_id, ff_username, ff_userid, last_seen) VALUES (?, ?, ?, ?)
+    ON CONFLICT (telegram_id) DO UPDATE SET
+        ff_username = COALESCE(excluded.ff_username, ff_username),
+        ff_userid = COALESCE(excluded.ff_userid, ff_userid),
+        is_blocked = 0,
+        last_seen = MAX(COALESCE(last_seen, 0), excluded.last_seen)
+'''
+
 def add_or_update_user(telegram_id, ff_username=None, ff_userid=None):
+    """Creates or updates a user and records that they were just seen."""
     conn = get_db_connection()
-    c = conn.cursor()
-    # Check if user exists
-    c.execute("SELECT * FROM users WHERE telegram_id = ?", (telegram_id,))
-    user = c.fetchone()
-    if user:
-        if ff_username and ff_userid:
-            c.execute("UPDATE users SET ff_username = ?, ff_userid = ? WHERE telegram_id = ?",
-                      (ff_username, ff_userid, telegram_id))
-    else:
-        c.execute("INSERT INTO users (telegram_id, ff_username, ff_userid) VALUES (?, ?, ?)",
-                  (telegram_id, ff_username, ff_userid))
-    conn.commit()
-    conn.close()
+    with conn:
+        conn.execute(USER_UPSERT, (telegram_id, ff_username, ff_userid, time.time()))
+
+def add_or_update_users(users):
+    """Upserts a batch of (telegram_id, ff_username, ff_userid, last_seen) rows in one transaction."""
+    conn = get_db_connection()
+    try:
+        conn.executemany(USER_UPSERT, users)
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
 
 def get_user(telegram_id):
     conn = get_db_connection()
     c = conn.cursor()
     c.execute("SELECT * FROM users WHERE telegram_id = ?", (telegram_id,))
     user = c.fetchone()
-    conn.close()
     return user
 
 def get_all_user_ids():
     conn = get_db_connection()
     c = conn.cursor()
-    c.execute("SELECT telegram_id FROM users")
+    c.execute("SELECT telegram_id FROM users WHERE is_blocked = 0")
     user_ids = [row['telegram_id'] for row in c.fetchall()]
-    conn.close()
     return user_ids
 
+@admin_cache.cached
 def is_admin(telegram_id):
     user = get_user(telegram_id)
     return user and user['is_admin'] == 1
 
+def grant_admin(telegram_id):
+    conn = get_db_connection()
+    with conn:
+        conn.execute("INSERT OR IGNORE INTO users (telegram_id) VALUES (?)", (telegram_id,))
+        conn.execute("UPDATE users SET is_admin = 1 WHERE telegram_id = ?", (telegram_id,))
+    admin_cache.invalidate((telegram_id,))
+
 # --- Tournament Functions ---
-def add_tournament(mode, date_time, fee, max_players):
+def add_tournament(mode, date_time, fee, max_players, starts_at=None, next_event=None, next_event_at=None, team_size=1):
     conn = get_db_connection()
     c = conn.cursor()
-    c.execute("INSERT INTO tournaments (mode, date_time, fee, max_players) VALUES (?, ?, ?, ?)",
-              (mode, date_time, fee, max_players))
-    conn.commit()
-    conn.close()
+    with conn:
+        c.execute('''
+            INSERT INTO tournaments (mode, date_time, fee, max_players, starts_at, next_event, next_event_at, team_size)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+        ''', (mode, date_time, fee, max_players, starts_at, next_event, next_event_at, team_size))
+    _invalidate_tournament(c.lastrowid)
 
+@open_tournaments_cache.cached
 def get_open_tournaments():
     conn = get_db_connection()
     c = conn.cursor()
     c.execute("SELECT * FROM tournaments WHERE status = 'OPEN'")
     tournaments = c.fetchall()
-    conn.close()
     return tournaments
 
+def _keyset_page(c, query, params, after_id, before_id, limit):
+    """Runs `query` for one page; it compares its key column with `{op} ?` and ends in ORDER BY key.
+
+    Pages are addressed by the last id seen (`after_id`) or, going backwards,
+    the first id seen (`before_id`), so each page is an index range scan no
+    matter how deep into the listing it is. Rows come back in ascending order.
+    """
+    if before_id is not None:
+        c.execute(f"{query.format(op='<')} DESC LIMIT ?", (*params, before_id, limit))
+        return c.fetchall()[::-1]
+    c.execute(f"{query.format(op='>')} LIMIT ?", (*params, after_id, limit))
+    return c.fetchall()
+
+def get_open_tournaments_page(after_id=0, before_id=None, limit=10):
+    """One page of open tournaments, in id order. The first page, where every /register starts, is cached."""
+    if not after_id and before_id is None:
+        return _first_open_tournaments_page(limit)
+    conn = get_db_connection()
+    return _keyset_page(conn.cursor(), "SELECT * FROM tournaments WHERE status = 'OPEN' AND id {op} ? ORDER BY id",
+                        (), after_id, before_id, limit)
+
+@open_tournaments_cache.cached
+def _first_open_tournaments_page(limit):
+    conn = get_db_connection()
+    return _keyset_page(conn.cursor(), "SELECT * FROM tournaments WHERE status = 'OPEN' AND id {op} ? ORDER BY id",
+                        (), 0, None, limit)
+
+@tournament_cache.cached
 def get_tournament_details(tournament_id):
     conn = get_db_connection()
     c = conn.cursor()
     c.execute("SELECT * FROM tournaments WHERE id = ?", (tournament_id,))
     tournament = c.fetchone()
-    conn.close()
     return tournament
 
+def set_room_details(tournament_id, room_id, room_password):
+    conn = get_db_connection()
+    with conn:
+        conn.execute("UPDATE tournaments SET room_id = ?, room_password = ? WHERE id = ?",
+                     (room_id, room_password, tournament_id))
+    _invalidate_tournament(tournament_id)
+
+# --- Tournament Lifecycle Functions ---
+def get_next_tournament_event_time():
+    conn = get_db_connection()
+    c = conn.cursor()
+    c.execute("SELECT MIN(next_event_at) AS at FROM tournaments WHERE next_event IS NOT NULL")
+    return c.fetchone()['at']
+
+def get_due_tournament_events(now, limit=100):
+    conn = get_db_connection()
+    c = conn.cursor()
+    c.execute('''
+        SELECT * FROM tournaments
+        WHERE next_event IS NOT NULL AND next_event_at <= ?
+        ORDER BY next_event_at
+        LIMIT ?
+    ''', (now, limit))
+    return c.fetchall()
+
+def advance_tournament_event(tournament_id, event, status, next_event, next_event_at):
+    """Records that `event` ran, sets `status` (unless None) and schedules the event after it."""
+    conn = get_db_connection()
+    c = conn.cursor()
+    with conn:
+        c.execute('''
+            UPDATE tournaments SET status = COALESCE(?, status), next_event = ?, next_event_at = ?
+            WHERE id = ? AND next_event = ?
+        ''', (status, next_event, next_event_at, tournament_id, event))
+    _invalidate_tournament(tournament_id)
+
+def get_unscheduled_tournaments():
+    conn = get_db_connection()
+    c = conn.cursor()
+    c.execute("SELECT id, date_time FROM tournaments WHERE starts_at IS NULL AND status != 'FINISHED'")
+    return c.fetchall()
+
+def set_tournament_schedule(tournament_id, starts_at, next_event, next_event_at):
+    conn = get_db_connection()
+    with conn:
+        conn.execute("UPDATE tournaments SET starts_at = ?, next_event = ?, next_event_at = ? WHERE id = ?",
+                     (starts_at, next_event, next_event_at, tournament_id))
+    _invalidate_tournament(tournament_id)
+
 # --- Registration Functions ---
 def register_user_for_tournament(tournament_id, telegram_id):
+    """Takes a slot in a tournament, returning 'SUCCESS', 'ALREADY_REGISTERED', 'FULL' or 'CLOSED'.
+
+    The duplicate check, capacity check, insert and slot count all happen in
+    one write transaction, so concurrent registrations can't overbook.
+    """
     conn = get_db_connection()
     c = conn.cursor()
-    # Check if already registered
-    c.execute("SELECT * FROM registrations WHERE tournament_id = ? AND telegram_id = ?", (tournament_id, telegram_id))
-    if c.fetchone():
-        conn.close()
-        return "ALREADY_REGISTERED"
-
-    c.execute("INSERT INTO registrations (tournament_id, telegram_id) VALUES (?, ?)", (tournament_id, telegram_id))
-    conn.commit()
-    
-    # Check if tournament is now full
-    c.execute("SELECT COUNT(*) as count FROM registrations WHERE tournament_id = ?", (tournament_id,))
-    registration_count = c.fetchone()['count']
-    tournament = get_tournament_details(tournament_id)
-    if registration_count >= tournament['max_players']:
-        c.execute("UPDATE tournaments SET status = 'FULL' WHERE id = ?", (tournament_id,))
+    c.execute("BEGIN IMMEDIATE")
+    try:
+        c.execute("SELECT 1 FROM registrations WHERE tournament_id = ? AND telegram_id = ?", (tournament_id, telegram_id))
+        if c.fetchone():
+            conn.rollback()
+            return "ALREADY_REGISTERED"
+        c.execute("SELECT status, registered_count, max_players, fee FROM tournaments WHERE id = ?", (tournament_id,))
+        tournament = c.fetchone()
+        if not tournament or tournament['status'] not in ('OPEN', 'FULL'):
+            conn.rollback()
+            return "CLOSED"
+        if tournament['status'] == 'FULL' or tournament['registered_count'] >= tournament['max_players']:
+            conn.rollback()
+            return "FULL"
+        c.execute("INSERT INTO registrations (tournament_id, telegram_id) VALUES (?, ?)", (tournament_id, telegram_id))
+        if tournament['fee'] > 0:
+            c.execute("INSERT INTO payments (registration_id, tournament_id, telegram_id, amount) VALUES (?, ?, ?, ?)",
+                      (c.lastrowid, tournament_id, telegram_id, tournament['fee']))
+        c.execute("UPDATE users SET preferred_mode = (SELECT mode FROM tournaments WHERE id = ?) WHERE telegram_id = ?",
+                  (tournament_id, telegram_id))
+        if tournament['fee'] == 0:
+            # Room details already scheduled for this tournament go to the new
+            # player too (in a paid one, once they have paid; see mark_payments).
+            c.execute('''
+                INSERT OR IGNORE INTO broadcast_deliveries (job_id, telegram_id)
+                SELECT id, ? FROM broadcast_jobs WHERE tournament_id = ? AND status = 'PENDING'
+            ''', (telegram_id, tournament_id))
+        c.execute('''
+            UPDATE tournaments
+            SET registered_count = registered_count + 1,
+                status = CASE WHEN registered_count + 1 >= max_players THEN 'FULL' ELSE status END
+            WHERE id = ?
+        ''', (tournament_id,))
         conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    _invalidate_tournament(tournament_id)
+    return "SUCCESS"
+
+def register_team(tournament_id, captain_id, team_name, members):
+    """Registers a whole team in one transaction, returning 'SUCCESS', 'ALREADY_REGISTERED',
+    'FULL', 'CLOSED', 'NAME_TAKEN' or 'PLAYER_TAKEN'.
 
-    conn.close()
+    `members` holds (ff_username, ff_userid) pairs, captain first; the
+    captain's Free Fire details are saved on their user. The team reserves
+    team_size player slots however many members it lists, and the fee is
+    per player.
+    """
+    conn = get_db_connection()
+    c = conn.cursor()
+    c.execute("BEGIN IMMEDIATE")
+    try:
+        c.execute("SELECT 1 FROM registrations WHERE tournament_id = ? AND telegram_id = ?", (tournament_id, captain_id))
+        if c.fetchone():
+            conn.rollback()
+            return "ALREADY_REGISTERED"
+        c.execute("SELECT status, registered_count, max_players, fee, team_size FROM tournaments WHERE id = ?",
+                  (tournament_id,))
+        tournament = c.fetchone()
+        if not tournament or tournament['status'] not in ('OPEN', 'FULL'):
+            conn.rollback()
+            return "CLOSED"
+        slots = tournament['team_size']
+        if tournament['status'] == 'FULL' or tournament['registered_count'] + slots > tournament['max_players']:
+            conn.rollback()
+            return "FULL"
+        c.execute("SELECT 1 FROM teams WHERE tournament_id = ? AND name = ?", (tournament_id, team_name))
+        if c.fetchone():
+            conn.rollback()
+            return "NAME_TAKEN"
+        ff_userids = [ff_userid for _, ff_userid in members]
+        c.execute(f"SELECT 1 FROM team_members WHERE tournament_id = ? AND ff_userid IN ({','.join('?' * len(ff_userids))})",
+                  (tournament_id, *ff_userids))
+        if c.fetchone():
+            conn.rollback()
+            return "PLAYER_TAKEN"
+        c.execute(USER_UPSERT, (captain_id, *members[0], time.time()))
+        c.execute("INSERT INTO teams (tournament_id, name, captain_id) VALUES (?, ?, ?)", (tournament_id, team_name, captain_id))
+        team_id = c.lastrowid
+        c.executemany("INSERT INTO team_members (team_id, tournament_id, ff_username, ff_userid) VALUES (?, ?, ?, ?)",
+                      ((team_id, tournament_id, ff_username, ff_userid) for ff_username, ff_userid in members))
+        c.execute("INSERT INTO registrations (tournament_id, telegram_id, team_id, slots) VALUES (?, ?, ?, ?)",
+                  (tournament_id, captain_id, team_id, slots))
+        if tournament['fee'] > 0:
+            c.execute("INSERT INTO payments (registration_id, tournament_id, telegram_id, amount) VALUES (?, ?, ?, ?)",
+                      (c.lastrowid, tournament_id, captain_id, tournament['fee'] * len(members)))
+        c.execute("UPDATE users SET preferred_mode = (SELECT mode FROM tournaments WHERE id = ?) WHERE telegram_id = ?",
+                  (tournament_id, captain_id))
+        if tournament['fee'] == 0:
+            c.execute('''
+                INSERT OR IGNORE INTO broadcast_deliveries (job_id, telegram_id)
+                SELECT id, ? FROM broadcast_jobs WHERE tournament_id = ? AND status = 'PENDING'
+            ''', (captain_id, tournament_id))
+        # FULL once there is no room left for another team.
+        c.execute('''
+            UPDATE tournaments
+            SET registered_count = registered_count + ?,
+                status = CASE WHEN registered_count + ? + team_size > max_players THEN 'FULL' ELSE status END
+            WHERE id = ?
+        ''', (slots, slots, tournament_id))
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    _invalidate_tournament(tournament_id)
     return "SUCCESS"
 
+def get_team_members(team_ids):
+    """Members of several teams in one query, as {team_id: [rows]} in the order they were given."""
+    if not team_ids:
+        return {}
+    conn = get_db_connection()
+    c = conn.cursor()
+    c.execute(f'''
+        SELECT team_id, ff_username, ff_userid FROM team_members
+        WHERE team_id IN ({','.join('?' * len(team_ids))}) ORDER BY team_id, rowid
+    ''', tuple(team_ids))
+    members = {}
+    for row in c.fetchall():
+        members.setdefault(row['team_id'], []).append(row)
+    return members
+
 def get_registrations_for_tournament(tournament_id):
     conn = get_db_connection()
     c = conn.cursor()
@@ -145,5 +641,371 @@ def get_registrations_for_tournament(tournament_id):
         WHERE r.tournament_id = ?
     ''', (tournament_id,))
     registrations = c.fetchall()
-    conn.close()
-    return registrations
\ No newline at end of file
+    return registrations
+
+def get_registrations_page(tournament_id, after_id=0, before_id=None, limit=20):
+    """One page of a tournament's registrations, in registration order."""
+    conn = get_db_connection()
+    return _keyset_page(conn.cursor(), '''
+        SELECT r.id, u.telegram_id, u.ff_username, u.ff_userid, r.team_id, t.name AS team_name
+        FROM registrations r
+        JOIN users u ON r.telegram_id = u.telegram_id
+        LEFT JOIN teams t ON t.id = r.team_id
+        WHERE r.tournament_id = ? AND r.id {op} ?
+        ORDER BY r.id
+    ''', (tournament_id,), after_id, before_id, limit)
+
+# --- Bulk Export/Import Functions ---
+def iter_registrations(tournament_id, batch_size=1000):
+    """Yields a tournament's registrations in registration order, reading `batch_size` rows at a time."""
+    conn = get_db_connection()
+    c = conn.cursor()
+    c.execute('''
+        SELECT u.telegram_id, u.ff_username, u.ff_userid
+        FROM registrations r
+        JOIN users u ON r.telegram_id = u.telegram_id
+        WHERE r.tournament_id = ?
+        ORDER BY r.id
+    ''', (tournament_id,))
+    while True:
+        rows = c.fetchmany(batch_size)
+        if not rows:
+            return
+        yield from rows
+
+def import_registrations(tournament_id, players):
+    """Registers (telegram_id, ff_username, ff_userid) rows for a tournament in one transaction.
+
+    `players` may be a generator over a large file: rows go through
+    executemany, and if it raises nothing is saved. Capacity isn't checked,
+    since this is for admins loading pre-registered players. Returns
+    (newly registered, rows read). Team tournaments can't be imported (rows
+    are single players) and raise ValueError.
+    """
+    conn = get_db_connection()
+    c = conn.cursor()
+    telegram_ids = []
+
+    def users():
+        for telegram_id, ff_username, ff_userid in players:
+            telegram_ids.append(telegram_id)
+            yield telegram_id, ff_username, ff_userid
+
+    c.execute("BEGIN IMMEDIATE")
+    try:
+        c.execute("SELECT team_size FROM tournaments WHERE id = ?", (tournament_id,))
+        tournament = c.fetchone()
+        if tournament and tournament['team_size'] > 1:
+            raise ValueError("this is a team tournament; captains register their teams with /register")
+        c.executemany('''
+            INSERT INTO users (telegram_id, ff_username, ff_userid) VALUES (?, ?, ?)
+            ON CONFLICT (telegram_id) DO UPDATE SET ff_username = COALESCE(excluded.ff_username, ff_username),
+                                                    ff_userid = COALESCE(excluded.ff_userid, ff_userid)
+        ''', users())
+        c.executemany("INSERT OR IGNORE INTO registrations (tournament_id, telegram_id) VALUES (?, ?)",
+                      ((tournament_id, telegram_id) for telegram_id in telegram_ids))
+        registered = c.rowcount
+        c.execute('''
+            INSERT OR IGNORE INTO payments (registration_id, tournament_id, telegram_id, amount)
+            SELECT r.id, r.tournament_id, r.telegram_id, t.fee
+            FROM registrations r JOIN tournaments t ON t.id = r.tournament_id
+            WHERE r.tournament_id = ? AND t.fee > 0
+        ''', (tournament_id,))
+        c.execute('''
+            UPDATE users SET preferred_mode = (SELECT mode FROM tournaments WHERE id = ?)
+            WHERE telegram_id IN (SELECT telegram_id FROM registrations WHERE tournament_id = ?)
+        ''', (tournament_id, tournament_id))
+        c.execute('''
+            INSERT OR IGNORE INTO broadcast_deliveries (job_id, telegram_id)
+            SELECT j.id, p.telegram_id FROM broadcast_jobs j
+            JOIN ({}) p
+            WHERE j.tournament_id = ? AND j.status = 'PENDING'
+        '''.format(SEGMENT_QUERIES["paid"]), (tournament_id, tournament_id))
+        c.execute('''
+            UPDATE tournaments
+            SET registered_count = (SELECT COALESCE(SUM(slots), 0) FROM registrations r WHERE r.tournament_id = tournaments.id),
+                status = CASE WHEN status = 'OPEN' AND
+                    (SELECT COALESCE(SUM(slots), 0) FROM registrations r WHERE r.tournament_id = tournaments.id) >= max_players
+                    THEN 'FULL' ELSE status END
+            WHERE id = ?
+        ''', (tournament_id,))
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    _invalidate_tournament(tournament_id)
+    return registered, len(telegram_ids)
+
+# --- Payment Functions ---
+def mark_payments(tournament_id, ff_userids, paid=True, marked_by=None):
+    """Marks the players with these Free Fire user ids paid (or unpaid again), in one transaction.
+
+    Returns (changed, unchanged, unknown) lists of the given ids: those whose
+    status changed, those that already had it, and those with no fee to pay
+    in this tournament. Newly paid players are added to the tournament's
+    pending room details, and players marked unpaid are taken off them.
+    """
+    status = 'PAID' if paid else 'UNPAID'
+    conn = get_db_connection()
+    c = conn.cursor()
+    c.execute("BEGIN IMMEDIATE")
+    try:
+        # The whole tournament's ledger (at most max_players rows) in one read;
+        # a team's payment can be found by any member's id.
+        c.execute('''
+            SELECT p.registration_id, p.telegram_id, p.status, u.ff_userid
+            FROM payments p JOIN users u ON u.telegram_id = p.telegram_id
+            WHERE p.tournament_id = ?
+            UNION
+            SELECT p.registration_id, p.telegram_id, p.status, m.ff_userid
+            FROM payments p JOIN registrations r ON r.id = p.registration_id
+            JOIN team_members m ON m.team_id = r.team_id
+            WHERE p.tournament_id = ?
+        ''', (tournament_id, tournament_id))
+        by_ff_userid = {}
+        for row in c.fetchall():
+            by_ff_userid.setdefault(row['ff_userid'], []).append(row)
+        changed, unchanged, unknown, updates = [], [], [], {}
+        for ff_userid in dict.fromkeys(ff_userids):
+            rows = by_ff_userid.get(ff_userid)
+            if not rows:
+                unknown.append(ff_userid)
+                continue
+            pending = [row for row in rows if row['status'] != status]
+            (changed if pending else unchanged).append(ff_userid)
+            updates.update((row['registration_id'], row) for row in pending)
+        updates = list(updates.values())
+        c.executemany("UPDATE payments SET status = ?, paid_at = ?, marked_by = ? WHERE registration_id = ?",
+                      ((status, time.time() if paid else None, marked_by, row['registration_id']) for row in updates))
+        if paid:
+            c.executemany('''
+                INSERT OR IGNORE INTO broadcast_deliveries (job_id, telegram_id)
+                SELECT id, ? FROM broadcast_jobs WHERE tournament_id = ? AND status = 'PENDING'
+            ''', ((row['telegram_id'], tournament_id) for row in updates))
+        else:
+            c.executemany('''
+                DELETE FROM broadcast_deliveries WHERE telegram_id = ? AND status = 'PENDING' AND job_id IN
+                    (SELECT id FROM broadcast_jobs WHERE tournament_id = ? AND status = 'PENDING')
+            ''', ((row['telegram_id'], tournament_id) for row in updates))
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    return changed, unchanged, unknown
+
+def get_payment_summary(tournament_id):
+    """Players and amount per payment status, e.g. {'PAID': {'players': 3, 'amount': 150}, 'UNPAID': ...}."""
+    conn = get_db_connection()
+    c = conn.cursor()
+    c.execute('''
+        SELECT status, COUNT(*) AS players, SUM(amount) AS amount
+        FROM payments WHERE tournament_id = ? GROUP BY status
+    ''', (tournament_id,))
+    summary = {status: {"players": 0, "amount": 0} for status in ('PAID', 'UNPAID')}
+    for row in c.fetchall():
+        summary[row['status']] = {"players": row['players'], "amount": row['amount']}
+    return summary
+
+def get_unpaid_players(tournament_id, limit=50):
+    conn = get_db_connection()
+    c = conn.cursor()
+    c.execute('''
+        SELECT u.telegram_id, u.ff_username, u.ff_userid, t.name AS team_name
+        FROM payments p JOIN users u ON u.telegram_id = p.telegram_id
+        LEFT JOIN registrations r ON r.id = p.registration_id
+        LEFT JOIN teams t ON t.id = r.team_id
+        WHERE p.tournament_id = ? AND p.status = 'UNPAID'
+        ORDER BY p.registration_id
+        LIMIT ?
+    ''', (tournament_id, limit))
+    return c.fetchall()
+
+# --- Broadcast Audience Functions ---
+# Who a broadcast goes to, as (kind, argument). Each one is an indexed
+# query that skips users who blocked the bot.
+SEGMENT_QUERIES = {
+    "all": "SELECT telegram_id FROM users WHERE is_blocked = 0",
+    "active": "SELECT telegram_id FROM users WHERE is_blocked = 0 AND last_seen >= ?",
+    "mode": "SELECT telegram_id FROM users WHERE is_blocked = 0 AND preferred_mode = ?",
+    "tournament": '''
+        SELECT u.telegram_id FROM registrations r JOIN users u ON u.telegram_id = r.telegram_id
+        WHERE r.tournament_id = ? AND u.is_blocked = 0
+    ''',
+    # Players of a tournament who may get its room details: those who paid,
+    # or everyone when it's free (free tournaments have no payment rows).
+    "paid": '''
+        SELECT u.telegram_id FROM registrations r
+        JOIN users u ON u.telegram_id = r.telegram_id
+        LEFT JOIN payments p ON p.registration_id = r.id
+        WHERE r.tournament_id = ? AND u.is_blocked = 0 AND (p.status IS NULL OR p.status = 'PAID')
+    ''',
+    # Still owing the fee of an upcoming tournament.
+    "unpaid": '''
+        SELECT DISTINCT u.telegram_id FROM tournaments t
+        JOIN payments p ON p.tournament_id = t.id AND p.status = 'UNPAID'
+        JOIN users u ON u.telegram_id = p.telegram_id
+        WHERE t.status IN ('OPEN', 'FULL') AND u.is_blocked = 0
+    ''',
+}
+
+def _segment_query(segment):
+    kind, arg = segment
+    if kind == "active":
+        arg = time.time() - arg * 86400  # `arg` is a number of days
+    return SEGMENT_QUERIES[kind], (() if arg is None else (arg,))
+
+def count_segment(segment):
+    conn = get_db_connection()
+    c = conn.cursor()
+    query, params = _segment_query(segment)
+    c.execute(f"SELECT COUNT(*) AS count FROM ({query})", params)
+    return c.fetchone()['count']
+
+# --- Broadcast Job Functions ---
+def create_broadcast_job(text, parse_mode=None, recipient_ids=None, admin_chat_id=None, status_message_id=None,
+                         send_at=None, tournament_id=None, segment=("all", None)):
+    """Queues a broadcast to `recipient_ids`, or else to everyone in `segment` (see SEGMENT_QUERIES).
+
+    The job is sent at `send_at` (a timestamp, default now). A job with a
+    `tournament_id` also reaches players who register (or, when there is a
+    fee, pay) while it is pending.
+    """
+    conn = get_db_connection()
+    c = conn.cursor()
+    with conn:
+        c.execute('''
+            INSERT INTO broadcast_jobs (text, parse_mode, admin_chat_id, status_message_id, send_at, tournament_id)
+            VALUES (?, ?, ?, ?, ?, ?)
+        ''', (text, parse_mode, admin_chat_id, status_message_id, time.time() if send_at is None else send_at, tournament_id))
+        job_id = c.lastrowid
+        if recipient_ids is None:
+            query, params = _segment_query(segment)
+            c.execute(f"INSERT OR IGNORE INTO broadcast_deliveries (job_id, telegram_id) SELECT ?, telegram_id FROM ({query})",
+                      (job_id, *params))
+        else:
+            c.executemany("INSERT OR IGNORE INTO broadcast_deliveries (job_id, telegram_id) VALUES (?, ?)",
+                          ((job_id, telegram_id) for telegram_id in recipient_ids))
+    return job_id
+
+def get_unfinished_broadcast_jobs():
+    conn = get_db_connection()
+    c = conn.cursor()
+    c.execute("SELECT * FROM broadcast_jobs WHERE status = 'PENDING' ORDER BY send_at, id")
+    return c.fetchall()
+
+def get_broadcast_job(job_id):
+    conn = get_db_connection()
+    c = conn.cursor()
+    c.execute("SELECT * FROM broadcast_jobs WHERE id = ?", (job_id,))
+    return c.fetchone()
+
+def cancel_scheduled_tournament_jobs(tournament_id):
+    """Cancels a tournament's broadcasts that haven't reached their send time; returns how many."""
+    conn = get_db_connection()
+    c = conn.cursor()
+    with conn:
+        c.execute("UPDATE broadcast_jobs SET status = 'CANCELLED' WHERE tournament_id = ? AND status = 'PENDING' AND send_at > ?",
+                  (tournament_id, time.time()))
+    return c.rowcount
+
+def get_pending_deliveries(job_id, limit):
+    conn = get_db_connection()
+    c = conn.cursor()
+    c.execute("SELECT telegram_id FROM broadcast_deliveries WHERE job_id = ? AND status = 'PENDING' LIMIT ?",
+              (job_id, limit))
+    return [row['telegram_id'] for row in c.fetchall()]
+
+def record_deliveries(job_id, results):
+    """Stores (telegram_id, status, delivered_at) results for a job and marks blocked users."""
+    conn = get_db_connection()
+    c = conn.cursor()
+    with conn:
+        c.executemany("UPDATE broadcast_deliveries SET status = ?, delivered_at = ? WHERE job_id = ? AND telegram_id = ?",
+                      ((status, delivered_at, job_id, telegram_id) for telegram_id, status, delivered_at in results))
+        c.executemany("UPDATE users SET is_blocked = 1 WHERE telegram_id = ?",
+                      ((telegram_id,) for telegram_id, status, delivered_at in results if status == 'BLOCKED'))
+
+def get_broadcast_job_counts(job_id):
+    conn = get_db_connection()
+    c = conn.cursor()
+    c.execute("SELECT status, COUNT(*) AS count FROM broadcast_deliveries WHERE job_id = ? GROUP BY status", (job_id,))
+    counts = {'PENDING': 0, 'SENT': 0, 'BLOCKED': 0, 'FAILED': 0}
+    counts.update({row['status']: row['count'] for row in c.fetchall()})
+    return counts
+
+def finish_broadcast_job(job_id):
+    """Marks a job DONE, unless it was cancelled in the meantime."""
+    conn = get_db_connection()
+    with conn:
+        conn.execute("UPDATE broadcast_jobs SET status = 'DONE' WHERE id = ? AND status = 'PENDING'", (job_id,))
+
+def get_delivery_latency(job_id):
+    """Median and slowest time from a job's send time to each delivered message, in seconds."""
+    conn = get_db_connection()
+    c = conn.cursor()
+    latency = "d.delivered_at - j.send_at"
+    query = f'''
+        FROM broadcast_deliveries d JOIN broadcast_jobs j ON j.id = d.job_id
+        WHERE d.job_id = ? AND d.status = 'SENT' AND d.delivered_at IS NOT NULL
+    '''
+    c.execute(f"SELECT COUNT(*) AS count, MAX({latency}) AS max {query}", (job_id,))
+    stats = dict(c.fetchone())
+    c.execute(f"SELECT {latency} AS latency {query} ORDER BY latency LIMIT 1 OFFSET ?", (job_id, stats['count'] // 2))
+    row = c.fetchone()
+    stats['median'] = row['latency'] if row else None
+    return stats
+
+# --- Bot Persistence Functions ---
+def load_persistence_data(kind):
+    conn = get_db_connection()
+    c = conn.cursor()
+    c.execute("SELECT key, data, updated_at FROM persistence_data WHERE kind = ?", (kind,))
+    return c.fetchall()
+
+def get_persistence_data_if_newer(kind, key, updated_after):
+    conn = get_db_connection()
+    c = conn.cursor()
+    c.execute("SELECT data, updated_at FROM persistence_data WHERE kind = ? AND key = ? AND updated_at > ?",
+              (kind, key, updated_after))
+    return c.fetchone()
+
+def load_conversation_states(name):
+    conn = get_db_connection()
+    c = conn.cursor()
+    c.execute("SELECT key, state FROM conversation_states WHERE name = ?", (name,))
+    return c.fetchall()
+
+def get_conversation_states(names, keys):
+    """Stored states of the conversations called `names` under any of `keys` (JSON lists)."""
+    names, keys = list(names), list(keys)
+    conn = get_db_connection()
+    c = conn.cursor()
+    c.execute(f"SELECT name, key, state FROM conversation_states WHERE name IN ({', '.join('?' * len(names))}) "
+              f"AND key IN ({', '.join('?' * len(keys))})", (*names, *keys))
+    return c.fetchall()
+
+def write_persistence(upserts, deletes, conversation_states):
+    """Writes a batch of buffered persistence changes in one transaction.
+
+    `upserts` holds (kind, key, data, updated_at) rows, `deletes` (kind, key)
+    pairs and `conversation_states` (name, key, state) rows, where a state of
+    None means the conversation ended.
+    """
+    conn = get_db_connection()
+    c = conn.cursor()
+    try:
+        c.executemany('''
+            INSERT INTO persistence_data (kind, key, data, updated_at) VALUES (?, ?, ?, ?)
+            ON CONFLICT (kind, key) DO UPDATE SET data = excluded.data, updated_at = excluded.updated_at
+        ''', upserts)
+        c.executemany("DELETE FROM persistence_data WHERE kind = ? AND key = ?", deletes)
+        c.executemany("DELETE FROM conversation_states WHERE name = ? AND key = ?",
+                      ((name, key) for name, key, state in conversation_states if state is None))
+        c.executemany('''
+            INSERT INTO conversation_states (name, key, state) VALUES (?, ?, ?)
+            ON CONFLICT (name, key) DO UPDATE SET state = excluded.state
+        ''', ((name, key, state) for name, key, state in conversation_states if state is not None))
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
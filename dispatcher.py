@@ -0,0 +1,113 @@
+# dispatcher.py
+import asyncio
+import logging
+import time
+from collections import OrderedDict
+
+from telegram import Update
+
+logger = logging.getLogger(__name__)
+
+WORKERS = 8
+QUEUE_SIZE = 1000
+DEDUP_WINDOW = 10000
+
+
+def _user_key(data):
+    """Picks the sender's id out of a raw update so one user's updates stay on one worker."""
+    for field in ("message", "edited_message", "callback_query", "inline_query", "my_chat_member"):
+        sender = (data.get(field) or {}).get("from")
+        if sender:
+            return sender["id"]
+    return data["update_id"]
+
+
+class UpdateDispatcher:
+    """Bounded in-memory ingestion queue in front of the Application.
+
+    The webhook calls `submit()`, which validates, de-duplicates by update_id
+    and enqueues without waiting for any handler. A pool of worker tasks then
+    feeds updates to `application.process_update`. Each worker owns its own
+    queue and updates are routed by user id, so a user's updates are always
+    processed in the order they arrived. With a persistence, each update's
+    changes are handed to it as soon as the update is done, rather than every
+    update_interval, so the user's next update can go to another worker.
+    """
+
+    def __init__(self, application, workers=WORKERS, queue_size=QUEUE_SIZE, dedup_window=DEDUP_WINDOW):
+        self.application = application
+        self.queues = [asyncio.Queue(maxsize=max(1, queue_size // workers)) for _ in range(workers)]
+        self.dedup_window = dedup_window
+        self._seen = OrderedDict()
+        self._tasks = []
+        self.received = 0
+        self.processed = 0
+        self.duplicates = 0
+        self.rejected = 0
+        self.failed = 0
+        self._lag_total = 0.0
+        self.lag_max = 0.0
+
+    def submit(self, data):
+        """Queues a raw update dict. Returns 'queued', 'duplicate', 'invalid' or 'full'."""
+        if not isinstance(data, dict) or not isinstance(data.get("update_id"), int):
+            return "invalid"
+        update_id = data["update_id"]
+        if update_id in self._seen:
+            self.duplicates += 1
+            return "duplicate"
+        queue = self.queues[hash(_user_key(data)) % len(self.queues)]
+        try:
+            queue.put_nowait((time.monotonic(), data))
+        except asyncio.QueueFull:
+            self.rejected += 1
+            return "full"
+        self.received += 1
+        self._seen[update_id] = None
+        if len(self._seen) > self.dedup_window:
+            self._seen.popitem(last=False)
+        return "queued"
+
+    async def _worker(self, queue):
+        while True:
+            queued_at, data = await queue.get()
+            lag = time.monotonic() - queued_at
+            self._lag_total += lag
+            self.lag_max = max(self.lag_max, lag)
+            try:
+                await self.application.process_update(Update.de_json(data, self.application.bot))
+                if self.application.persistence:
+                    await self.application.update_persistence()
+            except Exception:
+                self.failed += 1
+                logger.exception(f"Failed to process update {data['update_id']}")
+            finally:
+                self.processed += 1
+                queue.task_done()
+
+    def start(self):
+        self._tasks = [asyncio.create_task(self._worker(queue), name=f"update-worker-{i}")
+                       for i, queue in enumerate(self.queues)]
+
+    async def stop(self, drain_timeout=10):
+        """Gives queued updates up to `drain_timeout` seconds to finish, then stops the workers."""
+        try:
+            await asyncio.wait_for(asyncio.gather(*(queue.join() for queue in self.queues)), drain_timeout)
+        except asyncio.TimeoutError:
+            logger.warning("Update queue not drained before shutdown")
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+
+    def stats(self):
+        return {
+            "queue_depth": sum(queue.qsize() for queue in self.queues),
+            "workers": len(self.queues),
+            "received": self.received,
+            "processed": self.processed,
+            "failed": self.failed,
+            "duplicates": self.duplicates,
+            "rejected": self.rejected,
+            "lag_avg_ms": round(self._lag_total / self.processed * 1000, 2) if self.processed else 0.0,
+            "lag_max_ms": round(self.lag_max * 1000, 2),
+        }
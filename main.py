@@ -1,9 +1,24 @@
 # main.py (The Final, Simplified, and Correct Version)
 
+import functools
+import html
 import logging
 import os
-import database as db
+import re
+import tempfile
+import time
+from zoneinfo import ZoneInfo
+from async_db import store
+from broadcast import BroadcastWorker, engine as broadcast_engine
+import metrics
+from dispatcher import QUEUE_SIZE, WORKERS, UpdateDispatcher
+from persistence import UPDATE_INTERVAL, DatabasePersistence
+from player_lists import FORMATS
+from scheduler import TournamentScheduler, first_event, format_datetime, parse_datetime
+from sharding import ShardCoordinator
+from user_writes import FLUSH_DELAY, UserWriteBuffer
 import asyncio
+import contextlib
 from telegram import Update, ReplyKeyboardMarkup, InlineKeyboardMarkup, InlineKeyboardButton
 from telegram.ext import (
     Application,
@@ -12,39 +27,150 @@ from telegram.ext import (
     ConversationHandler,
     MessageHandler,
     CallbackQueryHandler,
+    TypeHandler,
     filters,
 )
-from flask import Flask, request
+from starlette.applications import Starlette
+from starlette.requests import Request
+from starlette.responses import JSONResponse, PlainTextResponse
+from starlette.routing import Route
 
 # --- Configuration ---
 BOT_TOKEN = os.environ.get("BOT_TOKEN")
 ADMIN_ID = int(os.environ.get("ADMIN_ID"))
+# Point at a local Bot API server (or the benchmarks' fake one) instead of api.telegram.org.
+TELEGRAM_API_BASE_URL = os.environ.get("TELEGRAM_API_BASE_URL", "https://api.telegram.org/bot")
+UPDATE_WORKERS = int(os.environ.get("UPDATE_WORKERS", WORKERS))
+UPDATE_QUEUE_SIZE = int(os.environ.get("UPDATE_QUEUE_SIZE", QUEUE_SIZE))
+SHARDS = int(os.environ.get("SHARDS", 1))
+PERSISTENCE_INTERVAL = float(os.environ.get("PERSISTENCE_INTERVAL", UPDATE_INTERVAL))
+USER_WRITE_DELAY = float(os.environ.get("USER_WRITE_DELAY", FLUSH_DELAY))
+# Tournament start times typed by admins are read in this timezone.
+TOURNAMENT_TIMEZONE = ZoneInfo(os.environ.get("TOURNAMENT_TIMEZONE", "Asia/Kolkata"))
 
 # --- Logging Setup ---
 logging.basicConfig(
     format="%(asctime)s - %(name)s - %(levelname)s - %(message)s", level=logging.INFO
 )
+# The lifecycle job is re-planned after every run; its add/run/remove lines are noise.
+logging.getLogger("apscheduler").setLevel(logging.WARNING)
 logger = logging.getLogger(__name__)
 
-# --- State Management for Startup ---
-app_initialized = False
-
 # --- Conversation States ---
 (ADD_TOURNAMENT_MODE, ADD_TOURNAMENT_DATETIME, ADD_TOURNAMENT_FEE,
  BROADCAST_MESSAGE, VIEW_REGISTRATIONS) = range(5)
 REGISTER_GET_USERNAME, REGISTER_GET_USERID = range(5, 7)
 (SEND_ROOM_GET_TID, SEND_ROOM_GET_RID, SEND_ROOM_GET_RPASS, SEND_ROOM_CONFIRM) = range(7, 11)
+SEND_ROOM_GET_TIME = 11
+BROADCAST_AUDIENCE, BROADCAST_TOURNAMENT = range(12, 14)
+REGISTER_TEAM_NAME, REGISTER_TEAM_MEMBERS, ADD_TOURNAMENT_TEAM_SIZE = range(14, 17)
+
+# Exports and uploaded imports stay in memory up to this size, then spill to disk.
+SPOOL_MAX_SIZE = 1024 * 1024
+
+# --- Broadcast Audiences ---
+# Button key -> label; "kind_arg" keys become the (kind, arg) segments of database.SEGMENT_QUERIES.
+BROADCAST_AUDIENCES = {
+    "all": "Everyone",
+    "active_7": "Active in the last 7 days",
+    "active_30": "Active in the last 30 days",
+    "unpaid": "Registered, fee unpaid",
+    "mode_BR": "Battle Royale players",
+    "mode_CS": "Clash Squad players",
+    "tournament": "Players of a tournament…",
+}
+
+# --- Teams ---
+# Players per team; in team tournaments a captain registers the whole team,
+# which takes that many of max_players' slots.
+TEAM_SIZES = {"Solo": 1, "Duo": 2, "Squad": 4}
+TEAM_NAME_MAX_LENGTH = 32
+# A member line is a Free Fire name followed by the (numeric) Free Fire ID.
+TEAM_MEMBER_LINE = re.compile(r"^(.+?)[\s,;:|-]+(\d{5,})$")
+
+# --- Listing Pages ---
+TOURNAMENTS_PAGE_SIZE = 10
+REGISTRATIONS_PAGE_SIZE = 25
+
+
+# ========== GLOBAL APPLICATION OBJECTS ==========
+# The Application and everything bound to it are made by build_bot() on first
+# use, not at import: building the Bot's HTTP clients alone takes a few hundred
+# milliseconds, and the sharded web process never needs them.
+persistence = None
+application = None
+dispatcher = None
+broadcast_worker = None
+tournament_scheduler = None
+
+# In sharded mode the web process hands updates to SHARDS bot processes instead.
+coordinator = ShardCoordinator(SHARDS, queue_size=UPDATE_QUEUE_SIZE) if SHARDS > 1 else None
+
+# /start only records that a user exists and was seen; those upserts are
+# batched instead of committing once per message.
+user_writes = UserWriteBuffer(store, flush_delay=USER_WRITE_DELAY)
+
+
+def build_bot():
+    """Builds the Application, its handlers and background workers (once)."""
+    global persistence, application, dispatcher, broadcast_worker, tournament_scheduler
+    if application is not None:
+        return application
+    # Conversation progress and user_data live in the database so they survive
+    # restarts and can be shared by several worker processes.
+    persistence = DatabasePersistence(store, update_interval=PERSISTENCE_INTERVAL)
+    application = (
+        Application.builder().token(BOT_TOKEN).base_url(TELEGRAM_API_BASE_URL)
+        .request(metrics.InstrumentedRequest()).persistence(persistence).build()
+    )
+    add_handlers(application)
+    # Webhook updates are acknowledged immediately and processed by this pool.
+    dispatcher = UpdateDispatcher(application, workers=UPDATE_WORKERS, queue_size=UPDATE_QUEUE_SIZE)
+    # Drains queued broadcast jobs in the background on the application's loop.
+    broadcast_worker = BroadcastWorker(application.bot, store, broadcast_engine)
+    # Sends reminders, closes registration and archives tournaments on schedule.
+    tournament_scheduler = TournamentScheduler(store, broadcast_worker, TOURNAMENT_TIMEZONE)
+    return application
+
+
+# ========== PAGINATION HELPERS ==========
+# Long listings are shown a page at a time with ⬅️/➡️ buttons. A button's
+# callback data carries the page's cursor as "<a|b>_<id>_<position>": fetch
+# rows after (a) or before (b) that id, with `position` the index of the
+# first row on the next page (a) or of the current page (b).
 
+async def fetch_page(fetch, page_size, cursor=None):
+    """Fetches one keyset page with `fetch`; returns (rows, start, has_prev, has_next)."""
+    direction, last_id, position = cursor.split('_') if cursor else ("a", "0", "0")
+    last_id, position = int(last_id), int(position)
+    if direction == "b":
+        rows = await fetch(before_id=last_id, limit=page_size + 1)
+        has_prev = len(rows) > page_size
+        rows = rows[-page_size:]
+        return rows, max(position - len(rows), 0), has_prev, True
+    rows = await fetch(after_id=last_id, limit=page_size + 1)
+    if not rows and last_id:
+        return await fetch_page(fetch, page_size)  # everything after it is gone, start over
+    return rows[:page_size], position, last_id > 0, len(rows) > page_size
 
-# ========== GLOBAL APPLICATION OBJECT ==========
-application = Application.builder().token(BOT_TOKEN).build()
+def page_buttons(prefix, rows, start, has_prev, has_next):
+    buttons = []
+    if has_prev:
+        buttons.append(InlineKeyboardButton("⬅️ Prev", callback_data=f"{prefix}b_{rows[0]['id']}_{start}"))
+    if has_next:
+        buttons.append(InlineKeyboardButton("Next ➡️", callback_data=f"{prefix}a_{rows[-1]['id']}_{start + len(rows)}"))
+    return buttons
+
+def page_markup(prefix, rows, start, has_prev, has_next):
+    buttons = page_buttons(prefix, rows, start, has_prev, has_next)
+    return InlineKeyboardMarkup([buttons]) if buttons else None
 
 
 # ========== USER COMMANDS & HANDLERS ==========
 
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     user = update.effective_user
-    db.add_or_update_user(user.id)
+    user_writes.add_or_update_user(user.id)
     await update.message.reply_html(
         f"🔥 Welcome, {user.first_name}! 🔥\n\n"
         "I am your Free Fire Tournament Bot.\n\n"
@@ -62,12 +188,16 @@ async def help_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> No
         "/help - Show this message\n\n"
         "<b>Admin Commands:</b>\n"
         "/admin - Open the admin panel\n"
-        "/sendroom - Send Room ID/Pass to players"
+        "/sendroom - Send Room ID/Pass to players who paid\n"
+        "/payments &lt;tournament_id&gt; - Paid/unpaid summary\n"
+        "/markpaid &lt;tournament_id&gt; &lt;FF IDs&gt; - Mark players paid (/markunpaid to undo)\n"
+        "/export &lt;tournament_id&gt; [csv|json] - Download the player list\n"
+        "/import &lt;tournament_id&gt; - As the caption of a CSV/JSON file, register its players"
     )
     await update.message.reply_html(text)
 
 async def my_info(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-    user_data = db.get_user(update.effective_user.id)
+    user_data = await store.get_user(update.effective_user.id)
     if user_data and user_data['ff_username']:
         await update.message.reply_html(
             "<b>Your Information:</b>\n"
@@ -78,31 +208,71 @@ async def my_info(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
         await update.message.reply_text("You haven't set your Free Fire info yet. Please /register for a tournament to set it.")
 
 # --- Registration Process ---
-async def register_start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
-    tournaments = db.get_open_tournaments()
-    if not tournaments:
-        await update.message.reply_text("Sorry, there are no open tournaments right now. Check back later!")
-        return ConversationHandler.END
+def team_label(tournament):
+    return next((name for name, size in TEAM_SIZES.items() if size == tournament['team_size']),
+                f"Teams of {tournament['team_size']}")
+
+def capacity_text(tournament):
+    """Slots taken, counted in teams for team tournaments."""
+    size = tournament['team_size']
+    if size == 1:
+        return f"{tournament['registered_count']}/{tournament['max_players']}"
+    return f"{tournament['registered_count'] // size}/{tournament['max_players'] // size} teams"
+
+def is_full(tournament):
+    return (tournament['status'] == 'FULL'
+            or tournament['registered_count'] + tournament['team_size'] > tournament['max_players'])
+
+def register_keyboard(tournaments, start, has_prev, has_next):
     keyboard = []
     for t in tournaments:
         mode = "Battle Royale" if t['mode'] == 'BR' else "Clash Squad"
         fee_text = f" (Fee: {t['fee']})" if t['fee'] > 0 else " (Free)"
-        button_text = f"{mode} - {t['date_time']}{fee_text}"
+        team_text = f" · {team_label(t)}" if t['team_size'] > 1 else ""
+        button_text = f"{mode}{team_text} - {t['date_time']}{fee_text}"
         keyboard.append([InlineKeyboardButton(button_text, callback_data=f"register_{t['id']}")])
-    reply_markup = InlineKeyboardMarkup(keyboard)
+    nav = page_buttons("register_page_", tournaments, start, has_prev, has_next)
+    if nav:
+        keyboard.append(nav)
+    return InlineKeyboardMarkup(keyboard)
+
+async def register_start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
+    tournaments, start, has_prev, has_next = await fetch_page(store.get_open_tournaments_page, TOURNAMENTS_PAGE_SIZE)
+    if not tournaments:
+        await update.message.reply_text("Sorry, there are no open tournaments right now. Check back later!")
+        return ConversationHandler.END
+    reply_markup = register_keyboard(tournaments, start, has_prev, has_next)
     await update.message.reply_text("Please choose a tournament to register for:", reply_markup=reply_markup)
     return REGISTER_GET_USERNAME
 
+async def register_page(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
+    query = update.callback_query
+    await query.answer()
+    tournaments, start, has_prev, has_next = await fetch_page(
+        store.get_open_tournaments_page, TOURNAMENTS_PAGE_SIZE, query.data.removeprefix("register_page_"))
+    if not tournaments:
+        await query.edit_message_text("Sorry, there are no open tournaments right now. Check back later!")
+        return ConversationHandler.END
+    await query.edit_message_reply_markup(register_keyboard(tournaments, start, has_prev, has_next))
+    return REGISTER_GET_USERNAME
+
 async def register_tournament_choice(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     query = update.callback_query
     await query.answer()
     tournament_id = int(query.data.split('_')[1])
     context.user_data['tournament_id'] = tournament_id
-    tournament = db.get_tournament_details(tournament_id)
-    registrations = db.get_registrations_for_tournament(tournament_id)
-    if len(registrations) >= tournament['max_players']:
+    tournament = await store.get_tournament_details(tournament_id)
+    if tournament['status'] not in ('OPEN', 'FULL'):
+        await query.edit_message_text("Sorry, registration for this tournament has closed.")
+        return ConversationHandler.END
+    if is_full(tournament):
         await query.edit_message_text("Sorry, this tournament is already full.")
         return ConversationHandler.END
+    if tournament['team_size'] > 1:
+        await query.edit_message_text(
+            f"This is a {team_label(tournament)} tournament: as captain you register your whole team "
+            f"(up to {tournament['team_size']} players).\n\nWhat is your <b>team name</b>?", parse_mode='HTML')
+        return REGISTER_TEAM_NAME
     await query.edit_message_text("Great! Now, please send me your Free Fire <b>in-game name</b>.", parse_mode='HTML')
     return REGISTER_GET_USERNAME
 
@@ -116,10 +286,10 @@ async def register_get_userid(update: Update, context: ContextTypes.DEFAULT_TYPE
     ff_userid = update.message.text
     ff_username = context.user_data['ff_username']
     tournament_id = context.user_data['tournament_id']
-    db.add_or_update_user(user.id, ff_username, ff_userid)
-    result = db.register_user_for_tournament(tournament_id, user.id)
+    await store.add_or_update_user(user.id, ff_username, ff_userid)
+    result = await store.register_user_for_tournament(tournament_id, user.id)
     if result == "SUCCESS":
-        tournament = db.get_tournament_details(tournament_id)
+        tournament = await store.get_tournament_details(tournament_id)
         fee_message = f"Please pay the registration fee of <b>₹{tournament['fee']}</b> to confirm your slot." if tournament['fee'] > 0 else "This is a free tournament."
         await update.message.reply_html(
             f"✅ <b>Registration Successful!</b>\n\n"
@@ -131,11 +301,72 @@ async def register_get_userid(update: Update, context: ContextTypes.DEFAULT_TYPE
         )
     elif result == "ALREADY_REGISTERED":
         await update.message.reply_text("You are already registered for this tournament.")
+    elif result == "FULL":
+        await update.message.reply_text("Sorry, this tournament filled up before your registration went through.")
+    elif result == "CLOSED":
+        await update.message.reply_text("Sorry, registration for this tournament closed before your registration went through.")
+    return ConversationHandler.END
+
+async def register_team_name(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
+    team_name = " ".join(update.message.text.split())
+    if len(team_name) > TEAM_NAME_MAX_LENGTH:
+        await update.message.reply_text(f"Please keep the team name under {TEAM_NAME_MAX_LENGTH} characters.")
+        return REGISTER_TEAM_NAME
+    context.user_data['team_name'] = team_name
+    tournament = await store.get_tournament_details(context.user_data['tournament_id'])
+    await update.message.reply_html(
+        f"Now send the Free Fire <b>name and ID</b> of each player, one per line, <b>yourself first</b> "
+        f"(up to {tournament['team_size']}), e.g.\n\n<code>CaptainName 123456789\nPlayerTwo 987654321</code>")
+    return REGISTER_TEAM_MEMBERS
+
+async def register_team_members(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
+    tournament_id = context.user_data['tournament_id']
+    tournament = await store.get_tournament_details(tournament_id)
+    members = []
+    for line in filter(None, (line.strip() for line in update.message.text.splitlines())):
+        match = TEAM_MEMBER_LINE.match(line)
+        if not match:
+            await update.message.reply_text(
+                f"I couldn't read \"{line}\". Each line should be a Free Fire name and ID, e.g. \"PlayerTwo 987654321\". "
+                "Please send the whole list again.")
+            return REGISTER_TEAM_MEMBERS
+        members.append((match.group(1), match.group(2)))
+    if not 1 <= len(members) <= tournament['team_size']:
+        await update.message.reply_text(f"A team has up to {tournament['team_size']} players. Please send the list again.")
+        return REGISTER_TEAM_MEMBERS
+    if len({ff_userid for _, ff_userid in members}) < len(members):
+        await update.message.reply_text("The same Free Fire ID is listed twice. Please send the list again.")
+        return REGISTER_TEAM_MEMBERS
+    team_name = context.user_data['team_name']
+    result = await store.register_team(tournament_id, update.effective_user.id, team_name, members)
+    if result == "SUCCESS":
+        total_fee = tournament['fee'] * len(members)
+        fee_message = (f"Please pay the registration fee of <b>₹{total_fee}</b> ({len(members)} × ₹{tournament['fee']}) "
+                       "to confirm your slot.") if tournament['fee'] > 0 else "This is a free tournament."
+        roster = "\n".join(f"{i}. {html.escape(name)} ({ff_userid})" for i, (name, ff_userid) in enumerate(members, 1))
+        await update.message.reply_html(
+            f"✅ <b>Team Registered!</b>\n\n"
+            f"<b>Tournament:</b> {tournament['mode']} on {tournament['date_time']}\n"
+            f"<b>Team:</b> {html.escape(team_name)}\n{roster}\n\n"
+            f"{fee_message}\n\n"
+            "You will receive the Room ID and Password before the match starts; please share them with your team."
+        )
+        return ConversationHandler.END
+    if result == "NAME_TAKEN":
+        await update.message.reply_text("Another team already has that name in this tournament. Please /register again with a different name.")
+    elif result == "PLAYER_TAKEN":
+        await update.message.reply_text("One of these Free Fire IDs is already in another team in this tournament.")
+    elif result == "ALREADY_REGISTERED":
+        await update.message.reply_text("You are already registered for this tournament.")
+    elif result == "FULL":
+        await update.message.reply_text("Sorry, this tournament filled up before your team's registration went through.")
+    elif result == "CLOSED":
+        await update.message.reply_text("Sorry, registration for this tournament closed before your team's registration went through.")
     return ConversationHandler.END
 
 # --- Admin Panel & Related Commands ---
 async def admin_panel(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-    if not db.is_admin(update.effective_user.id):
+    if not await store.is_admin(update.effective_user.id):
         await update.message.reply_text("You are not authorized to use this command.")
         return
     keyboard = [['➕ Add Tournament', '📢 Broadcast'], ['📋 View Tournaments', '👥 View Registrations']]
@@ -143,7 +374,7 @@ async def admin_panel(update: Update, context: ContextTypes.DEFAULT_TYPE) -> Non
     await update.message.reply_text("Welcome to the Admin Panel. Choose an option:\n\nUse /sendroom to send match details.", reply_markup=reply_markup)
 
 async def add_tournament_start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
-    if not db.is_admin(update.effective_user.id): return ConversationHandler.END
+    if not await store.is_admin(update.effective_user.id): return ConversationHandler.END
     keyboard = [['Battle Royale (50)', 'Clash Squad (8)']]
     reply_markup = ReplyKeyboardMarkup(keyboard, resize_keyboard=True, one_time_keyboard=True)
     await update.message.reply_text("Select tournament mode:", reply_markup=reply_markup)
@@ -160,23 +391,52 @@ async def add_tournament_get_mode(update: Update, context: ContextTypes.DEFAULT_
     else:
         await update.message.reply_text("Invalid mode. Please choose from the keyboard.")
         return ADD_TOURNAMENT_MODE
+    reply_markup = ReplyKeyboardMarkup([list(TEAM_SIZES)], resize_keyboard=True, one_time_keyboard=True)
+    await update.message.reply_text("Do players register alone or as teams?", reply_markup=reply_markup)
+    return ADD_TOURNAMENT_TEAM_SIZE
+
+async def add_tournament_get_team_size(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
+    team_size = TEAM_SIZES.get(update.message.text.strip().title())
+    if team_size is None or team_size > context.user_data['max_players']:
+        await update.message.reply_text("Invalid choice. Please choose from the keyboard.")
+        return ADD_TOURNAMENT_TEAM_SIZE
+    context.user_data['team_size'] = team_size
     await update.message.reply_text("Enter the date and time (e.g., 'July 10, 9:00 PM'):")
     return ADD_TOURNAMENT_DATETIME
 
 async def add_tournament_get_datetime(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
+    starts_at = parse_datetime(update.message.text, TOURNAMENT_TIMEZONE)
+    if starts_at is None:
+        await update.message.reply_text(
+            "I couldn't read that date and time. Try e.g. \"July 10, 9:00 PM\", "
+            "\"10/07/2025 21:00\" or \"tomorrow 9 PM\".")
+        return ADD_TOURNAMENT_DATETIME
+    if starts_at <= time.time():
+        await update.message.reply_text("That time has already passed. Please enter a time in the future.")
+        return ADD_TOURNAMENT_DATETIME
     context.user_data['date_time'] = update.message.text
-    await update.message.reply_text("Enter the registration fee (enter 0 for free):")
+    context.user_data['starts_at'] = starts_at
+    await update.message.reply_text(
+        f"📅 Starts {format_datetime(starts_at, TOURNAMENT_TIMEZONE)}.\n\n"
+        "Enter the registration fee (enter 0 for free):")
     return ADD_TOURNAMENT_FEE
 
 async def add_tournament_get_fee(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     try:
         fee = int(update.message.text)
-        db.add_tournament(
+        starts_at = context.user_data.get('starts_at')
+        next_event, next_event_at = first_event(starts_at) if starts_at else (None, None)
+        await store.add_tournament(
             mode=context.user_data['mode'],
             date_time=context.user_data['date_time'],
             fee=fee,
-            max_players=context.user_data['max_players']
+            max_players=context.user_data['max_players'],
+            starts_at=starts_at,
+            next_event=next_event,
+            next_event_at=next_event_at,
+            team_size=context.user_data.get('team_size', 1),
         )
+        tournament_scheduler.wake()
         await update.message.reply_text("✅ Tournament successfully created!")
         return ConversationHandler.END
     except ValueError:
@@ -184,67 +444,277 @@ async def add_tournament_get_fee(update: Update, context: ContextTypes.DEFAULT_T
         return ADD_TOURNAMENT_FEE
 
 async def broadcast_start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
-    if not db.is_admin(update.effective_user.id): return ConversationHandler.END
-    await update.message.reply_text("Please send the message you want to broadcast to all users.")
+    if not await store.is_admin(update.effective_user.id): return ConversationHandler.END
+    keyboard = [[InlineKeyboardButton(label, callback_data=f"audience_{key}")] for key, label in BROADCAST_AUDIENCES.items()]
+    await update.message.reply_text("Who should get this broadcast?", reply_markup=InlineKeyboardMarkup(keyboard))
+    return BROADCAST_AUDIENCE
+
+async def ask_broadcast_message(context, segment, label, reply):
+    recipients = await store.count_segment(segment)
+    if recipients == 0:
+        await reply(f"Nobody matches \"{label}\" right now, so there is no one to send to.")
+        return ConversationHandler.END
+    context.user_data['broadcast_segment'] = segment
+    await reply(f"{label}: {recipients} users.\n\nPlease send the message you want to broadcast to them.")
     return BROADCAST_MESSAGE
 
+async def broadcast_audience(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
+    query = update.callback_query
+    await query.answer()
+    key = query.data.removeprefix("audience_")
+    if key == "tournament":
+        await query.edit_message_text("Enter the Tournament ID whose players should get the broadcast.")
+        return BROADCAST_TOURNAMENT
+    kind, _, arg = key.partition("_")
+    segment = [kind, int(arg) if kind == "active" else (arg or None)]
+    return await ask_broadcast_message(context, segment, BROADCAST_AUDIENCES[key], query.edit_message_text)
+
+async def broadcast_tournament(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
+    try:
+        tournament_id = int(update.message.text)
+    except ValueError:
+        await update.message.reply_text("That's not a valid number. Please enter the Tournament ID, or /cancel.")
+        return BROADCAST_TOURNAMENT
+    if not await store.get_tournament_details(tournament_id):
+        await update.message.reply_text("Sorry, I can't find a tournament with that ID. Please try again or /cancel.")
+        return BROADCAST_TOURNAMENT
+    return await ask_broadcast_message(context, ["tournament", tournament_id], f"Players of tournament {tournament_id}",
+                                       update.message.reply_text)
+
 async def broadcast_get_message(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     message_to_send = update.message.text
-    user_ids = db.get_all_user_ids()
-    sent_count = 0
-    for user_id in user_ids:
-        try:
-            await context.bot.send_message(chat_id=user_id, text=f"📢 **Admin Broadcast**\n\n{message_to_send}", parse_mode='Markdown')
-            sent_count += 1
-        except Exception as e:
-            logger.error(f"Could not send broadcast to {user_id}: {e}")
-    await update.message.reply_text(f"Broadcast sent to {sent_count}/{len(user_ids)} users.")
+    status_message = await update.message.reply_text("📢 Broadcast queued. I'll update this message as it goes out.")
+    await store.create_broadcast_job(
+        f"📢 **Admin Broadcast**\n\n{message_to_send}", parse_mode='Markdown',
+        admin_chat_id=status_message.chat_id, status_message_id=status_message.message_id,
+        segment=context.user_data.get('broadcast_segment', ["all", None]),
+    )
+    broadcast_worker.wake()
     return ConversationHandler.END
 
-async def view_tournaments(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-    if not db.is_admin(update.effective_user.id): return
-    tournaments = db.get_open_tournaments()
-    if not tournaments:
-        await update.message.reply_text("No open tournaments found.")
-        return
+def tournaments_page_text(tournaments):
     response = "<b>Open Tournaments:</b>\n\n"
     for t in tournaments:
         mode = "Battle Royale" if t['mode'] == 'BR' else "Clash Squad"
-        regs = len(db.get_registrations_for_tournament(t['id']))
         response += f"<b>ID: {t['id']}</b> | {mode}\n"
         response += f"  - Date: {t['date_time']}\n"
         response += f"  - Fee: {t['fee']}\n"
-        response += f"  - Registered: {regs}/{t['max_players']}\n\n"
-    await update.message.reply_html(response)
+        if t['team_size'] > 1:
+            response += f"  - Teams: {team_label(t)}\n"
+        response += f"  - Registered: {capacity_text(t)}\n\n"
+    return response
+
+async def view_tournaments(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    if not await store.is_admin(update.effective_user.id): return
+    tournaments, start, has_prev, has_next = await fetch_page(store.get_open_tournaments_page, TOURNAMENTS_PAGE_SIZE)
+    if not tournaments:
+        await update.message.reply_text("No open tournaments found.")
+        return
+    await update.message.reply_html(tournaments_page_text(tournaments),
+                                    reply_markup=page_markup("tournaments_page_", tournaments, start, has_prev, has_next))
+
+async def view_tournaments_page(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    query = update.callback_query
+    await query.answer()
+    if not await store.is_admin(update.effective_user.id): return
+    tournaments, start, has_prev, has_next = await fetch_page(
+        store.get_open_tournaments_page, TOURNAMENTS_PAGE_SIZE, query.data.removeprefix("tournaments_page_"))
+    if not tournaments:
+        await query.edit_message_text("No open tournaments found.")
+        return
+    await query.edit_message_text(tournaments_page_text(tournaments), parse_mode='HTML',
+                                  reply_markup=page_markup("tournaments_page_", tournaments, start, has_prev, has_next))
 
 async def view_registrations_start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
-    if not db.is_admin(update.effective_user.id): return ConversationHandler.END
+    if not await store.is_admin(update.effective_user.id): return ConversationHandler.END
     await update.message.reply_text("Please enter the Tournament ID to view its registrations.")
     return VIEW_REGISTRATIONS
 
+def registrations_page_text(tournament, registrations, start, members):
+    response = f"<b>Registrations for Tournament ID {tournament['id']}:</b>\n"
+    response += f"({tournament['mode']} on {tournament['date_time']}, {capacity_text(tournament)} registered)\n\n"
+    for i, reg in enumerate(registrations, start + 1):
+        if reg['team_id']:
+            response += f"{i}. <b>{html.escape(reg['team_name'])}</b>\n"
+            for member in members.get(reg['team_id'], []):
+                response += f"   • {html.escape(member['ff_username'])} (ID: {html.escape(member['ff_userid'])})\n"
+            continue
+        response += f"{i}. {html.escape(reg['ff_username'] or '')} (ID: {html.escape(str(reg['ff_userid'] or ''))})\n"
+    return response
+
+async def registrations_page(tournament, cursor=None):
+    """A page of registrations as (text, markup), or None when there are none; one query fetches its teams' members."""
+    fetch = functools.partial(store.get_registrations_page, tournament['id'])
+    registrations, start, has_prev, has_next = await fetch_page(fetch, REGISTRATIONS_PAGE_SIZE, cursor)
+    if not registrations:
+        return None
+    members = await store.get_team_members([reg['team_id'] for reg in registrations if reg['team_id']])
+    markup = page_markup(f"registrations_page_{tournament['id']}_", registrations, start, has_prev, has_next)
+    return registrations_page_text(tournament, registrations, start, members), markup
+
 async def view_registrations_get_id(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     try:
         tournament_id = int(update.message.text)
-        registrations = db.get_registrations_for_tournament(tournament_id)
-        tournament = db.get_tournament_details(tournament_id)
+        tournament = await store.get_tournament_details(tournament_id)
         if not tournament:
             await update.message.reply_text("Tournament with that ID not found.")
             return ConversationHandler.END
-        if not registrations:
+        page = await registrations_page(tournament)
+        if not page:
             await update.message.reply_text(f"No one has registered for Tournament ID {tournament_id} yet.")
             return ConversationHandler.END
-        response = f"<b>Registrations for Tournament ID {tournament_id}:</b>\n"
-        response += f"({tournament['mode']} on {tournament['date_time']})\n\n"
-        for i, reg in enumerate(registrations, 1):
-            response += f"{i}. {reg['ff_username']} (ID: {reg['ff_userid']})\n"
-        await update.message.reply_html(response)
+        text, markup = page
+        await update.message.reply_html(text, reply_markup=markup)
     except ValueError:
         await update.message.reply_text("Invalid ID. Please enter a number.")
     return ConversationHandler.END
 
+async def view_registrations_page(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    query = update.callback_query
+    await query.answer()
+    if not await store.is_admin(update.effective_user.id): return
+    tournament_id, cursor = query.data.removeprefix("registrations_page_").split('_', 1)
+    tournament = await store.get_tournament_details(int(tournament_id))
+    page = tournament and await registrations_page(tournament, cursor)
+    if not page:
+        await query.edit_message_text(f"No one has registered for Tournament ID {tournament_id} yet.")
+        return
+    text, markup = page
+    await query.edit_message_text(text, parse_mode='HTML', reply_markup=markup)
+
+# --- Player List Export/Import ---
+async def export_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    if not await store.is_admin(update.effective_user.id):
+        await update.message.reply_text("This is an admin-only command.")
+        return
+    args = context.args
+    if not args or not args[0].isdigit() or len(args) > 2 or (len(args) == 2 and args[1].lower() not in FORMATS):
+        await update.message.reply_text("Usage: /export <tournament_id> [csv|json]")
+        return
+    tournament_id = int(args[0])
+    fmt = args[1].lower() if len(args) == 2 else "csv"
+    tournament = await store.get_tournament_details(tournament_id)
+    if not tournament:
+        await update.message.reply_text("Tournament with that ID not found.")
+        return
+    with tempfile.SpooledTemporaryFile(max_size=SPOOL_MAX_SIZE) as out:
+        count = await store.export_registrations(tournament_id, fmt, out)
+        out.seek(0)
+        # The upload itself needs the whole file; only the finished bytes are held for it.
+        await update.message.reply_document(
+            out.read(), filename=f"tournament_{tournament_id}_registrations.{fmt}",
+            caption=f"{count} registrations for Tournament ID {tournament_id} "
+                    f"({tournament['mode']} on {tournament['date_time']})",
+        )
+
+async def import_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    if not await store.is_admin(update.effective_user.id):
+        await update.message.reply_text("This is an admin-only command.")
+        return
+    document = update.message.document
+    args = (update.message.caption or update.message.text or "").split()[1:]
+    if document is None or len(args) != 1 or not args[0].isdigit():
+        await update.message.reply_text(
+            "Send a CSV or JSON file with the caption /import <tournament_id>.\n"
+            "Columns: telegram_id, ff_username, ff_userid (the same as /export).")
+        return
+    tournament_id = int(args[0])
+    tournament = await store.get_tournament_details(tournament_id)
+    if not tournament:
+        await update.message.reply_text("Tournament with that ID not found.")
+        return
+    if tournament['team_size'] > 1:
+        await update.message.reply_text(
+            f"Tournament ID {tournament_id} is a {team_label(tournament)} tournament. Imports hold single "
+            "players, so captains register their teams with /register instead.")
+        return
+    fmt = "json" if (document.file_name or "").lower().endswith(".json") else "csv"
+    file = await document.get_file()
+    with tempfile.SpooledTemporaryFile(max_size=SPOOL_MAX_SIZE) as data:
+        await file.download_to_memory(data)
+        data.seek(0)
+        try:
+            registered, total = await store.import_players(tournament_id, fmt, data)
+        except ValueError as e:
+            await update.message.reply_text(f"Import failed, nothing was saved: {e}")
+            return
+    await update.message.reply_text(
+        f"Imported {total} players into Tournament ID {tournament_id}: "
+        f"{registered} newly registered, {total - registered} already were.")
+
+# --- Payments ---
+# Admins reconcile fees by Free Fire user id, pasting as many as they have;
+# ids may be separated by spaces, commas or new lines.
+UNPAID_LIST_LIMIT = 30
+
+async def payments_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    if not await store.is_admin(update.effective_user.id):
+        await update.message.reply_text("This is an admin-only command.")
+        return
+    if len(context.args) != 1 or not context.args[0].isdigit():
+        await update.message.reply_text("Usage: /payments <tournament_id>")
+        return
+    tournament_id = int(context.args[0])
+    tournament = await store.get_tournament_details(tournament_id)
+    if not tournament:
+        await update.message.reply_text("Tournament with that ID not found.")
+        return
+    if tournament['fee'] == 0:
+        await update.message.reply_text(f"Tournament ID {tournament_id} is free; there are no fees to track.")
+        return
+    summary = await store.get_payment_summary(tournament_id)
+    paid, unpaid = summary['PAID'], summary['UNPAID']
+    unit = "teams" if tournament['team_size'] > 1 else "players"
+    lines = [
+        f"💰 <b>Payments for Tournament ID {tournament_id}</b> ({tournament['mode']} on "
+        f"{html.escape(tournament['date_time'])}, fee ₹{tournament['fee']})\n",
+        f"✅ Paid: {paid['players']} {unit}, ₹{paid['amount']}",
+        f"⏳ Unpaid: {unpaid['players']} {unit}, ₹{unpaid['amount']}",
+    ]
+    if unpaid['players']:
+        lines.append(f"\n<b>Unpaid {unit}:</b>")
+        for player in await store.get_unpaid_players(tournament_id, UNPAID_LIST_LIMIT):
+            team = f"<b>{html.escape(player['team_name'])}</b>, captain " if player['team_name'] else ""
+            lines.append(f"• {team}{html.escape(player['ff_username'] or '-')} (ID: <code>{html.escape(player['ff_userid'] or '-')}</code>)")
+        if unpaid['players'] > UNPAID_LIST_LIMIT:
+            lines.append(f"… and {unpaid['players'] - UNPAID_LIST_LIMIT} more")
+    lines.append(f"\nMark payments with /markpaid {tournament_id} &lt;FF ID&gt; &lt;FF ID&gt; …")
+    await update.message.reply_html("\n".join(lines))
+
+async def mark_payments_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """/markpaid and /markunpaid: <tournament_id> followed by Free Fire user ids."""
+    if not await store.is_admin(update.effective_user.id):
+        await update.message.reply_text("This is an admin-only command.")
+        return
+    command = update.message.text.split()[0].lstrip("/").split("@")[0]
+    paid = command == "markpaid"
+    ids = [part for arg in context.args[1:] for part in arg.split(",") if part]
+    if not context.args or not context.args[0].isdigit() or not ids:
+        await update.message.reply_text(f"Usage: /{command} <tournament_id> <FF ID> <FF ID> …")
+        return
+    tournament_id = int(context.args[0])
+    tournament = await store.get_tournament_details(tournament_id)
+    if not tournament:
+        await update.message.reply_text("Tournament with that ID not found.")
+        return
+    if tournament['fee'] == 0:
+        await update.message.reply_text(f"Tournament ID {tournament_id} is free; there are no fees to track.")
+        return
+    changed, unchanged, unknown = await store.mark_payments(tournament_id, ids, paid, update.effective_user.id)
+    state = "paid" if paid else "unpaid"
+    lines = [f"Tournament ID {tournament_id}: marked {len(changed)} players {state}."]
+    if unchanged:
+        lines.append(f"Already {state}: {len(unchanged)}.")
+    if unknown:
+        lines.append(f"Not registered for this tournament ({len(unknown)}): {', '.join(unknown[:UNPAID_LIST_LIMIT])}"
+                     + (" …" if len(unknown) > UNPAID_LIST_LIMIT else ""))
+    summary = await store.get_payment_summary(tournament_id)
+    lines.append(f"Now {summary['PAID']['players']} paid, {summary['UNPAID']['players']} unpaid.")
+    await update.message.reply_text("\n".join(lines))
+
 # --- Send Room Details Feature ---
 async def send_room_start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
-    if not db.is_admin(update.effective_user.id):
+    if not await store.is_admin(update.effective_user.id):
         await update.message.reply_text("This is an admin-only command.")
         return ConversationHandler.END
     await update.message.reply_text("Okay, let's send some room details. What is the Tournament ID?")
@@ -253,7 +723,7 @@ async def send_room_start(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
 async def send_room_get_tid(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     try:
         tournament_id = int(update.message.text)
-        tournament = db.get_tournament_details(tournament_id)
+        tournament = await store.get_tournament_details(tournament_id)
         if not tournament:
             await update.message.reply_text("Sorry, I can't find a tournament with that ID. Please try again or /cancel.")
             return SEND_ROOM_GET_TID
@@ -274,57 +744,89 @@ async def send_room_get_rpass(update: Update, context: ContextTypes.DEFAULT_TYPE
     tid = context.user_data['send_room_tid']
     rid = context.user_data['send_room_rid']
     rpass = context.user_data['send_room_rpass']
-    registrations = db.get_registrations_for_tournament(tid)
-    player_count = len(registrations)
-    if player_count == 0:
+    # Only players who paid get the room details (everyone, in a free tournament).
+    player_count = await store.count_segment(("paid", tid))
+    unpaid = (await store.get_payment_summary(tid))['UNPAID']['players']
+    if player_count == 0 and unpaid == 0:
         await update.message.reply_text("There are no players registered for this tournament. Nothing to send. /cancel")
         return ConversationHandler.END
+    unpaid_note = f" {unpaid} unpaid players won't get them until marked paid with /markpaid." if unpaid else ""
     confirmation_text = (
         f"🚨 **Please Confirm** 🚨\n\n"
         f"You are about to send the following details:\n"
         f"  - **Tournament ID:** {tid}\n"
         f"  - **Room ID:** `{rid}`\n"
         f"  - **Password:** `{rpass}`\n\n"
-        f"This will be sent to **{player_count}** registered players.\n\n"
+        f"This will be sent to **{player_count}** registered players.{unpaid_note}\n\n"
         f"Are you sure you want to proceed?"
     )
     keyboard = [[InlineKeyboardButton("✅ Yes, Send It!", callback_data="send_room_confirm_yes"),
-                 InlineKeyboardButton("❌ No, Cancel", callback_data="send_room_confirm_no")]]
+                 InlineKeyboardButton("⏰ Schedule", callback_data="send_room_confirm_schedule")],
+                [InlineKeyboardButton("❌ No, Cancel", callback_data="send_room_confirm_no")]]
     reply_markup = InlineKeyboardMarkup(keyboard)
     await update.message.reply_html(confirmation_text, reply_markup=reply_markup)
     return SEND_ROOM_CONFIRM
 
-async def send_room_confirm(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
-    query = update.callback_query
-    await query.answer()
-    if query.data == "send_room_confirm_no":
-        await query.edit_message_text("Operation cancelled. Nothing was sent.")
-        return ConversationHandler.END
-    await query.edit_message_text("Sending messages... Please wait.")
-    tid = context.user_data['send_room_tid']
-    rid = context.user_data['send_room_rid']
-    rpass = context.user_data['send_room_rpass']
-    registrations = db.get_registrations_for_tournament(tid)
-    tournament = db.get_tournament_details(tid)
+def room_details_message(tournament, rid, rpass):
     mode = "Battle Royale" if tournament['mode'] == 'BR' else "Clash Squad"
-    message_to_send = (
+    return (
         f"🔥 **Tournament Room Details!** 🔥\n\n"
         f"Here are the details for your upcoming **{mode}** tournament on **{tournament['date_time']}**.\n\n"
         f"🔑 **Room ID:** `{rid}`\n"
         f"🔒 **Password:** `{rpass}`\n\n"
         f"Please join the room quickly. Good luck!"
     )
-    sent_count = 0
-    failed_count = 0
-    for reg in registrations:
-        try:
-            await context.bot.send_message(chat_id=reg['telegram_id'], text=message_to_send, parse_mode='Markdown')
-            sent_count += 1
-            await asyncio.sleep(0.1)
-        except Exception as e:
-            logger.error(f"Failed to send room details to {reg['telegram_id']}: {e}")
-            failed_count += 1
-    await query.edit_message_text(f"✅ Done!\n\nRoom details sent to {sent_count} players.\nFailed to send to {failed_count} players (they may have blocked the bot).")
+
+async def queue_room_details(context, send_at, admin_chat_id, status_message_id):
+    """Stores the room details and queues them, rendered, for every player who paid (all, if free).
+
+    Replaces room details already scheduled for the tournament; players who
+    register or pay before `send_at` are added to the recipients as they do.
+    """
+    tid = context.user_data['send_room_tid']
+    rid = context.user_data['send_room_rid']
+    rpass = context.user_data['send_room_rpass']
+    await store.set_room_details(tid, rid, rpass)
+    await store.cancel_scheduled_tournament_jobs(tid)
+    tournament = await store.get_tournament_details(tid)
+    job_id = await store.create_broadcast_job(
+        room_details_message(tournament, rid, rpass), parse_mode='Markdown', segment=("paid", tid),
+        admin_chat_id=admin_chat_id, status_message_id=status_message_id, send_at=send_at, tournament_id=tid,
+    )
+    broadcast_worker.wake()
+    return sum((await store.get_broadcast_job_counts(job_id)).values())
+
+async def send_room_confirm(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
+    query = update.callback_query
+    await query.answer()
+    if query.data == "send_room_confirm_no":
+        await query.edit_message_text("Operation cancelled. Nothing was sent.")
+        return ConversationHandler.END
+    if query.data == "send_room_confirm_schedule":
+        tournament = await store.get_tournament_details(context.user_data['send_room_tid'])
+        starts = (f" The tournament starts {format_datetime(tournament['starts_at'], TOURNAMENT_TIMEZONE)}."
+                  if tournament['starts_at'] else "")
+        await query.edit_message_text(
+            f"When should the room details be sent? (e.g. 'today 8:50 PM').{starts}")
+        return SEND_ROOM_GET_TIME
+    await query.edit_message_text("Sending messages... Please wait.")
+    await queue_room_details(context, None, query.message.chat_id, query.message.message_id)
+    return ConversationHandler.END
+
+async def send_room_get_time(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
+    send_at = parse_datetime(update.message.text, TOURNAMENT_TIMEZONE)
+    if send_at is None:
+        await update.message.reply_text("I couldn't read that time. Try e.g. 'today 8:50 PM', or /cancel.")
+        return SEND_ROOM_GET_TIME
+    if send_at <= time.time():
+        await update.message.reply_text("That time has already passed. Please enter a time in the future, or /cancel.")
+        return SEND_ROOM_GET_TIME
+    when = format_datetime(send_at, TOURNAMENT_TIMEZONE)
+    status = await update.message.reply_text(f"⏰ Room details scheduled for {when}.")
+    players = await queue_room_details(context, send_at, status.chat_id, status.message_id)
+    await status.edit_text(
+        f"⏰ Room details scheduled for {when} to {players} players.\n"
+        "Players who register (or pay) before then will get them too; this message will show the delivery.")
     return ConversationHandler.END
 
 # --- General Utility ---
@@ -334,82 +836,262 @@ async def cancel(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
 
 
 # --- Add all handlers to the application object ---
-register_conv_handler = ConversationHandler(
-    entry_points=[CommandHandler("register", register_start)],
-    states={
-        REGISTER_GET_USERNAME: [
-            CallbackQueryHandler(register_tournament_choice, pattern='^register_'),
-            MessageHandler(filters.TEXT & ~filters.COMMAND, register_get_username),
+def add_handlers(application):
+    register_conv_handler = ConversationHandler(
+        entry_points=[CommandHandler("register", register_start)],
+        states={
+            REGISTER_GET_USERNAME: [
+                CallbackQueryHandler(register_page, pattern='^register_page_'),
+                CallbackQueryHandler(register_tournament_choice, pattern=r'^register_\d+$'),
+                MessageHandler(filters.TEXT & ~filters.COMMAND, register_get_username),
+            ],
+            REGISTER_GET_USERID: [MessageHandler(filters.TEXT & ~filters.COMMAND, register_get_userid)],
+            REGISTER_TEAM_NAME: [MessageHandler(filters.TEXT & ~filters.COMMAND, register_team_name)],
+            REGISTER_TEAM_MEMBERS: [MessageHandler(filters.TEXT & ~filters.COMMAND, register_team_members)],
+        },
+        fallbacks=[CommandHandler("cancel", cancel)],
+        name="register",
+        persistent=True,
+    )
+    admin_conv_handler = ConversationHandler(
+        entry_points=[
+            MessageHandler(filters.Regex('^➕ Add Tournament$'), add_tournament_start),
+            MessageHandler(filters.Regex('^📢 Broadcast$'), broadcast_start),
+            MessageHandler(filters.Regex('^👥 View Registrations$'), view_registrations_start)
         ],
-        REGISTER_GET_USERID: [MessageHandler(filters.TEXT & ~filters.COMMAND, register_get_userid)],
-    },
-    fallbacks=[CommandHandler("cancel", cancel)],
-)
-admin_conv_handler = ConversationHandler(
-    entry_points=[
-        MessageHandler(filters.Regex('^➕ Add Tournament$'), add_tournament_start),
-        MessageHandler(filters.Regex('^📢 Broadcast$'), broadcast_start),
-        MessageHandler(filters.Regex('^👥 View Registrations$'), view_registrations_start)
-    ],
-    states={
-        ADD_TOURNAMENT_MODE: [MessageHandler(filters.TEXT & ~filters.COMMAND, add_tournament_get_mode)],
-        ADD_TOURNAMENT_DATETIME: [MessageHandler(filters.TEXT & ~filters.COMMAND, add_tournament_get_datetime)],
-        ADD_TOURNAMENT_FEE: [MessageHandler(filters.TEXT & ~filters.COMMAND, add_tournament_get_fee)],
-        BROADCAST_MESSAGE: [MessageHandler(filters.TEXT & ~filters.COMMAND, broadcast_get_message)],
-        VIEW_REGISTRATIONS: [MessageHandler(filters.TEXT & ~filters.COMMAND, view_registrations_get_id)],
-    },
-    fallbacks=[CommandHandler("cancel", cancel)],
-)
-send_room_handler = ConversationHandler(
-    entry_points=[CommandHandler("sendroom", send_room_start)],
-    states={
-        SEND_ROOM_GET_TID: [MessageHandler(filters.TEXT & ~filters.COMMAND, send_room_get_tid)],
-        SEND_ROOM_GET_RID: [MessageHandler(filters.TEXT & ~filters.COMMAND, send_room_get_rid)],
-        SEND_ROOM_GET_RPASS: [MessageHandler(filters.TEXT & ~filters.COMMAND, send_room_get_rpass)],
-        SEND_ROOM_CONFIRM: [CallbackQueryHandler(send_room_confirm)],
-    },
-    fallbacks=[CommandHandler("cancel", cancel)],
-)
+        states={
+            ADD_TOURNAMENT_MODE: [MessageHandler(filters.TEXT & ~filters.COMMAND, add_tournament_get_mode)],
+            ADD_TOURNAMENT_TEAM_SIZE: [MessageHandler(filters.TEXT & ~filters.COMMAND, add_tournament_get_team_size)],
+            ADD_TOURNAMENT_DATETIME: [MessageHandler(filters.TEXT & ~filters.COMMAND, add_tournament_get_datetime)],
+            ADD_TOURNAMENT_FEE: [MessageHandler(filters.TEXT & ~filters.COMMAND, add_tournament_get_fee)],
+            BROADCAST_AUDIENCE: [CallbackQueryHandler(broadcast_audience, pattern='^audience_')],
+            BROADCAST_TOURNAMENT: [MessageHandler(filters.TEXT & ~filters.COMMAND, broadcast_tournament)],
+            BROADCAST_MESSAGE: [MessageHandler(filters.TEXT & ~filters.COMMAND, broadcast_get_message)],
+            VIEW_REGISTRATIONS: [MessageHandler(filters.TEXT & ~filters.COMMAND, view_registrations_get_id)],
+        },
+        fallbacks=[CommandHandler("cancel", cancel)],
+        name="admin",
+        persistent=True,
+    )
+    send_room_handler = ConversationHandler(
+        entry_points=[CommandHandler("sendroom", send_room_start)],
+        states={
+            SEND_ROOM_GET_TID: [MessageHandler(filters.TEXT & ~filters.COMMAND, send_room_get_tid)],
+            SEND_ROOM_GET_RID: [MessageHandler(filters.TEXT & ~filters.COMMAND, send_room_get_rid)],
+            SEND_ROOM_GET_RPASS: [MessageHandler(filters.TEXT & ~filters.COMMAND, send_room_get_rpass)],
+            SEND_ROOM_CONFIRM: [CallbackQueryHandler(send_room_confirm)],
+            SEND_ROOM_GET_TIME: [MessageHandler(filters.TEXT & ~filters.COMMAND, send_room_get_time)],
+        },
+        fallbacks=[CommandHandler("cancel", cancel)],
+        name="send_room",
+        persistent=True,
+    )
+    conversations = [register_conv_handler, admin_conv_handler, send_room_handler]
 
-application.add_handler(CommandHandler("start", start))
-application.add_handler(CommandHandler("help", help_command))
-application.add_handler(CommandHandler("myinfo", my_info))
-application.add_handler(CommandHandler("admin", admin_panel))
-application.add_handler(MessageHandler(filters.Regex('^📋 View Tournaments$'), view_tournaments))
-application.add_handler(register_conv_handler)
-application.add_handler(admin_conv_handler)
-application.add_handler(send_room_handler)
+    async def refresh_conversations(update, context):
+        await persistence.refresh_conversations(update, conversations)
 
+    # Group -1 runs before the handlers: the user's last step may have been handled by another worker.
+    application.add_handler(TypeHandler(Update, refresh_conversations), group=-1)
 
-# ========== WEB SERVER SETUP ==========
+    application.add_handler(metrics.instrument_handler(CommandHandler("start", start)))
+    application.add_handler(metrics.instrument_handler(CommandHandler("help", help_command)))
+    application.add_handler(metrics.instrument_handler(CommandHandler("myinfo", my_info)))
+    application.add_handler(metrics.instrument_handler(CommandHandler("admin", admin_panel)))
+    application.add_handler(metrics.instrument_handler(MessageHandler(filters.Regex('^📋 View Tournaments$'), view_tournaments)))
+    application.add_handler(metrics.instrument_handler(CallbackQueryHandler(view_tournaments_page, pattern='^tournaments_page_')))
+    application.add_handler(metrics.instrument_handler(CallbackQueryHandler(view_registrations_page, pattern='^registrations_page_')))
+    application.add_handler(metrics.instrument_handler(register_conv_handler))
+    application.add_handler(metrics.instrument_handler(admin_conv_handler))
+    application.add_handler(metrics.instrument_handler(send_room_handler))
+    application.add_handler(metrics.instrument_handler(CommandHandler("payments", payments_command)))
+    application.add_handler(metrics.instrument_handler(CommandHandler(["markpaid", "markunpaid"], mark_payments_command)))
+    application.add_handler(metrics.instrument_handler(CommandHandler("export", export_command)))
+    application.add_handler(metrics.instrument_handler(CommandHandler("import", import_command)))
+    application.add_handler(metrics.instrument_handler(
+        MessageHandler(filters.Document.ALL & filters.CaptionRegex(r'^/import(@\w+)?(\s|$)'), import_command)))
 
-app = Flask(__name__)
+
+# ========== WEB SERVER SETUP ==========
 
 async def main_setup():
     """Initializes the bot and its handlers, and sets up the database."""
-    global app_initialized
-    if not app_initialized:
-        await application.initialize()
-        db.setup_database()
-        conn = db.get_db_connection()
-        conn.execute("INSERT OR IGNORE INTO users (telegram_id) VALUES (?)", (ADMIN_ID,))
-        conn.execute("UPDATE users SET is_admin = 1 WHERE telegram_id = ?", (ADMIN_ID,))
-        conn.commit()
-        conn.close()
-        app_initialized = True
-        logger.info("Application initialized and database setup complete.")
-
-# Run the setup once when the app starts
-asyncio.run(main_setup())
-
-@app.route("/")
-def index():
-    return "Hello, I am your Free Fire Bot and I am running!"
-
-@app.route(f"/{BOT_TOKEN}", methods=["POST"])
-async def webhook():
-    """Webhook endpoint to process updates."""
-    await application.process_update(
-        Update.de_json(request.get_json(force=True), application.bot)
+    await setup_storage()
+    build_bot()
+    await application.initialize()
+    logger.info("Application initialized and database setup complete.")
+
+async def setup_storage():
+    # Both are no-ops on an up-to-date database, so a restart does no writes.
+    await store.setup_database()
+    if not await store.is_admin(ADMIN_ID):
+        await store.grant_admin(ADMIN_ID)
+
+background_tasks = []
+BACKGROUND_LOCK_RETRY = 30   # seconds between attempts to take the background lock
+BACKGROUND_LOCK_CHECK = 5    # seconds between checks that we still hold it
+
+async def run_background_jobs():
+    """Runs the broadcast worker and scheduler whenever this process holds the background lock.
+
+    Instances sharing a PostgreSQL database would otherwise each send every
+    broadcast and reminder; the others wait and take over if the holder goes
+    away. With SQLite the lock is always ours.
+    """
+    while True:
+        try:
+            locked = await store.acquire_background_lock()
+        except Exception:
+            logger.exception("Could not take the background lock, retrying")
+            locked = False
+        if locked:
+            logger.info("Running the broadcast worker and tournament scheduler")
+            # Also resumes broadcast jobs left over from a restart.
+            worker = asyncio.create_task(broadcast_worker.run_forever(), name="broadcast-worker")
+            try:
+                tournament_scheduler.start(application.job_queue)
+                while await store.holds_background_lock():
+                    await asyncio.sleep(BACKGROUND_LOCK_CHECK)
+                logger.warning("Lost the background lock, stopping the broadcast worker and scheduler")
+            finally:
+                worker.cancel()
+                tournament_scheduler.stop()
+        await asyncio.sleep(BACKGROUND_LOCK_RETRY)
+
+async def start_bot(background_jobs=True):
+    """Starts processing updates; `background_jobs` also runs the broadcast worker and scheduler."""
+    await application.start()
+    dispatcher.start()
+    if background_jobs:
+        background_tasks.append(asyncio.create_task(run_background_jobs(), name="background-jobs"))
+
+async def stop_bot():
+    for task in background_tasks:
+        task.cancel()
+    await dispatcher.stop()
+    await application.stop()
+    await application.shutdown()
+    await user_writes.flush()
+    store.shutdown()
+
+# --- Lazy start ---
+# The server accepts requests as soon as it is up; the bot is initialized
+# (which calls getMe over the network) and started by a background task, and
+# the first update waits for it. If that fails, e.g. with no network yet,
+# updates get a 503 (Telegram redelivers them) and the next one retries.
+BOT_START_TIMEOUT = 30
+_bot_starting = None
+
+async def _start_bot_once():
+    await main_setup()
+    await start_bot()
+    logger.info("Bot started.")
+
+def start_bot_soon():
+    """Starts the bot in the background unless it is started or starting; returns that task."""
+    global _bot_starting
+    if _bot_starting is None or (_bot_starting.done() and (_bot_starting.cancelled() or _bot_starting.exception())):
+        _bot_starting = asyncio.create_task(_start_bot_once(), name="bot-start")
+        _bot_starting.add_done_callback(_log_start_failure)
+    return _bot_starting
+
+def _log_start_failure(task):
+    if not task.cancelled() and task.exception():
+        logger.error("Could not start the bot, will retry on the next update", exc_info=task.exception())
+
+async def wait_for_bot():
+    task = start_bot_soon()
+    if not task.done():
+        await asyncio.wait_for(asyncio.shield(task), BOT_START_TIMEOUT)
+    task.result()
+
+@contextlib.asynccontextmanager
+async def lifespan(app):
+    """Runs the bot on the server's event loop for the lifetime of the process.
+
+    With SHARDS > 1 this process only sets up the database and routes updates
+    to shard processes, each running its own bot (see sharding.py).
+    """
+    if coordinator:
+        await setup_storage()
+        coordinator.start()
+        try:
+            yield
+        finally:
+            await coordinator.stop()
+            store.shutdown()
+        return
+    start_bot_soon()
+    try:
+        yield
+    finally:
+        if not _bot_starting.done():
+            _bot_starting.cancel()
+            await asyncio.gather(_bot_starting, return_exceptions=True)
+        if application is not None and application.running:
+            await stop_bot()
+        else:
+            store.shutdown()
+
+async def index(request: Request) -> PlainTextResponse:
+    return PlainTextResponse("Hello, I am your Free Fire Bot and I am running!")
+
+async def webhook(request: Request) -> PlainTextResponse:
+    """Webhook endpoint: queues the update and acknowledges without waiting for handlers."""
+    try:
+        data = await request.json()
+    except ValueError:
+        return PlainTextResponse("invalid update", status_code=400)
+    if not coordinator:
+        try:
+            await wait_for_bot()
+        except Exception:
+            return PlainTextResponse("starting", status_code=503)
+    result = (coordinator or dispatcher).submit(data)
+    if result == "invalid":
+        return PlainTextResponse("invalid update", status_code=400)
+    if result == "full":
+        # Telegram redelivers on non-2xx responses, so this only delays the update.
+        return PlainTextResponse("busy", status_code=503)
+    return PlainTextResponse("ok")
+
+async def stats(request: Request) -> JSONResponse:
+    if not (coordinator or dispatcher):
+        return JSONResponse({"started": False})
+    return JSONResponse((coordinator or dispatcher).stats())
+
+async def update_runtime_metrics():
+    """Copies dispatcher and cache counters into metrics just before they are reported."""
+    if coordinator:
+        # The shards report their own queues and counters, which are summed
+        # with these; the coordinator adds only what it alone sees.
+        metrics.set_gauge("update_queue_depth", coordinator.inbox_depth())
+        metrics.set_counter("updates_rejected_total", coordinator.rejected)
+        return
+    if not dispatcher:
+        return
+    stats = dispatcher.stats()
+    metrics.set_gauge("update_queue_depth", stats["queue_depth"])
+    metrics.set_counter("updates_processed_total", stats["processed"])
+    metrics.set_counter("updates_rejected_total", stats["rejected"])
+    metrics.set_gauge("update_lag_max_seconds", stats["lag_max_ms"] / 1000)
+    for name, cache in (await store.cache_stats()).items():
+        metrics.set_counter("cache_hits_total", cache["hits"], cache=name)
+        metrics.set_counter("cache_misses_total", cache["misses"], cache=name)
+
+async def metrics_endpoint(request: Request) -> PlainTextResponse:
+    await update_runtime_metrics()
+    shard_snapshots = coordinator.metric_snapshots() if coordinator else ()
+    return PlainTextResponse(metrics.render(shard_snapshots), media_type="text/plain; version=0.0.4")
+
+def create_app():
+    """The ASGI app: `uvicorn --factory main:create_app`."""
+    return Starlette(
+        routes=[
+            Route("/", index),
+            Route("/stats", stats),
+            Route("/metrics", metrics_endpoint),
+            Route(f"/{BOT_TOKEN}", webhook, methods=["POST"]),
+        ],
+        lifespan=lifespan,
     )
-    return "ok"
\ No newline at end of file
@@ -0,0 +1,189 @@
+# metrics.py
+import contextlib
+import functools
+import threading
+import time
+from collections import defaultdict
+
+from telegram.error import TelegramError
+from telegram.ext import ConversationHandler
+from telegram.request import HTTPXRequest
+
+# Minimal in-process metrics rendered in the Prometheus text format. Series
+# are keyed by (name, sorted label pairs); recording is a dict update under a
+# lock, so instrumenting hot paths costs next to nothing.
+BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+DESCRIPTIONS = {
+    "handler_duration_seconds": ("histogram", "Time spent in each update handler."),
+    "handler_errors_total": ("counter", "Handler calls that raised an exception."),
+    "db_query_duration_seconds": ("histogram", "Time spent in each database.py function."),
+    "telegram_api_duration_seconds": ("histogram", "Latency of Bot API calls by method."),
+    "telegram_api_errors_total": ("counter", "Bot API calls that failed, by method and status."),
+    "broadcast_messages_total": ("counter", "Broadcast messages by delivery status."),
+    "broadcast_pending_deliveries": ("gauge", "Deliveries still pending in the broadcasts being sent."),
+    "broadcast_delivery_latency_seconds": ("histogram", "Time from a broadcast's send time to each delivery, by kind."),
+    "update_queue_depth": ("gauge", "Updates waiting in the ingestion queue."),
+    "updates_processed_total": ("counter", "Updates processed since start."),
+    "updates_rejected_total": ("counter", "Updates refused because the queue was full."),
+    "update_lag_max_seconds": ("gauge", "Longest time an update waited in the queue."),
+    "cache_hits_total": ("counter", "Read cache hits by cache."),
+    "cache_misses_total": ("counter", "Read cache misses by cache."),
+}
+# Gauges that hold a maximum rather than an amount: merged across shards with
+# max(), where every other gauge (queue depth, pending deliveries) adds up.
+MAX_GAUGES = {"update_lag_max_seconds"}
+
+_lock = threading.Lock()
+_counters = defaultdict(float)
+_gauges = {}
+_histograms = {}
+
+
+def _key(name, labels):
+    return name, tuple(sorted(labels.items()))
+
+
+def inc(name, value=1, **labels):
+    with _lock:
+        _counters[_key(name, labels)] += value
+
+
+def set_counter(name, total, **labels):
+    """Sets a counter to a running total kept elsewhere (e.g. by the dispatcher)."""
+    with _lock:
+        _counters[_key(name, labels)] = total
+
+
+def set_gauge(name, value, **labels):
+    with _lock:
+        _gauges[_key(name, labels)] = value
+
+
+def observe(name, seconds, **labels):
+    key = _key(name, labels)
+    with _lock:
+        histogram = _histograms.get(key)
+        if histogram is None:
+            histogram = _histograms[key] = [[0] * len(BUCKETS), 0.0, 0]
+        for i, bound in enumerate(BUCKETS):
+            if seconds <= bound:
+                histogram[0][i] += 1
+                break
+        histogram[1] += seconds
+        histogram[2] += 1
+
+
+@contextlib.contextmanager
+def timer(name, **labels):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        observe(name, time.perf_counter() - start, **labels)
+
+
+def snapshot():
+    """A picklable copy of every series, e.g. to ship from a shard process."""
+    with _lock:
+        return {
+            "counters": dict(_counters),
+            "gauges": dict(_gauges),
+            "histograms": {key: [list(h[0]), h[1], h[2]] for key, h in _histograms.items()},
+        }
+
+
+def _merge(snapshots):
+    merged = {"counters": defaultdict(float), "gauges": defaultdict(float), "histograms": {}}
+    for snap in snapshots:
+        for key, value in snap["counters"].items():
+            merged["counters"][key] += value
+        for key, value in snap["gauges"].items():
+            if key[0] in MAX_GAUGES:
+                merged["gauges"][key] = max(merged["gauges"].get(key, value), value)
+            else:
+                merged["gauges"][key] += value
+        for key, (buckets, total, count) in snap["histograms"].items():
+            current = merged["histograms"].setdefault(key, [[0] * len(BUCKETS), 0.0, 0])
+            current[0] = [a + b for a, b in zip(current[0], buckets)]
+            current[1] += total
+            current[2] += count
+    return merged
+
+
+def _labels(pairs, extra=()):
+    pairs = list(pairs) + list(extra)
+    if not pairs:
+        return ""
+    return "{" + ",".join(f'{k}="{v}"' for k, v in pairs) + "}"
+
+
+def render(extra_snapshots=()):
+    """Renders this process's metrics (plus any shard snapshots) as Prometheus text."""
+    merged = _merge([snapshot(), *extra_snapshots])
+    series = defaultdict(list)
+    for kind in ("counters", "gauges"):
+        for (name, labels), value in merged[kind].items():
+            series[name].append(f"{name}{_labels(labels)} {value}")
+    for (name, labels), (buckets, total, count) in merged["histograms"].items():
+        cumulative = 0
+        for bound, bucket in zip(BUCKETS, buckets):
+            cumulative += bucket
+            series[name].append(f"{name}_bucket{_labels(labels, [('le', bound)])} {cumulative}")
+        series[name].append(f"{name}_bucket{_labels(labels, [('le', '+Inf')])} {count}")
+        series[name].append(f"{name}_sum{_labels(labels)} {total}")
+        series[name].append(f"{name}_count{_labels(labels)} {count}")
+    lines = []
+    for name in sorted(series):
+        kind, help_text = DESCRIPTIONS.get(name, ("untyped", name))
+        lines.append(f"# HELP {name} {help_text}")
+        lines.append(f"# TYPE {name} {kind}")
+        lines.extend(series[name])
+    return "\n".join(lines) + "\n"
+
+
+# --- Instrumentation helpers ---
+def _timed_callback(callback):
+    @functools.wraps(callback)
+    async def wrapper(update, context):
+        name = callback.__name__
+        start = time.perf_counter()
+        try:
+            return await callback(update, context)
+        except Exception:
+            inc("handler_errors_total", handler=name)
+            raise
+        finally:
+            observe("handler_duration_seconds", time.perf_counter() - start, handler=name)
+    return wrapper
+
+
+def instrument_handler(handler):
+    """Wraps a handler's callback (and every callback inside a ConversationHandler) with timing."""
+    if isinstance(handler, ConversationHandler):
+        for inner in handler.entry_points + handler.fallbacks:
+            instrument_handler(inner)
+        for state_handlers in handler.states.values():
+            for inner in state_handlers:
+                instrument_handler(inner)
+    else:
+        handler.callback = _timed_callback(handler.callback)
+    return handler
+
+
+class InstrumentedRequest(HTTPXRequest):
+    """HTTPXRequest that records latency and failures of every Bot API call."""
+
+    async def do_request(self, url, method, *args, **kwargs):
+        api_method = url.rsplit("/", 1)[-1]
+        start = time.perf_counter()
+        try:
+            status, payload = await super().do_request(url, method, *args, **kwargs)
+        except TelegramError as e:
+            inc("telegram_api_errors_total", method=api_method, status=type(e).__name__)
+            raise
+        finally:
+            observe("telegram_api_duration_seconds", time.perf_counter() - start, method=api_method)
+        if status >= 400:
+            inc("telegram_api_errors_total", method=api_method, status=status)
+        return status, payload
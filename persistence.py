@@ -0,0 +1,185 @@
+# persistence.py
+import asyncio
+import json
+import logging
+import time
+
+from telegram.ext import BasePersistence, PersistenceInput
+
+logger = logging.getLogger(__name__)
+
+# PTB hands changed data to the persistence every UPDATE_INTERVAL seconds;
+# everything it hands over within FLUSH_DELAY is written in one transaction.
+UPDATE_INTERVAL = 5
+FLUSH_DELAY = 0.5
+
+
+class DatabasePersistence(BasePersistence):
+    """Stores user_data, chat_data, bot_data and conversation states in the bot's database.
+
+    Writes are buffered and flushed in batches rather than once per message.
+    Before each update PTB asks for a refresh of the user's and chat's data,
+    which is re-read only when another process has written a newer copy, so
+    several workers can share the same database. PTB itself reads
+    conversation states only at startup, so `refresh_conversations` re-reads
+    the sender's states before each update, and a changed state is written
+    right away rather than after `flush_delay`: the user's next step may reach
+    another worker.
+    """
+
+    def __init__(self, store, update_interval=UPDATE_INTERVAL, flush_delay=FLUSH_DELAY):
+        super().__init__(store_data=PersistenceInput(callback_data=False), update_interval=update_interval)
+        self.store = store
+        self.flush_delay = flush_delay
+        self._pending = {}          # (kind, key) -> JSON data, or None to delete
+        self._pending_conversations = {}   # (name, key) -> JSON state, or None when ended
+        self._versions = {}         # (kind, key) -> updated_at of the copy this process holds
+        self._writing = {}          # the batch being written, still newer than the database
+        self._writing_conversations = {}
+        self._write_lock = asyncio.Lock()   # batches are written in order
+        self._flush_task = None
+        self._conversation_flushes = set()
+        self._bot_data = None       # JSON of the bot_data last loaded or buffered
+
+    # --- Loading ---
+    async def _load(self, kind, convert_key):
+        rows = await self.store.load_persistence_data(kind)
+        for row in rows:
+            self._versions[(kind, row['key'])] = row['updated_at']
+        return {convert_key(row['key']): json.loads(row['data']) for row in rows}
+
+    async def get_user_data(self):
+        return await self._load("user", int)
+
+    async def get_chat_data(self):
+        return await self._load("chat", int)
+
+    async def get_bot_data(self):
+        data = await self._load("bot", str)
+        self._bot_data = json.dumps(data.get("", {}))
+        return data.get("", {})
+
+    async def get_callback_data(self):
+        return None
+
+    async def get_conversations(self, name):
+        rows = await self.store.load_conversation_states(name)
+        return {tuple(json.loads(row['key'])): json.loads(row['state']) for row in rows}
+
+    # --- Buffered writes ---
+    def _buffer(self, kind, key, data):
+        self._pending[(kind, str(key))] = None if data is None else json.dumps(data)
+        self._schedule_flush()
+
+    def _schedule_flush(self):
+        if self._flush_task is None or self._flush_task.done():
+            self._flush_task = asyncio.create_task(self._delayed_flush())
+
+    async def _delayed_flush(self):
+        await asyncio.sleep(self.flush_delay)
+        await self._write_pending()
+
+    async def _write_pending(self):
+        async with self._write_lock:
+            if not self._pending and not self._pending_conversations:
+                return
+            pending, self._pending = self._pending, {}
+            conversations, self._pending_conversations = self._pending_conversations, {}
+            self._writing, self._writing_conversations = pending, conversations
+            now = time.time()
+            upserts = [(kind, key, data, now) for (kind, key), data in pending.items() if data is not None]
+            deletes = [(kind, key) for (kind, key), data in pending.items() if data is None]
+            try:
+                await self.store.write_persistence(
+                    upserts, deletes, [(name, key, state) for (name, key), state in conversations.items()])
+            except Exception:
+                logger.exception("Could not write persistence batch, will retry with the next one")
+                self._pending = {**pending, **self._pending}
+                self._pending_conversations = {**conversations, **self._pending_conversations}
+                return
+            finally:
+                self._writing, self._writing_conversations = {}, {}
+            for kind, key, data, updated_at in upserts:
+                self._versions[(kind, key)] = updated_at
+
+    async def update_user_data(self, user_id, data):
+        self._buffer("user", user_id, data)
+
+    async def update_chat_data(self, chat_id, data):
+        self._buffer("chat", chat_id, data)
+
+    async def update_bot_data(self, data):
+        # Handed over after every update (see UpdateDispatcher), so only written when it changed.
+        if json.dumps(data) != self._bot_data:
+            self._bot_data = json.dumps(data)
+            self._buffer("bot", "", data)
+
+    async def update_callback_data(self, data):
+        pass
+
+    async def update_conversation(self, name, key, new_state):
+        state = None if new_state is None else json.dumps(new_state)
+        self._pending_conversations[(name, json.dumps(list(key)))] = state
+        # Written as soon as PTB has handed over the rest of this update's changes.
+        task = asyncio.create_task(self._write_pending())
+        self._conversation_flushes.add(task)
+        task.add_done_callback(self._conversation_flushes.discard)
+
+    async def drop_user_data(self, user_id):
+        self._buffer("user", user_id, None)
+
+    async def drop_chat_data(self, chat_id):
+        self._buffer("chat", chat_id, None)
+
+    # --- Refreshing from other workers ---
+    async def _refresh(self, kind, key, data):
+        key = str(key)
+        if (kind, key) in self._pending or (kind, key) in self._writing:
+            return  # our unflushed copy is the newest
+        row = await self.store.get_persistence_data_if_newer(kind, key, self._versions.get((kind, key), 0))
+        if row:
+            data.clear()
+            data.update(json.loads(row['data']))
+            self._versions[(kind, key)] = row['updated_at']
+
+    async def refresh_user_data(self, user_id, user_data):
+        await self._refresh("user", user_id, user_data)
+
+    async def refresh_chat_data(self, chat_id, chat_data):
+        await self._refresh("chat", chat_id, chat_data)
+
+    async def refresh_bot_data(self, bot_data):
+        pass
+
+    async def refresh_conversations(self, update, handlers):
+        """Loads the sender's current state in each persistent ConversationHandler of `handlers`.
+
+        Another worker may have moved the conversation on, or ended it, since
+        this process last saw it. The states are set without PTB tracking them,
+        so they aren't written back.
+        """
+        wanted = []
+        for handler in handlers:
+            try:
+                key = handler._get_key(update)  # PTB has no public way to build the conversation key
+            except RuntimeError:
+                continue  # no chat or user to key a conversation on
+            stored = (handler.name, json.dumps(list(key)))
+            if stored not in self._pending_conversations and stored not in self._writing_conversations:
+                wanted.append((handler, key, stored))
+        if not wanted:
+            return
+        rows = await self.store.get_conversation_states({s[0] for _, _, s in wanted}, {s[1] for _, _, s in wanted})
+        states = {(row['name'], row['key']): json.loads(row['state']) for row in rows}
+        for handler, key, stored in wanted:
+            conversations = handler._conversations.data
+            if stored in states:
+                conversations[key] = states[stored]
+            else:
+                conversations.pop(key, None)
+
+    async def flush(self):
+        if self._flush_task is not None and not self._flush_task.done():
+            await self._flush_task
+        await asyncio.gather(*self._conversation_flushes)
+        await self._write_pending()
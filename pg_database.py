@@ -0,0 +1,785 @@
+# pg_database.py
+import threading
+import time
+
+import psycopg
+from psycopg.rows import dict_row
+from psycopg_pool import ConnectionPool
+
+import database
+from cache import TTLCache
+
+# PostgreSQL backend with the same functions, arguments and results as
+# database.py (see storage.py for how one is picked). Rows are dicts, read
+# with row['column'] like sqlite3.Row.
+DATABASE_URL = None   # set by storage.py from the environment
+POOL_SIZE = 10        # connections, and threads running the async store's queries
+
+# Same read caches as database.py, invalidated by the same functions.
+admin_cache = TTLCache("admin", maxsize=4096, ttl=300)
+tournament_cache = TTLCache("tournament", maxsize=1024, ttl=30)
+open_tournaments_cache = TTLCache("open_tournaments", maxsize=4, ttl=30)
+CACHES = (admin_cache, tournament_cache, open_tournaments_cache)
+
+_pool = None
+_pool_lock = threading.Lock()
+
+def _get_pool():
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            _pool = ConnectionPool(DATABASE_URL, min_size=1, max_size=POOL_SIZE, name="tournament",
+                                   kwargs={"row_factory": dict_row}, open=True)
+        return _pool
+
+def get_db_connection():
+    """A pooled connection, as a context manager holding one transaction.
+
+    The transaction commits when the block ends and rolls back if it raises.
+    """
+    return _get_pool().connection()
+
+def cache_stats():
+    """Hit/miss counters for every read cache, keyed by cache name."""
+    return {cache.name: cache.stats() for cache in CACHES}
+
+def _invalidate_tournament(tournament_id):
+    tournament_cache.invalidate((tournament_id,))
+    open_tournaments_cache.clear()
+
+def close_db_connections():
+    """Closes the connection pool (call on shutdown); it reopens on next use."""
+    global _pool
+    with _pool_lock:
+        if _pool is not None:
+            _pool.close()
+            _pool = None
+    release_background_lock()
+
+# --- Background Lock ---
+# Every instance on the database serves updates, but the broadcast worker and
+# tournament scheduler must run in just one, or broadcasts and reminders go
+# out once per instance. The one running them holds a session-level advisory
+# lock on a connection of its own, outside the pool; when that connection
+# closes (the instance stops or loses the database) the lock is released and
+# another instance takes over.
+BACKGROUND_LOCK = 0x7f7f0002  # pg_try_advisory_lock key
+_background_conn = None
+
+def acquire_background_lock():
+    """Tries to take the background lock; returns whether this process holds it."""
+    global _background_conn
+    if holds_background_lock():
+        return True
+    conn = psycopg.connect(DATABASE_URL, autocommit=True)
+    try:
+        locked = conn.execute("SELECT pg_try_advisory_lock(%s)", (BACKGROUND_LOCK,)).fetchone()[0]
+    except psycopg.Error:
+        conn.close()
+        raise
+    if not locked:
+        conn.close()
+        return False
+    _background_conn = conn
+    return True
+
+def holds_background_lock():
+    """Whether the connection holding the background lock is still alive."""
+    global _background_conn
+    if _background_conn is None:
+        return False
+    try:
+        _background_conn.execute("SELECT 1")
+        return True
+    except psycopg.Error:
+        release_background_lock()
+        return False
+
+def release_background_lock():
+    global _background_conn
+    if _background_conn is not None:
+        _background_conn.close()
+        _background_conn = None
+
+# --- Schema Migrations ---
+# Same scheme as database.py: migration N brings the schema from version N-1
+# to N in its own transaction. Migration 1 is the schema database.py reaches
+# at its version 11; later changes are added to both.
+MIGRATION_LOCK = 0x7f7f0001  # pg_advisory_xact_lock key, so processes starting together migrate once
+
+def _migration_1_schema(c):
+    c.execute("CREATE TABLE schema_version (version INTEGER NOT NULL)")
+    c.execute('''
+        CREATE TABLE users (
+            telegram_id BIGINT PRIMARY KEY,
+            ff_username TEXT,
+            ff_userid TEXT,
+            is_admin INTEGER NOT NULL DEFAULT 0,
+            is_blocked INTEGER NOT NULL DEFAULT 0,
+            last_seen DOUBLE PRECISION,
+            preferred_mode TEXT
+        )
+    ''')
+    c.execute("CREATE INDEX idx_users_last_seen ON users (last_seen) WHERE is_blocked = 0")
+    c.execute("CREATE INDEX idx_users_preferred_mode ON users (preferred_mode) WHERE is_blocked = 0")
+    c.execute('''
+        CREATE TABLE tournaments (
+            id BIGINT GENERATED BY DEFAULT AS IDENTITY PRIMARY KEY,
+            mode TEXT NOT NULL,          -- 'BR' or 'CS'
+            date_time TEXT NOT NULL,
+            fee INTEGER NOT NULL,
+            max_players INTEGER NOT NULL,
+            status TEXT DEFAULT 'OPEN', -- 'OPEN', 'FULL', 'IN_PROGRESS', 'FINISHED'
+            room_id TEXT,
+            room_password TEXT,
+            registered_count INTEGER NOT NULL DEFAULT 0,
+            starts_at DOUBLE PRECISION,
+            next_event TEXT,             -- 'REMIND', 'CLOSE', 'ARCHIVE' or NULL
+            next_event_at DOUBLE PRECISION,
+            team_size INTEGER NOT NULL DEFAULT 1
+        )
+    ''')
+    c.execute("CREATE INDEX idx_tournaments_status ON tournaments (status)")
+    c.execute("CREATE INDEX idx_tournaments_next_event ON tournaments (next_event_at) WHERE next_event IS NOT NULL")
+    c.execute("CREATE INDEX idx_tournaments_starts_at ON tournaments (starts_at)")
+    # Team names are unique per tournament regardless of case (COLLATE NOCASE in SQLite).
+    c.execute('''
+        CREATE TABLE teams (
+            id BIGINT GENERATED BY DEFAULT AS IDENTITY PRIMARY KEY,
+            tournament_id BIGINT NOT NULL REFERENCES tournaments (id),
+            name TEXT NOT NULL,
+            captain_id BIGINT NOT NULL REFERENCES users (telegram_id)
+        )
+    ''')
+    c.execute("CREATE UNIQUE INDEX idx_teams_name ON teams (tournament_id, lower(name))")
+    c.execute('''
+        CREATE TABLE team_members (
+            id BIGINT GENERATED BY DEFAULT AS IDENTITY PRIMARY KEY,  -- keeps the roster order
+            team_id BIGINT NOT NULL REFERENCES teams (id),
+            tournament_id BIGINT NOT NULL,
+            ff_username TEXT NOT NULL,
+            ff_userid TEXT NOT NULL,
+            UNIQUE (tournament_id, ff_userid)
+        )
+    ''')
+    c.execute("CREATE INDEX idx_team_members_team ON team_members (team_id)")
+    c.execute('''
+        CREATE TABLE registrations (
+            id BIGINT GENERATED BY DEFAULT AS IDENTITY PRIMARY KEY,
+            tournament_id BIGINT NOT NULL REFERENCES tournaments (id),
+            telegram_id BIGINT NOT NULL REFERENCES users (telegram_id),
+            team_id BIGINT REFERENCES teams (id),
+            slots INTEGER NOT NULL DEFAULT 1
+        )
+    ''')
+    c.execute("CREATE UNIQUE INDEX idx_registrations_unique ON registrations (tournament_id, telegram_id)")
+    c.execute("CREATE INDEX idx_registrations_telegram_id ON registrations (telegram_id)")
+    c.execute("CREATE INDEX idx_registrations_tournament_page ON registrations (tournament_id, id)")
+    c.execute('''
+        CREATE TABLE payments (
+            registration_id BIGINT PRIMARY KEY REFERENCES registrations (id),
+            tournament_id BIGINT NOT NULL REFERENCES tournaments (id),
+            telegram_id BIGINT NOT NULL,
+            amount INTEGER NOT NULL,
+            status TEXT NOT NULL DEFAULT 'UNPAID', -- 'UNPAID', 'PAID'
+            paid_at DOUBLE PRECISION,
+            marked_by BIGINT
+        )
+    ''')
+    c.execute("CREATE INDEX idx_payments_tournament_status ON payments (tournament_id, status, amount)")
+    c.execute('''
+        CREATE TABLE broadcast_jobs (
+            id BIGINT GENERATED BY DEFAULT AS IDENTITY PRIMARY KEY,
+            text TEXT NOT NULL,
+            parse_mode TEXT,
+            status TEXT DEFAULT 'PENDING', -- 'PENDING', 'DONE', 'CANCELLED'
+            admin_chat_id BIGINT,
+            status_message_id BIGINT,
+            created_at TIMESTAMPTZ DEFAULT now(),
+            send_at DOUBLE PRECISION,
+            tournament_id BIGINT REFERENCES tournaments (id)
+        )
+    ''')
+    c.execute("CREATE INDEX idx_broadcast_jobs_pending_tournament ON broadcast_jobs (tournament_id) WHERE status = 'PENDING'")
+    c.execute('''
+        CREATE TABLE broadcast_deliveries (
+            job_id BIGINT NOT NULL REFERENCES broadcast_jobs (id),
+            telegram_id BIGINT NOT NULL,
+            status TEXT DEFAULT 'PENDING', -- 'PENDING', 'SENT', 'BLOCKED', 'FAILED'
+            delivered_at DOUBLE PRECISION,
+            PRIMARY KEY (job_id, telegram_id)
+        )
+    ''')
+    c.execute("CREATE INDEX idx_broadcast_deliveries_status ON broadcast_deliveries (job_id, status)")
+    c.execute('''
+        CREATE TABLE persistence_data (
+            kind TEXT NOT NULL,          -- 'user', 'chat' or 'bot'
+            key TEXT NOT NULL,
+            data TEXT NOT NULL,
+            updated_at DOUBLE PRECISION NOT NULL,
+            PRIMARY KEY (kind, key)
+        )
+    ''')
+    c.execute('''
+        CREATE TABLE conversation_states (
+            name TEXT NOT NULL,
+            key TEXT NOT NULL,           -- JSON list, e.g. [chat_id, user_id]
+            state TEXT NOT NULL,         -- JSON-encoded state
+            PRIMARY KEY (name, key)
+        )
+    ''')
+
+MIGRATIONS = [
+    _migration_1_schema,
+]
+SCHEMA_VERSION = len(MIGRATIONS)
+
+def get_schema_version(conn):
+    if conn.execute("SELECT to_regclass('schema_version') AS name").fetchone()['name'] is None:
+        return 0  # a new database
+    row = conn.execute("SELECT version FROM schema_version").fetchone()
+    return row['version'] if row else 0
+
+def setup_database():
+    """Creates the tables and applies any schema migrations not yet run.
+
+    An up-to-date database costs a single round trip, so this is cheap to
+    call on every start.
+    """
+    with get_db_connection() as conn:
+        if get_schema_version(conn) == len(MIGRATIONS):
+            return
+    while True:
+        with get_db_connection() as conn:
+            conn.execute("SELECT pg_advisory_xact_lock(%s)", (MIGRATION_LOCK,))
+            version = get_schema_version(conn)  # another process may have got here first
+            if version == len(MIGRATIONS):
+                break
+            migration = MIGRATIONS[version]
+            c = conn.cursor()
+            migration(c)
+            c.execute("DELETE FROM schema_version")
+            c.execute("INSERT INTO schema_version (version) VALUES (%s)", (version + 1,))
+        print(f"Applied database migration {version + 1}: {migration.__name__}")
+    print("Database setup complete.")
+
+# --- User Functions ---
+USER_UPSERT = '''
+    INSERT INTO users (telegram_id, ff_username, ff_userid, last_seen) VALUES (%s, %s, %s, %s)
+    ON CONFLICT (telegram_id) DO UPDATE SET
+        ff_username = COALESCE(excluded.ff_username, users.ff_username),
+        ff_userid = COALESCE(excluded.ff_userid, users.ff_userid),
+        is_blocked = 0,
+        last_seen = GREATEST(users.last_seen, excluded.last_seen)
+'''
+
+def add_or_update_user(telegram_id, ff_username=None, ff_userid=None):
+    """Creates or updates a user and records that they were just seen."""
+    with get_db_connection() as conn:
+        conn.execute(USER_UPSERT, (telegram_id, ff_username, ff_userid, time.time()))
+
+def add_or_update_users(users):
+    """Upserts a batch of (telegram_id, ff_username, ff_userid, last_seen) rows in one transaction."""
+    # In id order, so batches running at once lock their rows in the same order.
+    with get_db_connection() as conn:
+        conn.cursor().executemany(USER_UPSERT, sorted(users, key=lambda user: user[0]))
+
+def get_user(telegram_id):
+    with get_db_connection() as conn:
+        return conn.execute("SELECT * FROM users WHERE telegram_id = %s", (telegram_id,)).fetchone()
+
+def get_all_user_ids():
+    with get_db_connection() as conn:
+        return [row['telegram_id'] for row in conn.execute("SELECT telegram_id FROM users WHERE is_blocked = 0")]
+
+@admin_cache.cached
+def is_admin(telegram_id):
+    user = get_user(telegram_id)
+    return user and user['is_admin'] == 1
+
+def grant_admin(telegram_id):
+    with get_db_connection() as conn:
+        conn.execute('''
+            INSERT INTO users (telegram_id, is_admin) VALUES (%s, 1)
+            ON CONFLICT (telegram_id) DO UPDATE SET is_admin = 1
+        ''', (telegram_id,))
+    admin_cache.invalidate((telegram_id,))
+
+# --- Tournament Functions ---
+def add_tournament(mode, date_time, fee, max_players, starts_at=None, next_event=None, next_event_at=None, team_size=1):
+    with get_db_connection() as conn:
+        tournament_id = conn.execute('''
+            INSERT INTO tournaments (mode, date_time, fee, max_players, starts_at, next_event, next_event_at, team_size)
+            VALUES (%s, %s, %s, %s, %s, %s, %s, %s) RETURNING id
+        ''', (mode, date_time, fee, max_players, starts_at, next_event, next_event_at, team_size)).fetchone()['id']
+    _invalidate_tournament(tournament_id)
+
+@open_tournaments_cache.cached
+def get_open_tournaments():
+    with get_db_connection() as conn:
+        return conn.execute("SELECT * FROM tournaments WHERE status = 'OPEN' ORDER BY id").fetchall()
+
+def _keyset_page(query, params, after_id, before_id, limit):
+    """Runs `query` for one page, as database._keyset_page does (`{op} %s` on the key, ORDER BY key)."""
+    with get_db_connection() as conn:
+        if before_id is not None:
+            return conn.execute(f"{query.format(op='<')} DESC LIMIT %s", (*params, before_id, limit)).fetchall()[::-1]
+        return conn.execute(f"{query.format(op='>')} LIMIT %s", (*params, after_id, limit)).fetchall()
+
+def get_open_tournaments_page(after_id=0, before_id=None, limit=10):
+    """One page of open tournaments, in id order; the first page is cached (see database.py)."""
+    if not after_id and before_id is None:
+        return _first_open_tournaments_page(limit)
+    return _keyset_page("SELECT * FROM tournaments WHERE status = 'OPEN' AND id {op} %s ORDER BY id",
+                        (), after_id, before_id, limit)
+
+@open_tournaments_cache.cached
+def _first_open_tournaments_page(limit):
+    return _keyset_page("SELECT * FROM tournaments WHERE status = 'OPEN' AND id {op} %s ORDER BY id",
+                        (), 0, None, limit)
+
+@tournament_cache.cached
+def get_tournament_details(tournament_id):
+    with get_db_connection() as conn:
+        return conn.execute("SELECT * FROM tournaments WHERE id = %s", (tournament_id,)).fetchone()
+
+def set_room_details(tournament_id, room_id, room_password):
+    with get_db_connection() as conn:
+        conn.execute("UPDATE tournaments SET room_id = %s, room_password = %s WHERE id = %s",
+                     (room_id, room_password, tournament_id))
+    _invalidate_tournament(tournament_id)
+
+# --- Tournament Lifecycle Functions ---
+def get_next_tournament_event_time():
+    with get_db_connection() as conn:
+        return conn.execute("SELECT MIN(next_event_at) AS at FROM tournaments WHERE next_event IS NOT NULL").fetchone()['at']
+
+def get_due_tournament_events(now, limit=100):
+    with get_db_connection() as conn:
+        return conn.execute('''
+            SELECT * FROM tournaments
+            WHERE next_event IS NOT NULL AND next_event_at <= %s
+            ORDER BY next_event_at
+            LIMIT %s
+        ''', (now, limit)).fetchall()
+
+def advance_tournament_event(tournament_id, event, status, next_event, next_event_at):
+    """Records that `event` ran, sets `status` (unless None) and schedules the event after it."""
+    with get_db_connection() as conn:
+        conn.execute('''
+            UPDATE tournaments SET status = COALESCE(%s, status), next_event = %s, next_event_at = %s
+            WHERE id = %s AND next_event = %s
+        ''', (status, next_event, next_event_at, tournament_id, event))
+    _invalidate_tournament(tournament_id)
+
+def get_unscheduled_tournaments():
+    with get_db_connection() as conn:
+        return conn.execute("SELECT id, date_time FROM tournaments WHERE starts_at IS NULL AND status != 'FINISHED'").fetchall()
+
+def set_tournament_schedule(tournament_id, starts_at, next_event, next_event_at):
+    with get_db_connection() as conn:
+        conn.execute("UPDATE tournaments SET starts_at = %s, next_event = %s, next_event_at = %s WHERE id = %s",
+                     (starts_at, next_event, next_event_at, tournament_id))
+    _invalidate_tournament(tournament_id)
+
+# --- Registration Functions ---
+# Registering locks the tournament's row first (SELECT ... FOR UPDATE), which
+# serializes registrations for that tournament the way BEGIN IMMEDIATE does
+# for the whole SQLite file, while other tournaments' go ahead in parallel.
+TOURNAMENT_FOR_UPDATE = "SELECT status, registered_count, max_players, fee, mode, team_size FROM tournaments WHERE id = %s FOR UPDATE"
+
+def register_user_for_tournament(tournament_id, telegram_id):
+    """Takes a slot in a tournament, returning 'SUCCESS', 'ALREADY_REGISTERED', 'FULL' or 'CLOSED'."""
+    with get_db_connection() as conn:
+        c = conn.cursor()
+        tournament = c.execute(TOURNAMENT_FOR_UPDATE, (tournament_id,)).fetchone()
+        c.execute("SELECT 1 FROM registrations WHERE tournament_id = %s AND telegram_id = %s", (tournament_id, telegram_id))
+        if c.fetchone():
+            return "ALREADY_REGISTERED"
+        if not tournament or tournament['status'] not in ('OPEN', 'FULL'):
+            return "CLOSED"
+        if tournament['status'] == 'FULL' or tournament['registered_count'] >= tournament['max_players']:
+            return "FULL"
+        c.execute("INSERT INTO registrations (tournament_id, telegram_id) VALUES (%s, %s) RETURNING id",
+                  (tournament_id, telegram_id))
+        registration_id = c.fetchone()['id']
+        if tournament['fee'] > 0:
+            c.execute("INSERT INTO payments (registration_id, tournament_id, telegram_id, amount) VALUES (%s, %s, %s, %s)",
+                      (registration_id, tournament_id, telegram_id, tournament['fee']))
+        c.execute("UPDATE users SET preferred_mode = %s WHERE telegram_id = %s", (tournament['mode'], telegram_id))
+        if tournament['fee'] == 0:
+            c.execute('''
+                INSERT INTO broadcast_deliveries (job_id, telegram_id)
+                SELECT id, %s FROM broadcast_jobs WHERE tournament_id = %s AND status = 'PENDING'
+                ON CONFLICT DO NOTHING
+            ''', (telegram_id, tournament_id))
+        c.execute('''
+            UPDATE tournaments
+            SET registered_count = registered_count + 1,
+                status = CASE WHEN registered_count + 1 >= max_players THEN 'FULL' ELSE status END
+            WHERE id = %s
+        ''', (tournament_id,))
+    _invalidate_tournament(tournament_id)
+    return "SUCCESS"
+
+def register_team(tournament_id, captain_id, team_name, members):
+    """Registers a whole team in one transaction; see database.register_team."""
+    with get_db_connection() as conn:
+        c = conn.cursor()
+        tournament = c.execute(TOURNAMENT_FOR_UPDATE, (tournament_id,)).fetchone()
+        c.execute("SELECT 1 FROM registrations WHERE tournament_id = %s AND telegram_id = %s", (tournament_id, captain_id))
+        if c.fetchone():
+            return "ALREADY_REGISTERED"
+        if not tournament or tournament['status'] not in ('OPEN', 'FULL'):
+            return "CLOSED"
+        slots = tournament['team_size']
+        if tournament['status'] == 'FULL' or tournament['registered_count'] + slots > tournament['max_players']:
+            return "FULL"
+        c.execute("SELECT 1 FROM teams WHERE tournament_id = %s AND lower(name) = lower(%s)", (tournament_id, team_name))
+        if c.fetchone():
+            return "NAME_TAKEN"
+        c.execute("SELECT 1 FROM team_members WHERE tournament_id = %s AND ff_userid = ANY(%s)",
+                  (tournament_id, [ff_userid for _, ff_userid in members]))
+        if c.fetchone():
+            return "PLAYER_TAKEN"
+        c.execute(USER_UPSERT, (captain_id, *members[0], time.time()))
+        c.execute("INSERT INTO teams (tournament_id, name, captain_id) VALUES (%s, %s, %s) RETURNING id",
+                  (tournament_id, team_name, captain_id))
+        team_id = c.fetchone()['id']
+        c.executemany("INSERT INTO team_members (team_id, tournament_id, ff_username, ff_userid) VALUES (%s, %s, %s, %s)",
+                      [(team_id, tournament_id, ff_username, ff_userid) for ff_username, ff_userid in members])
+        c.execute("INSERT INTO registrations (tournament_id, telegram_id, team_id, slots) VALUES (%s, %s, %s, %s) RETURNING id",
+                  (tournament_id, captain_id, team_id, slots))
+        registration_id = c.fetchone()['id']
+        if tournament['fee'] > 0:
+            c.execute("INSERT INTO payments (registration_id, tournament_id, telegram_id, amount) VALUES (%s, %s, %s, %s)",
+                      (registration_id, tournament_id, captain_id, tournament['fee'] * len(members)))
+        c.execute("UPDATE users SET preferred_mode = %s WHERE telegram_id = %s", (tournament['mode'], captain_id))
+        if tournament['fee'] == 0:
+            c.execute('''
+                INSERT INTO broadcast_deliveries (job_id, telegram_id)
+                SELECT id, %s FROM broadcast_jobs WHERE tournament_id = %s AND status = 'PENDING'
+                ON CONFLICT DO NOTHING
+            ''', (captain_id, tournament_id))
+        # FULL once there is no room left for another team.
+        c.execute('''
+            UPDATE tournaments
+            SET registered_count = registered_count + %s,
+                status = CASE WHEN registered_count + %s + team_size > max_players THEN 'FULL' ELSE status END
+            WHERE id = %s
+        ''', (slots, slots, tournament_id))
+    _invalidate_tournament(tournament_id)
+    return "SUCCESS"
+
+def get_team_members(team_ids):
+    """Members of several teams in one query, as {team_id: [rows]} in the order they were given."""
+    if not team_ids:
+        return {}
+    with get_db_connection() as conn:
+        rows = conn.execute('''
+            SELECT team_id, ff_username, ff_userid FROM team_members
+            WHERE team_id = ANY(%s) ORDER BY team_id, id
+        ''', (list(team_ids),)).fetchall()
+    members = {}
+    for row in rows:
+        members.setdefault(row['team_id'], []).append(row)
+    return members
+
+def get_registrations_for_tournament(tournament_id):
+    with get_db_connection() as conn:
+        return conn.execute('''
+            SELECT u.telegram_id, u.ff_username, u.ff_userid
+            FROM registrations r
+            JOIN users u ON r.telegram_id = u.telegram_id
+            WHERE r.tournament_id = %s
+        ''', (tournament_id,)).fetchall()
+
+def get_registrations_page(tournament_id, after_id=0, before_id=None, limit=20):
+    """One page of a tournament's registrations, in registration order."""
+    return _keyset_page('''
+        SELECT r.id, u.telegram_id, u.ff_username, u.ff_userid, r.team_id, t.name AS team_name
+        FROM registrations r
+        JOIN users u ON r.telegram_id = u.telegram_id
+        LEFT JOIN teams t ON t.id = r.team_id
+        WHERE r.tournament_id = %s AND r.id {op} %s
+        ORDER BY r.id
+    ''', (tournament_id,), after_id, before_id, limit)
+
+# --- Bulk Export/Import Functions ---
+def iter_registrations(tournament_id, batch_size=1000):
+    """Yields a tournament's registrations in registration order, fetching `batch_size` rows at a time."""
+    with get_db_connection() as conn:
+        with conn.cursor(name="iter_registrations") as c:  # server-side, so rows stream
+            c.itersize = batch_size
+            c.execute('''
+                SELECT u.telegram_id, u.ff_username, u.ff_userid
+                FROM registrations r
+                JOIN users u ON r.telegram_id = u.telegram_id
+                WHERE r.tournament_id = %s
+                ORDER BY r.id
+            ''', (tournament_id,))
+            yield from c
+
+def import_registrations(tournament_id, players):
+    """Registers (telegram_id, ff_username, ff_userid) rows for a tournament in one transaction.
+
+    See database.import_registrations. Returns (newly registered, rows read).
+    """
+    telegram_ids = []
+
+    def users():
+        for telegram_id, ff_username, ff_userid in players:
+            telegram_ids.append(telegram_id)
+            yield telegram_id, ff_username, ff_userid
+
+    with get_db_connection() as conn:
+        c = conn.cursor()
+        c.execute("SELECT team_size FROM tournaments WHERE id = %s FOR UPDATE", (tournament_id,))
+        tournament = c.fetchone()
+        if tournament and tournament['team_size'] > 1:
+            raise ValueError("this is a team tournament; captains register their teams with /register")
+        c.executemany('''
+            INSERT INTO users (telegram_id, ff_username, ff_userid) VALUES (%s, %s, %s)
+            ON CONFLICT (telegram_id) DO UPDATE SET ff_username = COALESCE(excluded.ff_username, users.ff_username),
+                                                    ff_userid = COALESCE(excluded.ff_userid, users.ff_userid)
+        ''', users())
+        c.executemany("INSERT INTO registrations (tournament_id, telegram_id) VALUES (%s, %s) ON CONFLICT DO NOTHING",
+                      ((tournament_id, telegram_id) for telegram_id in telegram_ids))
+        registered = c.rowcount
+        c.execute('''
+            INSERT INTO payments (registration_id, tournament_id, telegram_id, amount)
+            SELECT r.id, r.tournament_id, r.telegram_id, t.fee
+            FROM registrations r JOIN tournaments t ON t.id = r.tournament_id
+            WHERE r.tournament_id = %s AND t.fee > 0
+            ON CONFLICT DO NOTHING
+        ''', (tournament_id,))
+        c.execute('''
+            UPDATE users SET preferred_mode = (SELECT mode FROM tournaments WHERE id = %s)
+            WHERE telegram_id IN (SELECT telegram_id FROM registrations WHERE tournament_id = %s)
+        ''', (tournament_id, tournament_id))
+        c.execute('''
+            INSERT INTO broadcast_deliveries (job_id, telegram_id)
+            SELECT j.id, p.telegram_id FROM broadcast_jobs j
+            JOIN ({}) p ON TRUE
+            WHERE j.tournament_id = %s AND j.status = 'PENDING'
+            ON CONFLICT DO NOTHING
+        '''.format(SEGMENT_QUERIES["paid"]), (tournament_id, tournament_id))
+        c.execute('''
+            UPDATE tournaments
+            SET registered_count = (SELECT COALESCE(SUM(slots), 0) FROM registrations r WHERE r.tournament_id = tournaments.id),
+                status = CASE WHEN status = 'OPEN' AND
+                    (SELECT COALESCE(SUM(slots), 0) FROM registrations r WHERE r.tournament_id = tournaments.id) >= max_players
+                    THEN 'FULL' ELSE status END
+            WHERE id = %s
+        ''', (tournament_id,))
+    _invalidate_tournament(tournament_id)
+    return registered, len(telegram_ids)
+
+# --- Payment Functions ---
+def mark_payments(tournament_id, ff_userids, paid=True, marked_by=None):
+    """Marks the players with these Free Fire user ids paid (or unpaid again), in one transaction.
+
+    See database.mark_payments; returns (changed, unchanged, unknown).
+    """
+    status = 'PAID' if paid else 'UNPAID'
+    with get_db_connection() as conn:
+        c = conn.cursor()
+        # Locked like a registration, so a player can't register between the
+        # ledger read and the room details being updated.
+        c.execute("SELECT 1 FROM tournaments WHERE id = %s FOR UPDATE", (tournament_id,))
+        c.execute('''
+            SELECT p.registration_id, p.telegram_id, p.status, u.ff_userid
+            FROM payments p JOIN users u ON u.telegram_id = p.telegram_id
+            WHERE p.tournament_id = %s
+            UNION
+            SELECT p.registration_id, p.telegram_id, p.status, m.ff_userid
+            FROM payments p JOIN registrations r ON r.id = p.registration_id
+            JOIN team_members m ON m.team_id = r.team_id
+            WHERE p.tournament_id = %s
+        ''', (tournament_id, tournament_id))
+        by_ff_userid = {}
+        for row in c.fetchall():
+            by_ff_userid.setdefault(row['ff_userid'], []).append(row)
+        changed, unchanged, unknown, updates = [], [], [], {}
+        for ff_userid in dict.fromkeys(ff_userids):
+            rows = by_ff_userid.get(ff_userid)
+            if not rows:
+                unknown.append(ff_userid)
+                continue
+            pending = [row for row in rows if row['status'] != status]
+            (changed if pending else unchanged).append(ff_userid)
+            updates.update((row['registration_id'], row) for row in pending)
+        updates = list(updates.values())
+        if updates:
+            c.executemany("UPDATE payments SET status = %s, paid_at = %s, marked_by = %s WHERE registration_id = %s",
+                          [(status, time.time() if paid else None, marked_by, row['registration_id']) for row in updates])
+            telegram_ids = [row['telegram_id'] for row in updates]
+            if paid:
+                c.execute('''
+                    INSERT INTO broadcast_deliveries (job_id, telegram_id)
+                    SELECT j.id, p.telegram_id FROM broadcast_jobs j, unnest(%s::bigint[]) AS p (telegram_id)
+                    WHERE j.tournament_id = %s AND j.status = 'PENDING'
+                    ON CONFLICT DO NOTHING
+                ''', (telegram_ids, tournament_id))
+            else:
+                c.execute('''
+                    DELETE FROM broadcast_deliveries WHERE telegram_id = ANY(%s) AND status = 'PENDING' AND job_id IN
+                        (SELECT id FROM broadcast_jobs WHERE tournament_id = %s AND status = 'PENDING')
+                ''', (telegram_ids, tournament_id))
+    return changed, unchanged, unknown
+
+def get_payment_summary(tournament_id):
+    """Players and amount per payment status, e.g. {'PAID': {'players': 3, 'amount': 150}, 'UNPAID': ...}."""
+    with get_db_connection() as conn:
+        rows = conn.execute('''
+            SELECT status, COUNT(*) AS players, SUM(amount) AS amount
+            FROM payments WHERE tournament_id = %s GROUP BY status
+        ''', (tournament_id,)).fetchall()
+    summary = {status: {"players": 0, "amount": 0} for status in ('PAID', 'UNPAID')}
+    for row in rows:
+        summary[row['status']] = {"players": row['players'], "amount": row['amount']}
+    return summary
+
+def get_unpaid_players(tournament_id, limit=50):
+    with get_db_connection() as conn:
+        return conn.execute('''
+            SELECT u.telegram_id, u.ff_username, u.ff_userid, t.name AS team_name
+            FROM payments p JOIN users u ON u.telegram_id = p.telegram_id
+            LEFT JOIN registrations r ON r.id = p.registration_id
+            LEFT JOIN teams t ON t.id = r.team_id
+            WHERE p.tournament_id = %s AND p.status = 'UNPAID'
+            ORDER BY p.registration_id
+            LIMIT %s
+        ''', (tournament_id, limit)).fetchall()
+
+# --- Broadcast Audience Functions ---
+# The audiences of database.SEGMENT_QUERIES, which are plain SQL, with
+# psycopg's placeholders.
+SEGMENT_QUERIES = {kind: query.replace("?", "%s") for kind, query in database.SEGMENT_QUERIES.items()}
+
+def _segment_query(segment):
+    kind, arg = segment
+    if kind == "active":
+        arg = time.time() - arg * 86400  # `arg` is a number of days
+    return SEGMENT_QUERIES[kind], (() if arg is None else (arg,))
+
+def count_segment(segment):
+    query, params = _segment_query(segment)
+    with get_db_connection() as conn:
+        return conn.execute(f"SELECT COUNT(*) AS count FROM ({query}) AS segment", params).fetchone()['count']
+
+# --- Broadcast Job Functions ---
+def create_broadcast_job(text, parse_mode=None, recipient_ids=None, admin_chat_id=None, status_message_id=None,
+                         send_at=None, tournament_id=None, segment=("all", None)):
+    """Queues a broadcast to `recipient_ids`, or else to everyone in `segment`; see database.create_broadcast_job."""
+    with get_db_connection() as conn:
+        c = conn.cursor()
+        c.execute('''
+            INSERT INTO broadcast_jobs (text, parse_mode, admin_chat_id, status_message_id, send_at, tournament_id)
+            VALUES (%s, %s, %s, %s, %s, %s) RETURNING id
+        ''', (text, parse_mode, admin_chat_id, status_message_id, time.time() if send_at is None else send_at, tournament_id))
+        job_id = c.fetchone()['id']
+        if recipient_ids is None:
+            query, params = _segment_query(segment)
+            c.execute(f'''
+                INSERT INTO broadcast_deliveries (job_id, telegram_id) SELECT %s, telegram_id FROM ({query}) AS segment
+                ON CONFLICT DO NOTHING
+            ''', (job_id, *params))
+        else:
+            # The whole list as one array parameter instead of a statement per recipient.
+            c.execute('''
+                INSERT INTO broadcast_deliveries (job_id, telegram_id) SELECT %s, telegram_id FROM unnest(%s::bigint[]) AS telegram_id
+                ON CONFLICT DO NOTHING
+            ''', (job_id, list(recipient_ids)))
+    return job_id
+
+def get_unfinished_broadcast_jobs():
+    with get_db_connection() as conn:
+        return conn.execute("SELECT * FROM broadcast_jobs WHERE status = 'PENDING' ORDER BY send_at, id").fetchall()
+
+def get_broadcast_job(job_id):
+    with get_db_connection() as conn:
+        return conn.execute("SELECT * FROM broadcast_jobs WHERE id = %s", (job_id,)).fetchone()
+
+def cancel_scheduled_tournament_jobs(tournament_id):
+    """Cancels a tournament's broadcasts that haven't reached their send time; returns how many."""
+    with get_db_connection() as conn:
+        return conn.execute(
+            "UPDATE broadcast_jobs SET status = 'CANCELLED' WHERE tournament_id = %s AND status = 'PENDING' AND send_at > %s",
+            (tournament_id, time.time())).rowcount
+
+def get_pending_deliveries(job_id, limit):
+    with get_db_connection() as conn:
+        rows = conn.execute("SELECT telegram_id FROM broadcast_deliveries WHERE job_id = %s AND status = 'PENDING' LIMIT %s",
+                            (job_id, limit))
+        return [row['telegram_id'] for row in rows]
+
+def record_deliveries(job_id, results):
+    """Stores (telegram_id, status, delivered_at) results for a job and marks blocked users."""
+    results = list(results)
+    with get_db_connection() as conn:
+        c = conn.cursor()
+        c.executemany("UPDATE broadcast_deliveries SET status = %s, delivered_at = %s WHERE job_id = %s AND telegram_id = %s",
+                      [(status, delivered_at, job_id, telegram_id) for telegram_id, status, delivered_at in results])
+        blocked = [telegram_id for telegram_id, status, delivered_at in results if status == 'BLOCKED']
+        if blocked:
+            c.execute("UPDATE users SET is_blocked = 1 WHERE telegram_id = ANY(%s)", (blocked,))
+
+def get_broadcast_job_counts(job_id):
+    with get_db_connection() as conn:
+        rows = conn.execute("SELECT status, COUNT(*) AS count FROM broadcast_deliveries WHERE job_id = %s GROUP BY status",
+                            (job_id,)).fetchall()
+    counts = {'PENDING': 0, 'SENT': 0, 'BLOCKED': 0, 'FAILED': 0}
+    counts.update({row['status']: row['count'] for row in rows})
+    return counts
+
+def finish_broadcast_job(job_id):
+    """Marks a job DONE, unless it was cancelled in the meantime."""
+    with get_db_connection() as conn:
+        conn.execute("UPDATE broadcast_jobs SET status = 'DONE' WHERE id = %s AND status = 'PENDING'", (job_id,))
+
+def get_delivery_latency(job_id):
+    """Median and slowest time from a job's send time to each delivered message, in seconds."""
+    with get_db_connection() as conn:
+        stats = conn.execute('''
+            SELECT COUNT(*) AS count, MAX(d.delivered_at - j.send_at) AS max,
+                   percentile_disc(0.5) WITHIN GROUP (ORDER BY d.delivered_at - j.send_at) AS median
+            FROM broadcast_deliveries d JOIN broadcast_jobs j ON j.id = d.job_id
+            WHERE d.job_id = %s AND d.status = 'SENT' AND d.delivered_at IS NOT NULL
+        ''', (job_id,)).fetchone()
+    return dict(stats)
+
+# --- Bot Persistence Functions ---
+def load_persistence_data(kind):
+    with get_db_connection() as conn:
+        return conn.execute("SELECT key, data, updated_at FROM persistence_data WHERE kind = %s", (kind,)).fetchall()
+
+def get_persistence_data_if_newer(kind, key, updated_after):
+    with get_db_connection() as conn:
+        return conn.execute("SELECT data, updated_at FROM persistence_data WHERE kind = %s AND key = %s AND updated_at > %s",
+                            (kind, key, updated_after)).fetchone()
+
+def load_conversation_states(name):
+    with get_db_connection() as conn:
+        return conn.execute("SELECT key, state FROM conversation_states WHERE name = %s", (name,)).fetchall()
+
+def get_conversation_states(names, keys):
+    with get_db_connection() as conn:
+        return conn.execute("SELECT name, key, state FROM conversation_states WHERE name = ANY(%s) AND key = ANY(%s)",
+                            (list(names), list(keys))).fetchall()
+
+def write_persistence(upserts, deletes, conversation_states):
+    """Writes a batch of buffered persistence changes in one transaction; see database.write_persistence."""
+    with get_db_connection() as conn:
+        c = conn.cursor()
+        c.executemany('''
+            INSERT INTO persistence_data (kind, key, data, updated_at) VALUES (%s, %s, %s, %s)
+            ON CONFLICT (kind, key) DO UPDATE SET data = excluded.data, updated_at = excluded.updated_at
+        ''', upserts)
+        c.executemany("DELETE FROM persistence_data WHERE kind = %s AND key = %s", deletes)
+        c.executemany("DELETE FROM conversation_states WHERE name = %s AND key = %s",
+                      [(name, key) for name, key, state in conversation_states if state is None])
+        c.executemany('''
+            INSERT INTO conversation_states (name, key, state) VALUES (%s, %s, %s)
+            ON CONFLICT (name, key) DO UPDATE SET state = excluded.state
+        ''', [(name, key, state) for name, key, state in conversation_states if state is not None])
@@ -0,0 +1,90 @@
+# player_lists.py
+import codecs
+import csv
+import io
+import json
+
+from storage import db
+
+# Exported files use these columns, and imported files must have them, so an
+# export can be edited and imported again.
+FIELDS = ("telegram_id", "ff_username", "ff_userid")
+FORMATS = ("csv", "json")
+CHUNK_SIZE = 64 * 1024  # characters of export text encoded into the output at a time
+
+
+def export_registrations(tournament_id, fmt, out):
+    """Streams a tournament's registrations into the binary file `out` as CSV or JSON.
+
+    Rows go from the database cursor straight to `out` one at a time, so the
+    full list is never held in memory. Returns the number of rows written.
+    `out` only needs a write() method: text is encoded in chunks rather than
+    through io.TextIOWrapper, which before Python 3.11 can't wrap a
+    SpooledTemporaryFile.
+    """
+    text = io.StringIO()
+
+    def spill(final=False):
+        if final or text.tell() >= CHUNK_SIZE:
+            out.write(text.getvalue().encode("utf-8"))
+            text.seek(0)
+            text.truncate()
+
+    count = 0
+    if fmt == "csv":
+        writer = csv.writer(text)
+        writer.writerow(FIELDS)
+        for row in db.iter_registrations(tournament_id):
+            writer.writerow([row[field] for field in FIELDS])
+            count += 1
+            spill()
+    else:
+        text.write("[")
+        for row in db.iter_registrations(tournament_id):
+            text.write(("," if count else "") + "\n  " + json.dumps(dict(row), ensure_ascii=False))
+            count += 1
+            spill()
+        text.write("\n]\n")
+    spill(final=True)
+    return count
+
+
+def _player(record, where):
+    try:
+        telegram_id = int(record["telegram_id"])
+    except (KeyError, TypeError, ValueError):
+        raise ValueError(f"{where}: telegram_id must be a number") from None
+    ff_username = str(record.get("ff_username") or "").strip() or None
+    ff_userid = str(record.get("ff_userid") or "").strip() or None
+    return telegram_id, ff_username, ff_userid
+
+
+def read_players(data, fmt):
+    """Yields (telegram_id, ff_username, ff_userid) from a binary CSV or JSON file.
+
+    Raises ValueError on the first malformed row.
+    """
+    if fmt == "csv":
+        # Decoded line by line (keeping line endings, as newline="" would) rather
+        # than through io.TextIOWrapper; see export_registrations.
+        reader = csv.DictReader(codecs.iterdecode(data, "utf-8-sig"))
+        if reader.fieldnames is None or "telegram_id" not in reader.fieldnames:
+            raise ValueError(f"the CSV header must include {', '.join(FIELDS)}")
+        for record in reader:
+            yield _player(record, f"line {reader.line_num}")
+    else:
+        try:
+            records = json.load(data)
+        except json.JSONDecodeError as e:
+            raise ValueError(f"not valid JSON ({e})") from None
+        if not isinstance(records, list):
+            raise ValueError("the JSON file must contain a list of players")
+        for i, record in enumerate(records, 1):
+            if not isinstance(record, dict):
+                raise ValueError(f"entry {i}: expected an object")
+            yield _player(record, f"entry {i}")
+
+
+def import_players(tournament_id, fmt, data):
+    """Registers every player in an uploaded file in one transaction; see db.import_registrations."""
+    return db.import_registrations(tournament_id, read_players(data, fmt))
@@ -0,0 +1,218 @@
+# scheduler.py
+import asyncio
+import datetime as dtm
+import logging
+import re
+import time
+
+logger = logging.getLogger(__name__)
+
+# --- Tournament Times ---
+# Admins type the start time as free text; these are the shapes understood.
+# Dates without a year mean the occurrence nearest to today, so a typo'd past
+# date is caught rather than moved to next year, and old entries read back
+# as past dates.
+DATE_FORMATS = ("%B %d", "%b %d", "%d %B", "%d %b", "%d/%m", "%d-%m", "%d.%m")
+DATED_FORMATS = ("%B %d %Y", "%b %d %Y", "%d %B %Y", "%d %b %Y", "%Y-%m-%d", "%d/%m/%Y", "%d-%m-%Y", "%d.%m.%Y")
+TIME_FORMATS = ("%I:%M %p", "%I %p", "%H:%M", "%H.%M")
+RELATIVE_DAYS = {"today": 0, "tonight": 0, "tomorrow": 1}
+WEEKDAYS = ("monday", "tuesday", "wednesday", "thursday", "friday", "saturday", "sunday")
+
+
+def _normalize(text):
+    text = text.strip().lower().replace(",", " ")
+    text = re.sub(r"\b(at|on)\b", " ", text)
+    text = re.sub(r"(\d)(st|nd|rd|th)\b", r"\1", text)    # 10th -> 10
+    text = re.sub(r"(\d)\s*([ap])\.?m\b\.?", r"\1 \2m", text)   # 9pm, 9 p.m. -> 9 pm
+    return " ".join(text.split())
+
+
+def _parse_time(text):
+    for fmt in TIME_FORMATS:
+        try:
+            return dtm.datetime.strptime(text, fmt).time()
+        except ValueError:
+            pass
+    return None
+
+
+def _parse_date(text, today):
+    if text in RELATIVE_DAYS:
+        return today + dtm.timedelta(days=RELATIVE_DAYS[text])
+    for weekday, name in enumerate(WEEKDAYS):
+        if text in (name, name[:3]):  # the next such day, or today
+            return today + dtm.timedelta(days=(weekday - today.weekday()) % 7)
+    for fmt in DATED_FORMATS:
+        try:
+            return dtm.datetime.strptime(text, fmt).date()
+        except ValueError:
+            pass
+    for fmt in DATE_FORMATS:
+        for year in (today.year, today.year + 1, today.year - 1):
+            # Parsed with the year appended, so 29 February works in leap years.
+            try:
+                date = dtm.datetime.strptime(f"{text} {year}", f"{fmt} %Y").date()
+            except ValueError:
+                continue
+            if abs(date - today) <= dtm.timedelta(days=183):
+                return date
+    return None
+
+
+def parse_datetime(text, tz, now=None):
+    """Reads a start time like "July 10, 9:00 PM" or "tomorrow 21:00" as a UTC timestamp.
+
+    Returns None when the text can't be read. The date and time may come in
+    either order, and are taken to be in the timezone `tz`.
+    """
+    words = _normalize(text).split()
+    today = dtm.datetime.fromtimestamp(time.time() if now is None else now, tz).date()
+    for split in range(1, len(words)):
+        for date_words, time_words in ((words[:split], words[split:]), (words[split:], words[:split])):
+            date = _parse_date(" ".join(date_words), today)
+            clock = date and _parse_time(" ".join(time_words))
+            if clock:
+                return dtm.datetime.combine(date, clock, tzinfo=tz).timestamp()
+    return None
+
+
+def format_datetime(timestamp, tz):
+    return dtm.datetime.fromtimestamp(timestamp, tz).strftime("%a %d %b %Y, %I:%M %p")
+
+
+# --- Lifecycle Events ---
+# Each tournament with a start time moves through these events in order;
+# `tournaments.next_event`/`next_event_at` hold the one still to come.
+REMINDER_LEAD = 30 * 60        # remind registered players this long before the start
+MATCH_DURATION = 2 * 60 * 60   # archive this long after the start
+RECHECK_INTERVAL = 60          # also look for new events this often (other processes add tournaments)
+EVENTS = ("REMIND", "CLOSE", "ARCHIVE")
+JOB_NAME = "tournament-lifecycle"
+
+
+def event_time(event, starts_at):
+    return starts_at + {"REMIND": -REMINDER_LEAD, "CLOSE": 0, "ARCHIVE": MATCH_DURATION}[event]
+
+
+def first_event(starts_at, now=None):
+    """The first event still ahead for a tournament starting at `starts_at`, as (event, at).
+
+    A tournament whose every event has passed gets an overdue ARCHIVE.
+    """
+    now = time.time() if now is None else now
+    for event in EVENTS:
+        if event_time(event, starts_at) > now:
+            return event, event_time(event, starts_at)
+    return "ARCHIVE", event_time("ARCHIVE", starts_at)
+
+
+class TournamentScheduler:
+    """Runs tournament lifecycle events from the application's JobQueue.
+
+    One job is kept scheduled for the earliest pending event, found with an
+    indexed MIN() over `next_event_at`; when it fires, every due event is
+    handled and the job is planned again:
+
+      REMIND   queues a reminder to the registered players (as a broadcast job)
+      CLOSE    closes registration, OPEN/FULL -> IN_PROGRESS
+      ARCHIVE  FINISHED, which drops the tournament out of the open listings
+
+    Only one process should run it (shard 0 when sharded, and the holder of
+    the background lock when instances share a PostgreSQL database).
+    """
+
+    def __init__(self, store, broadcast_worker, tz):
+        self.store = store
+        self.broadcast_worker = broadcast_worker
+        self.tz = tz
+        self.job_queue = None
+        self._lock = asyncio.Lock()
+        self._backfilled = False
+
+    def start(self, job_queue):
+        if job_queue is None:
+            logger.warning("No JobQueue, tournament lifecycle events won't run "
+                           "(install python-telegram-bot[job-queue])")
+            return
+        self.job_queue = job_queue
+        self._plan(0)
+
+    def stop(self):
+        if self.job_queue is not None:
+            for job in self.job_queue.get_jobs_by_name(JOB_NAME):
+                job.schedule_removal()
+            self.job_queue = None
+
+    def wake(self):
+        """Re-plans the job right away, e.g. after a tournament was added."""
+        if self.job_queue is not None:
+            self._plan(0)
+
+    def _plan(self, delay):
+        for job in self.job_queue.get_jobs_by_name(JOB_NAME):
+            job.schedule_removal()
+        self.job_queue.run_once(self._run, when=delay, name=JOB_NAME)
+
+    async def _run(self, context):
+        async with self._lock:
+            if not self._backfilled:
+                await self._backfill()
+            failed = await self.run_due()
+            next_at = await self.store.get_next_tournament_event_time()
+        if self.job_queue is None:  # stopped meanwhile
+            return
+        delay = RECHECK_INTERVAL if next_at is None else min(max(next_at - time.time(), 0), RECHECK_INTERVAL)
+        self._plan(max(delay, RECHECK_INTERVAL) if failed else delay)
+
+    async def _backfill(self):
+        """Schedules tournaments created before start times were parsed."""
+        for t in await self.store.get_unscheduled_tournaments():
+            starts_at = parse_datetime(t['date_time'], self.tz)
+            if starts_at is None:
+                logger.info(f"Tournament {t['id']}: can't read start time {t['date_time']!r}, not scheduling it")
+                continue
+            event, at = first_event(starts_at)
+            await self.store.set_tournament_schedule(t['id'], starts_at, event, at)
+        self._backfilled = True
+
+    async def run_due(self, now=None):
+        """Handles every event that is due; returns whether any of them failed."""
+        now = time.time() if now is None else now
+        failed = False
+        for t in await self.store.get_due_tournament_events(now):
+            try:
+                await self._handle(t, now)
+            except Exception:
+                logger.exception(f"Tournament {t['id']}: {t['next_event']} failed, will retry")
+                failed = True
+        return failed
+
+    async def _handle(self, t, now):
+        event = t['next_event']
+        status = None
+        if event == "REMIND":
+            if now < t['starts_at']:  # a reminder for a match that already began is no use
+                await self._send_reminder(t)
+        elif event == "CLOSE":
+            status = "IN_PROGRESS"
+        elif event == "ARCHIVE":
+            status = "FINISHED"
+        following = EVENTS[EVENTS.index(event) + 1] if event != EVENTS[-1] else None
+        following_at = event_time(following, t['starts_at']) if following else None
+        await self.store.advance_tournament_event(t['id'], event, status, following, following_at)
+        logger.info(f"Tournament {t['id']}: {event} done" + (f", now {status}" if status else ""))
+
+    async def _send_reminder(self, t):
+        registrations = await self.store.get_registrations_for_tournament(t['id'])
+        if not registrations:
+            return
+        mode = "Battle Royale" if t['mode'] == 'BR' else "Clash Squad"
+        minutes = max(round((t['starts_at'] - time.time()) / 60), 1)
+        text = (
+            f"⏰ <b>Reminder:</b> your {mode} tournament starts in about {minutes} minutes "
+            f"({format_datetime(t['starts_at'], self.tz)}).\n\n"
+            "Watch this chat for the Room ID and Password."
+        )
+        await self.store.create_broadcast_job(text, parse_mode="HTML",
+                                              recipient_ids=[r['telegram_id'] for r in registrations])
+        self.broadcast_worker.wake()
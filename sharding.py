@@ -0,0 +1,136 @@
+# sharding.py
+import asyncio
+import logging
+import multiprocessing
+import os
+import queue
+import threading
+from collections import OrderedDict
+
+import metrics
+from dispatcher import DEDUP_WINDOW, QUEUE_SIZE, _user_key
+
+logger = logging.getLogger(__name__)
+
+STATS_INTERVAL = 2
+
+
+def run_shard(index, inbox, stats_queue):
+    """Entry point of a shard process: runs its own Application and event loop.
+
+    Updates arrive on `inbox` as raw dicts and go through the shard's own
+    UpdateDispatcher. Only shard 0 runs the background jobs (broadcast worker)
+    so they don't run once per process.
+    """
+    os.environ["SHARDS"] = "1"  # the shard itself runs a single local dispatcher
+    import main  # imported here so each spawned process builds its own bot and database connection
+
+    async def serve():
+        await main.main_setup()
+        await main.start_bot(background_jobs=index == 0)
+        loop = asyncio.get_running_loop()
+
+        async def report_stats():
+            while True:
+                await asyncio.sleep(STATS_INTERVAL)
+                await main.update_runtime_metrics()
+                stats_queue.put((index, main.dispatcher.stats(), metrics.snapshot()))
+
+        reporter = asyncio.create_task(report_stats())
+        try:
+            while True:
+                data = await loop.run_in_executor(None, inbox.get)
+                if data is None:
+                    break
+                while main.dispatcher.submit(data) == "full":
+                    await asyncio.sleep(0.05)
+        finally:
+            reporter.cancel()
+            await main.stop_bot()
+
+    asyncio.run(serve())
+
+
+class ShardCoordinator:
+    """Routes webhook updates to N shard processes by sender id.
+
+    Hashing on the user id keeps every update from one user on the same shard,
+    so ConversationHandler state and ordering hold. Shards report their
+    dispatcher stats back, and `stats()` aggregates them.
+    """
+
+    def __init__(self, shards, queue_size=QUEUE_SIZE, dedup_window=DEDUP_WINDOW):
+        self.shards = shards
+        self._context = multiprocessing.get_context("spawn")
+        self.inboxes = [self._context.Queue(maxsize=queue_size) for _ in range(shards)]
+        self._stats_queue = self._context.Queue()
+        self._processes = []
+        self._shard_stats = {}
+        self._shard_metrics = {}
+        self._seen = OrderedDict()
+        self.dedup_window = dedup_window
+        self.duplicates = 0
+        self.rejected = 0
+
+    def start(self):
+        for index, inbox in enumerate(self.inboxes):
+            process = self._context.Process(target=run_shard, args=(index, inbox, self._stats_queue),
+                                            name=f"shard-{index}", daemon=True)
+            process.start()
+            self._processes.append(process)
+        threading.Thread(target=self._collect_stats, name="shard-stats", daemon=True).start()
+        logger.info(f"Started {self.shards} shard processes")
+
+    def _collect_stats(self):
+        while True:
+            index, stats, metric_snapshot = self._stats_queue.get()
+            if index is None:
+                return
+            self._shard_stats[index] = stats
+            self._shard_metrics[index] = metric_snapshot
+
+    def submit(self, data):
+        """Same contract as UpdateDispatcher.submit: 'queued', 'duplicate', 'invalid' or 'full'."""
+        if not isinstance(data, dict) or not isinstance(data.get("update_id"), int):
+            return "invalid"
+        if data["update_id"] in self._seen:
+            self.duplicates += 1
+            return "duplicate"
+        try:
+            self.inboxes[hash(_user_key(data)) % self.shards].put_nowait(data)
+        except queue.Full:
+            self.rejected += 1
+            return "full"
+        self._seen[data["update_id"]] = None
+        if len(self._seen) > self.dedup_window:
+            self._seen.popitem(last=False)
+        return "queued"
+
+    async def stop(self, timeout=15):
+        for inbox in self.inboxes:
+            inbox.put(None)
+        loop = asyncio.get_running_loop()
+        for process in self._processes:
+            await loop.run_in_executor(None, process.join, timeout)
+            if process.is_alive():
+                process.terminate()
+        self._stats_queue.put((None, None, None))
+
+    def metric_snapshots(self):
+        """The latest metrics snapshot reported by each shard."""
+        return list(self._shard_metrics.values())
+
+    def inbox_depth(self):
+        """Updates routed to a shard that it hasn't picked up yet."""
+        return sum(inbox.qsize() for inbox in self.inboxes)
+
+    def stats(self):
+        shards = [self._shard_stats.get(index, {}) for index in range(self.shards)]
+        totals = {key: sum(s.get(key, 0) for s in shards)
+                  for key in ("queue_depth", "received", "processed", "failed", "duplicates", "rejected")}
+        totals["queue_depth"] += self.inbox_depth()
+        totals["duplicates"] += self.duplicates
+        totals["rejected"] += self.rejected
+        totals["lag_max_ms"] = max((s.get("lag_max_ms", 0) for s in shards), default=0)
+        totals["shards"] = shards
+        return totals
@@ -0,0 +1,109 @@
+# user_writes.py
+import asyncio
+import logging
+import time
+
+logger = logging.getLogger(__name__)
+
+# A buffered upsert reaches the database at most FLUSH_DELAY seconds after it
+# was queued (plus the time the batch takes); a batch that reaches MAX_BATCH
+# users is written right away.
+FLUSH_DELAY = 1.0
+MAX_BATCH = 1000
+
+
+class UserWriteBuffer:
+    """Write-behind buffer for the user upserts done on every /start.
+
+    Calls are coalesced per user in memory and written as one
+    INSERT ... ON CONFLICT DO UPDATE batch in a single transaction, so a burst
+    of /starts costs one commit per FLUSH_DELAY instead of one per message.
+    Only use it where nothing reads the row straight back; registration
+    still writes the user directly before adding the registration.
+    """
+
+    def __init__(self, store, flush_delay=FLUSH_DELAY, max_batch=MAX_BATCH):
+        self.store = store
+        self.flush_delay = flush_delay
+        self.max_batch = max_batch
+        self._pending = {}   # telegram_id -> [ff_username, ff_userid, last_seen]
+        self._oldest = None  # when the oldest pending upsert was queued
+        self._flush_task = None
+        self._flush_now = None  # made on first use, see _wakeup()
+        self._closing = False
+        self.batches = 0
+        self.written = 0
+
+    def add_or_update_user(self, telegram_id, ff_username=None, ff_userid=None):
+        self._merge(telegram_id, ff_username, ff_userid, time.time())
+        if len(self._pending) >= self.max_batch:
+            self._wakeup().set()
+        self._schedule_flush()
+
+    def _merge(self, telegram_id, ff_username, ff_userid, last_seen):
+        # Same rules as the SQL upsert: missing names keep the earlier ones.
+        if self._oldest is None:
+            self._oldest = time.monotonic()
+        current = self._pending.get(telegram_id)
+        if current is None:
+            self._pending[telegram_id] = [ff_username, ff_userid, last_seen]
+        else:
+            current[0] = ff_username or current[0]
+            current[1] = ff_userid or current[1]
+            current[2] = max(current[2], last_seen)
+
+    def _wakeup(self):
+        # The buffer is built at import time, where before Python 3.10 an
+        # asyncio.Event would bind to whatever loop get_event_loop() returns
+        # then, not the server's; so it is made inside the running loop.
+        if self._flush_now is None:
+            self._flush_now = asyncio.Event()
+        return self._flush_now
+
+    def _schedule_flush(self):
+        if self._flush_task is None or self._flush_task.done():
+            self._flush_task = asyncio.create_task(self._flush_loop())
+
+    async def _flush_loop(self):
+        # Runs while anything is pending, writing each batch once its oldest
+        # upsert is FLUSH_DELAY old (or sooner when woken).
+        while self._pending:
+            await self._wait(self._oldest + self.flush_delay - time.monotonic())
+            if not await self._write_pending():
+                if self._closing:
+                    return
+                await self._wait(self.flush_delay)  # back off before retrying
+
+    async def _wait(self, delay):
+        if delay > 0:
+            try:
+                await asyncio.wait_for(self._wakeup().wait(), delay)
+            except asyncio.TimeoutError:
+                pass
+        if not self._closing:
+            self._wakeup().clear()
+
+    async def _write_pending(self):
+        """Writes the current batch; returns False if it failed (and was put back)."""
+        if not self._pending:
+            return True
+        pending, self._pending, self._oldest = self._pending, {}, None
+        rows = [(telegram_id, *values) for telegram_id, values in pending.items()]
+        try:
+            await self.store.add_or_update_users(rows)
+        except Exception:
+            logger.exception(f"Could not write {len(rows)} buffered users, will retry with the next batch")
+            for telegram_id, ff_username, ff_userid, last_seen in rows:
+                self._merge(telegram_id, ff_username, ff_userid, last_seen)
+            return False
+        self.batches += 1
+        self.written += len(rows)
+        return True
+
+    async def flush(self):
+        """Writes everything still buffered; call before the store shuts down."""
+        self._closing = True
+        self._wakeup().set()
+        if self._flush_task is not None:
+            await self._flush_task
+        await self._write_pending()